@@ -0,0 +1,123 @@
+# One place for the normalized average pulses of every channel, shared by the odd average pulse
+# check, its plot, the batch pulse fits and the pdf report, so each average pulse is read from
+# mass once. When one channel's average pulse changes only that column and the running sum behind
+# the mean pulse are updated, and the residual statistics are recomputed lazily the next time they
+# are needed, so a live display can re-flag odd channels as new average pulses stream in.
+
+import numpy as np
+
+
+class AveragePulseStore():
+    """
+    AveragePulseStore(nsamples, npresamples)
+    Holds `norm_avg_pulses`, an `(nsamples, nchannels)` array with the normalized average pulse of each
+    channel as a column (in the order channels were first added, see `channums`), and `scales`, the
+    maximum of each unnormalized average pulse. Add or replace a channel with `set(ch, average_pulse)`.
+    `odd_channels(nsigma)` flags channels whose residual from the mean pulse is an outlier, as
+    `quality_check.channels_with_odd_average_pulse` always has.
+    """
+    def __init__(self, nsamples, npresamples, capacity=256):
+        self.nsamples = nsamples
+        self.npresamples = npresamples
+        self._pulses = np.zeros((nsamples, capacity))
+        self._scales = np.zeros(capacity)
+        self._sum = np.zeros(nsamples)
+        self.index = {} # channum -> column
+        self.channums = []
+        self._std_resid = None
+
+    @classmethod
+    def from_data(cls, data):
+        """Make a store holding the average pulse of every channel in the mass.TESGroup `data`."""
+        ds = data.first_good_dataset
+        store = cls(ds.nSamples, ds.nPresamples)
+        for ds in data:
+            store.set(ds.channum, ds.average_pulse[:])
+        return store
+
+    def __len__(self):
+        return len(self.channums)
+
+    def __contains__(self, ch):
+        return ch in self.index
+
+    @property
+    def norm_avg_pulses(self):
+        return self._pulses[:,:len(self)]
+
+    @property
+    def scales(self):
+        return self._scales[:len(self)]
+
+    @property
+    def mean_pulse(self):
+        return self._sum/max(1, len(self))
+
+    def normalized(self, ch):
+        return self._pulses[:,self.index[ch]]
+
+    def average_pulse(self, ch):
+        """Return the unnormalized average pulse of channel `ch`."""
+        i = self.index[ch]
+        return self._pulses[:,i]*self._scales[i]
+
+    def set(self, ch, average_pulse):
+        """Add channel `ch`, or replace its average pulse, updating the mean pulse in place."""
+        average_pulse = np.asarray(average_pulse, dtype=np.float64)
+        if len(average_pulse) != self.nsamples:
+            raise ValueError("average pulse of channel %s has %d samples, expected %d"%(ch, len(average_pulse), self.nsamples))
+        i = self.index.get(ch, None)
+        if i is None:
+            i = len(self)
+            if i == self._pulses.shape[1]:
+                self._grow()
+            self.index[ch] = i
+            self.channums.append(ch)
+        else:
+            self._sum -= self._pulses[:,i]
+        scale = np.amax(average_pulse)
+        self._pulses[:,i] = average_pulse/scale
+        self._scales[i] = scale
+        self._sum += self._pulses[:,i]
+        self._std_resid = None
+
+    def _grow(self):
+        n = self._pulses.shape[1]
+        pulses = np.zeros((self.nsamples, 2*n))
+        pulses[:,:n] = self._pulses
+        scales = np.zeros(2*n)
+        scales[:n] = self._scales
+        self._pulses, self._scales = pulses, scales
+
+    def std_resid(self):
+        """
+        Return the std over post trigger samples of each channel's residual from the mean normalized pulse,
+        divided by the mean pulse. Cached until the next `set`.
+        """
+        if self._std_resid is None:
+            mean = self.mean_pulse
+            weighted_resid = (self.norm_avg_pulses-mean[:,np.newaxis])/mean[:,np.newaxis]
+            self._std_resid = np.std(weighted_resid[self.npresamples:], axis=0)
+        return self._std_resid
+
+    def odd_mask(self, nsigma=5):
+        """Return a bool per channel (in `channums` order), True where `std_resid` is more than `nsigma` robust sigmas above the median."""
+        std_resid = self.std_resid()
+        med_std_resid = np.median(std_resid)
+        mad_std_resid = np.median(np.abs(std_resid-med_std_resid))
+        sigma = mad_std_resid*1.4826
+        keep_below = med_std_resid+nsigma*sigma
+        return std_resid > keep_below
+
+    def odd_channels(self, nsigma=5):
+        return [ch for (ch, odd) in zip(self.channums, self.odd_mask(nsigma)) if odd]
+
+    def update(self, ch, average_pulse, nsigma=5):
+        """
+        For live use: `set` the new average pulse of `ch`, then return `(flagged, cleared)`, the channels that became
+        odd and the channels that stopped being odd because of it (the mean pulse moves, so it can be any channel).
+        """
+        before = set(self.odd_channels(nsigma)) if len(self) > 0 else set()
+        self.set(ch, average_pulse)
+        after = set(self.odd_channels(nsigma))
+        return sorted(after-before), sorted(before-after)
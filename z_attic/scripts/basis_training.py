@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# Train per channel pulse bases like scripts/basis_create.jl (train_loop and create_basis_one_channel in
+# src/basis_creation.jl), in numpy. Each of the n_loop iterations fits a basis to the training pulses, then
+# drops the training pulses with the largest residuals. The basis comes from a truncated SVD, which here
+# is a randomized range finder. After the first loop it is warm started from the previous loop's singular
+# vectors, since dropping a few pulses barely moves them, so it needs one power iteration instead of
+# several. `svd="full"` uses a full SVD instead, for comparison. One channel is trained per process and
+# the results are written in the layout hdf5load(SVDBasisWithCreationInfo, ...) and hdf5load(SVDBasis, ...)
+# read. Julia matrices are column major, so every matrix is written transposed.
+
+import os
+import re
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import scipy.linalg
+import h5py
+import ljh
+import ljh3
+from projectors import computeprojectors, NoiseFactorCache
+
+TSVD_METHODS = ["noisemass3", "TSVD", "full"]
+PERCENTILES = list(range(10, 91, 10))+list(range(91, 100))
+
+
+def randomized_svd(a, k, start=None, oversample=10, n_iter=2, rng=None):
+    """
+    Return `(u, s, basis)`, the leading `k` left singular vectors and values of `a` and an orthonormal basis of the
+    range that was searched, to pass as `start` next time. `start`, a matrix whose columns span a guess of the range
+    of `a` (eg the previous loop's `basis`), takes the place of that many of the `k+oversample` random test vectors.
+    `n_iter` power iterations sharpen the range, each costs two products with `a`.
+    """
+    rng = np.random.RandomState(0) if rng is None else rng
+    l = min(k+oversample, *a.shape)
+    nstart = 0 if start is None else min(l, start.shape[1])
+    y = a.dot(rng.standard_normal((a.shape[1], l-nstart)).astype(a.dtype))
+    if nstart > 0:
+        y = np.hstack([start[:,:nstart], y])
+    q = np.linalg.qr(y)[0]
+    for i in range(n_iter):
+        q = np.linalg.qr(a.T.dot(q))[0]
+        q = np.linalg.qr(a.dot(q))[0]
+    ub, s, _ = np.linalg.svd(q.T.dot(a), full_matrices=False)
+    return q.dot(ub[:,:k]), s[:k], q
+
+
+def make_std_residuals(data, basis):
+    """The standard deviation of each pulse (column of `data`) minus its projection into `basis`, like basis_creation.jl."""
+    mpr = np.linalg.pinv(basis).dot(data) # model pulse reduced
+    return (data-basis.dot(mpr)).std(axis=0, ddof=1)
+
+
+def evenly_distributed_inds(n, n_wanted):
+    keep_each_n = max(1, int(np.floor(n/float(n_wanted))))
+    return np.arange(0, n, keep_each_n)
+
+
+def choose_new_train_inds(residuals, train_inds, frac_keep):
+    n_keep = int(round(frac_keep*len(train_inds)))
+    return train_inds[np.argsort(residuals[train_inds], kind="mergesort")][:n_keep]
+
+
+def train_loop(data, n_pulses_for_train, n_basis, n_loop, frac_keep_per_loop, make_basis):
+    """
+    Port of train_loop in basis_creation.jl. `data` is `(nsamples, npulses)`, `make_basis(data_train, nb)` returns
+    `(basis, singular_values)`. Returns `(basis, residuals, last_train_inds, train_inds, singular_values)`.
+    """
+    train_inds = evenly_distributed_inds(data.shape[1], n_pulses_for_train)
+    # Use only a 3-Dimensional basis the first time through. This helps reject pileup before it
+    # can sneak into the SVD.
+    nb = min(n_basis, 3)
+    for i in range(n_loop):
+        basis, singular_values = make_basis(data[:,train_inds], nb)
+        residuals = make_std_residuals(data, basis)
+        last_train_inds = train_inds
+        train_inds = choose_new_train_inds(residuals, train_inds, frac_keep_per_loop)
+        nb = n_basis
+    return basis, residuals, last_train_inds, train_inds, singular_values
+
+
+def mass3_basis(data_train, n_presamples):
+    """The constant, derivative like and average pulse components of TSVD_tsvd_mass3 in basis_creation.jl."""
+    average_pulse = data_train.mean(axis=1, dtype=np.float64)
+    if n_presamples > 0:
+        average_pulse -= average_pulse[:n_presamples].mean()
+    average_pulse[:n_presamples] = 0.0
+    average_pulse /= np.abs(average_pulse).max()
+    derivative_like = np.append(0.0, np.diff(average_pulse))
+    return np.column_stack([np.ones(len(average_pulse)), derivative_like, average_pulse])
+
+
+class BasisMaker():
+    """
+    BasisMaker(tsvd_method, n_presamples, autocorr, svd="randomized", n_iter=2, n_iter_warm=1, seed=0)
+    The `make_basis` of `train_loop` for `tsvd_method` "noisemass3" (mass3 components plus the SVD of the noise whitened
+    residuals, TSVD_tsvd_mass3 with an autocorrelation), "TSVD" (SVD of the pulses) or "full" (a full SVD of the
+    pulses, as in basis_creation.jl). With `svd` "randomized" the truncated SVDs use `randomized_svd`, with `n_iter`
+    power iterations the first time and `n_iter_warm` when warm started from the previous call, with "full" a full
+    SVD truncated to the leading vectors. `nsvd` counts the SVDs done.
+    """
+    def __init__(self, tsvd_method, n_presamples, autocorr, svd="randomized", n_iter=2, n_iter_warm=1, seed=0):
+        if tsvd_method not in TSVD_METHODS:
+            raise ValueError("tsvd_method %r is not one of %s, TSVDmass3 needs an ARMA model, use basis_create.jl"%(tsvd_method, TSVD_METHODS))
+        self.tsvd_method = tsvd_method
+        self.n_presamples = n_presamples
+        self.autocorr = np.asarray(autocorr, dtype=np.float64)
+        self.svd = "full" if tsvd_method == "full" else svd
+        self.n_iter = n_iter
+        self.n_iter_warm = n_iter_warm
+        self.rng = np.random.RandomState(seed)
+        self.start = None
+        self.nsvd = 0
+        self.noise = NoiseFactorCache("cholesky")
+
+    def truncated_svd(self, a, k):
+        self.nsvd += 1
+        if self.svd == "full":
+            u, s, _ = np.linalg.svd(a, full_matrices=False)
+            return u[:,:k], s[:k]
+        n_iter = self.n_iter if self.start is None else self.n_iter_warm
+        u, s, self.start = randomized_svd(a, k, self.start, n_iter=n_iter, rng=self.rng)
+        return u, s
+
+    def __call__(self, data_train, n_basis):
+        if self.tsvd_method != "noisemass3":
+            return self.truncated_svd(data_train, n_basis)
+        if n_basis < 3:
+            raise ValueError("mean, derivative and average pulse are 3 components, must request at least 3 components")
+        basis3 = mass3_basis(data_train, self.n_presamples)
+        if n_basis == 3:
+            return basis3, np.array([np.nan]*3)
+        projectors3, _ = computeprojectors(basis3, self.autocorr)
+        data_residual = data_train-basis3.dot(projectors3.dot(data_train))
+        # Whiten residual before taking the TSVD
+        L = self.noise.get(self.autocorr, data_train.shape[0]) # whose inverse whitens a record
+        white_residual = scipy.linalg.solve_triangular(L, data_residual, lower=True)
+        uwhite, s = self.truncated_svd(white_residual, n_basis-3)
+        # Unwhiten and renormalize U before combining
+        uunnorm = L.dot(uwhite)
+        u = uunnorm/np.sqrt((uunnorm**2).sum(axis=0))
+        return np.column_stack([basis3, u]), np.append([np.nan]*3, s)
+
+
+def create_basis_one_channel(data, autocorr, frac_keep, n_loop, n_pulses_for_train, n_basis, tsvd_method,
+        n_presamples, svd="randomized", seed=0):
+    """
+    Port of create_basis_one_channel in basis_creation.jl for `(nsamples, npulses)` `data`. Projectors always come
+    from the autocorrelation (the Julia version uses the ARMA model for methods other than noisemass3). Returns a dict
+    of the fields of SVDBasisWithCreationInfo, matrices in `(nsamples, n)` numpy orientation, without the noise.
+    """
+    make_basis = BasisMaker(tsvd_method, n_presamples, autocorr, svd=svd, seed=seed)
+    frac_keep_per_loop = np.exp(np.log(frac_keep)/n_loop)
+    basis, residual_stds, last_train_inds, train_inds, singular_values = train_loop(data, n_pulses_for_train,
+        n_basis, n_loop, frac_keep_per_loop, make_basis)
+    projectors, pcovar = computeprojectors(basis, autocorr)
+    sortinds = np.argsort(residual_stds, kind="mergesort")
+    percentile_indicies = sortinds[[int(round((p/100.0)*len(residual_stds)))-1 for p in PERCENTILES]]
+    return dict(basis=basis, projectors=projectors, projector_covariance=pcovar, singular_values=singular_values,
+        example_pulses=np.round(data[:,percentile_indicies]).astype(np.uint16),
+        std_residuals_of_example_pulses=residual_stds[percentile_indicies],
+        percentiles_of_sample_pulses=np.array(PERCENTILES, dtype=np.float32),
+        n_loop=n_loop, std_residuals=residual_stds, tsvd_method=tsvd_method, noise_std_dev=np.sqrt(autocorr[0]),
+        nsvd=make_basis.nsvd)
+
+
+def getall(filename, maxrecords):
+    """Return `(data, n_presamples)`, the first `maxrecords` records of an LJH 2.x or 3 file as `(nsamples, n)` float32, like getall."""
+    if ljh3.is_ljh3(filename):
+        with ljh3.LJH3File(filename) as f:
+            headers, samples = f.read_range(0, min(maxrecords, len(f)))
+            if len(set(len(s) for s in samples)) > 1:
+                raise ValueError("%s: records of different lengths can't be trained on together"%filename)
+            return np.array(samples, dtype=np.float32).T, int(headers["first_rising_sample"][0])
+    f = ljh.LJHFile(filename)
+    return f.samples[:maxrecords].astype(np.float32).T, f.npresamples
+
+
+def train_channel(job):
+    """
+    train_channel(job)
+    Train one channel's basis for a multiprocessing.Pool. `job` is a dict with `pulse_file`, `autocorr` and the
+    arguments of `create_basis_one_channel`. Returns `(job, result, elapsed_s)`.
+    """
+    tstart = time.time()
+    data, n_presamples = getall(job["pulse_file"], int(np.ceil(job["n_pulses_for_train"]/job["frac_keep"])))
+    result = create_basis_one_channel(data, job["autocorr"], job["frac_keep"], job["n_loop"], job["n_pulses_for_train"],
+        job["n_basis"], job["tsvd_method"], n_presamples, job.get("svd", "randomized"), job.get("seed", 0))
+    return job, result, time.time()-tstart
+
+
+def write_basis(h5, channum, result, noise_group, pulse_file):
+    """
+    Write one channel's `result` of `create_basis_one_channel` to the group `<channum>` of the open hdf5 file `h5` in the
+    layout of hdf5save(g, ::SVDBasisWithCreationInfo), copying the hdf5 group `noise_group` (`<channum>/noise` of a noise
+    analysis file) as `svdbasis/noise_result`. hdf5load only works if that group has the ARMAModel of noise_analysis.jl.
+    """
+    g = h5.create_group("%d"%channum)
+    sg = g.create_group("svdbasis")
+    sg["basis"] = result["basis"].T.astype(np.float32)
+    sg["projectors"] = result["projectors"].T.astype(np.float32)
+    sg["projector_covariance"] = result["projector_covariance"].T.astype(np.float32)
+    noise_group.file.copy(noise_group, sg, "noise_result")
+    g["singular_values"] = result["singular_values"].astype(np.float32)
+    g["example_pulses"] = result["example_pulses"].T
+    g["std_residuals_of_example_pulses"] = result["std_residuals_of_example_pulses"].astype(np.float32)
+    g["percentiles_of_sample_pulses"] = result["percentiles_of_sample_pulses"]
+    g["n_loop"] = np.int64(result["n_loop"])
+    source = noise_group["source"][()] if "source" in noise_group else ""
+    g["noise_model_file"] = source.decode() if isinstance(source, bytes) else source
+    g["pulse_file"] = pulse_file
+    g["std_residuals"] = result["std_residuals"].astype(np.float32)
+    g["tsvd_method"] = result["tsvd_method"]
+    g["channel_number"] = np.int64(channum)
+    g["noise_std_dev"] = np.float64(result["noise_std_dev"])
+
+
+def make_basis_all_channel(output, pulse_files, noise_filename, frac_keep=0.8, n_loop=5, n_pulses_for_train=3000,
+        n_basis=6, tsvd_method="noisemass3", svd="randomized", workers=None):
+    """
+    Train a basis for every channel in `pulse_files`, a dict of channel number -> LJH file, that has a noise result in
+    `noise_filename` (written by noise_analysis.jl, or `noise_analysis.write_noise_results`), one channel per worker
+    process in a pool of `workers` (default one per core), and write them to the hdf5 file `output`. Failed channels
+    are reported and skipped, like make_basis_all_channel. Returns a dict of channum -> (nsvd, elapsed_s).
+    """
+    summary = {}
+    with h5py.File(noise_filename, "r") as noise_h5, h5py.File(output, "w") as h5:
+        noise_channels = set(int(k) for k in noise_h5.keys())
+        jobs = [dict(channum=ch, pulse_file=fname, autocorr=noise_h5["%d/noise/autocorr"%ch][()], frac_keep=frac_keep,
+            n_loop=n_loop, n_pulses_for_train=n_pulses_for_train, n_basis=n_basis, tsvd_method=tsvd_method, svd=svd)
+            for (ch, fname) in sorted(pulse_files.items()) if ch in noise_channels]
+        print("Channels in noise_file but not in ljh: %s"%sorted(noise_channels-set(pulse_files)))
+        print("Channels in ljh but not in noise_file: %s"%sorted(set(pulse_files)-noise_channels))
+        pool = multiprocessing.Pool(workers)
+        try:
+            # one writer, the parent, channels are written in whatever order they finish
+            for (job, result, elapsed_s) in pool.imap_unordered(_train_channel_or_error, jobs):
+                if isinstance(result, Exception):
+                    print("channel %d failed:\n%s"%(job["channum"], result))
+                    continue
+                write_basis(h5, job["channum"], result, noise_h5["%d/noise"%job["channum"]], job["pulse_file"])
+                summary[job["channum"]] = (result["nsvd"], elapsed_s)
+        finally:
+            pool.close()
+            pool.join()
+    return summary
+
+
+def _train_channel_or_error(job):
+    try:
+        return train_channel(job)
+    except Exception as ex:
+        return job, ex, 0.0
+
+
+parser = argparse.ArgumentParser(description='Train a pulse basis for every channel with randomized SVDs, writing output that basis_create.jl would.')
+parser.add_argument('pulse_file', help="any one channel's LJH file, the other channels' are found from it")
+parser.add_argument('noise_file', help="noise analysis hdf5 file, from noise_analysis.jl or make_preknowledge.py --noise_analysis_file")
+parser.add_argument('--outputfile', '-o', help="output hdf5 file, default <pulse_file base>_model.hdf5 like basis_create.jl", default=None)
+parser.add_argument('--replaceoutput', '-r', help="overwrite an existing output file", action="store_true")
+parser.add_argument('--n_pulses_for_train', help="number of pulses for training", default=3000, type=int)
+parser.add_argument('--n_basis', help="number of basis vectors to calculate", default=6, type=int)
+parser.add_argument('--n_loop', help="number of training loops", default=5, type=int)
+parser.add_argument('--frac_keep', help="the fraction of training pulses left uncut after all loops", default=0.8, type=float)
+parser.add_argument('--tsvd_method', help="one of %s, as in basis_create.jl"%TSVD_METHODS, default="noisemass3")
+parser.add_argument('--svd', help="randomized, or full for a full SVD in every loop", default="randomized")
+parser.add_argument('--maxchannels', help="process at most this many channels, in order from lowest channel number", default=1000000, type=int)
+parser.add_argument('--workers', help="worker processes, default one per core", default=None, type=int)
+
+
+def dir_base_ext(pulse_file):
+    """Return `(dirname, base, ext)` of an LJH filename like "somedir/a_chan1.ljh", base without the _chanN, like dir_base_ext in ljhutil.jl."""
+    bname, ext = os.path.splitext(os.path.basename(pulse_file))
+    m = re.search(r"_chan\d+", bname)
+    return os.path.dirname(pulse_file) or ".", bname[:m.start()] if m else bname, ext or ".ljh"
+
+
+def ljh_channel_files(pulse_file, maxchannels):
+    """Return a dict of channel number -> filename of the LJH files in the same set as `pulse_file`, like LJH.allchannels."""
+    dname, bname, ext = dir_base_ext(pulse_file)
+    files = {}
+    for name in os.listdir(dname):
+        m = re.match(re.escape(bname)+r"_chan(\d+)"+re.escape(ext)+"$", name)
+        if m:
+            files[int(m.group(1))] = os.path.join(dname, name)
+    return {ch:files[ch] for ch in sorted(files)[:maxchannels]}
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    pulse_files = ljh_channel_files(args.pulse_file, args.maxchannels)
+    output = args.outputfile
+    if output is None:
+        dname, bname, ext = dir_base_ext(args.pulse_file)
+        output = os.path.join(dname, bname+"_model.hdf5")
+    if os.path.isfile(output) and not args.replaceoutput:
+        print("intended output file %s exists, pass --replaceoutput if you would like to overwrite it"%output)
+        raise SystemExit(1)
+    tstart = time.time()
+    summary = make_basis_all_channel(output, pulse_files, args.noise_file, args.frac_keep, args.n_loop,
+        args.n_pulses_for_train, args.n_basis, args.tsvd_method, args.svd, args.workers)
+    print("trained %d channels in %0.2f s, wrote %s"%(len(summary), time.time()-tstart, output))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# Offline reprocessing of LJH files with a preknowledge file, in numpy, without Pope or mass. Does what
+# Pope's MassCompatibleAnalysisFeb2017 does to each record (summarize in z_attic/src/summarize.jl,
+# filter_single_lag in z_attic/src/apply_filter.jl) but for a block of records at a time: the summaries
+# are whole array reductions, and filtering is one (nrecords, nsamples-1) x (nsamples-1, 2) matrix product
+# per block with the filter and its arrival time component as the two columns. Channels are spread over
+# a process pool, and the output is written in the layout of Pope's hdf5 output, so pope_hdf5.py,
+# columnar.py and mass read it the same way, and it can be compared field for field with Pope's.
+
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import h5py
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from preknowledge_format import PreknowledgeFile
+import ljh
+
+# mass's default 5 point derivative kernel, k1..k5 in max_timeseries_deriv_mass
+DERIV_KERNEL = np.array([2, 1, 0, -1, -2])
+
+
+class MassCompatibleAnalysis():
+    """
+    MassCompatibleAnalysis(filter, filter_at, npresamples, nsamples, peak_index, frametime, shift_threshold,
+        pretrigger_rms_cuts, postpeak_deriv_cuts, pk_filename="")
+    The python twin of Pope's `MassCompatibleAnalysisFeb2017`, usually made with `from_preknowledge`.
+    `peak_index` is the 1 based index written to `summarize/peak_index`. Call `analyze` on a block of records.
+    """
+    def __init__(self, filter, filter_at, npresamples, nsamples, peak_index, frametime, shift_threshold,
+            pretrigger_rms_cuts, postpeak_deriv_cuts, pk_filename=""):
+        self.filter = np.asarray(filter, dtype=np.float64)
+        self.filter_at = np.asarray(filter_at, dtype=np.float64)
+        if len(self.filter) != nsamples-1 or len(self.filter_at) != nsamples-1:
+            raise ValueError("filters have %d and %d values, need nsamples-1 = %d"%(len(self.filter), len(self.filter_at), nsamples-1))
+        self.filters = np.column_stack((self.filter, self.filter_at)) # (nsamples-1, 2), one matrix product does both
+        self.npresamples = int(npresamples)
+        self.nsamples = int(nsamples)
+        self.peak_index = int(peak_index)
+        self.frametime = float(frametime)
+        self.shift_threshold = int(shift_threshold)
+        self.pretrigger_rms_cuts = np.asarray(pretrigger_rms_cuts, dtype=np.float64)
+        self.postpeak_deriv_cuts = np.asarray(postpeak_deriv_cuts, dtype=np.float64)
+        self.pk_filename = pk_filename
+
+    @classmethod
+    def from_preknowledge(cls, values, pk_filename=""):
+        """Make one from a channel's preknowledge, a dict of path -> value as returned by `PreknowledgeFile.channel`."""
+        if values.get("analysis_type", None) != "mass compatible feb 2017":
+            raise ValueError("preknowledge analysis_type is %r, not mass compatible feb 2017"%values.get("analysis_type", None))
+        return cls(values["filter/values"], values["filter/values_at"], values["trigger/npresamples"], values["trigger/nsamples"],
+            values["summarize/peak_index"], values["physical/frametime"], values["filter/shift_threshold"],
+            values["cuts/pretrigger_rms"], values["cuts/postpeak_deriv"], pk_filename)
+
+    def check_compatibility(self, ljhfile):
+        """Raise ValueError if the `ljh.LJHFile` `ljhfile` doesn't match, like Pope's `check_compatability`."""
+        if ljhfile.nsamples != self.nsamples:
+            raise ValueError("Channel %d has %d samples, analyzer has %d."%(ljhfile.channum, ljhfile.nsamples, self.nsamples))
+        if ljhfile.npresamples != self.npresamples:
+            raise ValueError("Channel %d has %d pretrigger samples, analyzer has %d."%(ljhfile.channum, ljhfile.npresamples, self.npresamples))
+        if ljhfile.frametime != self.frametime:
+            raise ValueError("Channel %d has %g frametime, analyzer has %g."%(ljhfile.channum, ljhfile.frametime, self.frametime))
+
+    def analyze(self, samples, rowcount, timestamp_usec):
+        """Return a `dtype_MassCompatibleDataProductFeb2017` array for the `(n, nsamples)` uint16 `samples`."""
+        out = np.zeros(len(samples), dtype_MassCompatibleDataProductFeb2017)
+        summary = summarize_batch(samples, self.npresamples, self.peak_index, self.frametime)
+        for (name, v) in summary.items():
+            out[name] = v
+        out["filt_phase"], out["filt_value"] = filter_single_lag_batch(samples, self.filters, summary["pretrig_mean"],
+            self.npresamples, self.shift_threshold)
+        out["timestamp"] = np.asarray(timestamp_usec)/1e6
+        out["rowcount"] = rowcount
+        return out
+
+
+def max_timeseries_deriv_mass_batch(samples, s):
+    """
+    `max_timeseries_deriv_mass(p, s)` of summarize.jl for every row of `samples`, with `s` 1 based like there: the largest
+    of min(t[m], t[m+2]) over windows starting at m = s+1 to N-6, where t[m] is the 5 point kernel applied at m, over 10.
+    """
+    n = samples.shape[1]
+    a = s # 0 based index of sample s+1
+    nwin = n-4-a # windows starting at s+1 .. N-4
+    p = samples.astype(np.int32)
+    t = sum(k*p[:,a+4-i:a+4-i+nwin] for (i, k) in enumerate(DERIV_KERNEL)) # t[m] = k5*p[m]+...+k1*p[m+4]
+    nm = max(1, nwin-2)
+    return np.minimum(t[:,:nm], t[:,2:2+nm]).max(axis=1)/10.0
+
+
+def estimate_rise_time_batch(samples, npresamples, peak_idx, peak_val, ptm, frametime):
+    """`estimate_rise_time(p, npresamples+1:peak_idx, peak_val, ptm, frametime)` of summarize.jl for every row, indices 1 based."""
+    n, nsamples = samples.shape
+    rise_time = np.full(n, float(nsamples))
+    ok = (peak_idx <= nsamples)&(peak_idx >= npresamples+1)
+    if not np.any(ok):
+        return rise_time
+    pk = peak_idx[ok]
+    last = int(pk.max())
+    p = samples[ok,:last] # nothing after the latest peak is looked at
+    peakval = peak_val[ok].astype(np.float64)
+    ptm = ptm[ok]
+    thresh10 = 0.1*(peakval-ptm)+ptm
+    thresh90 = 0.9*(peakval-ptm)+ptm
+    cols = np.arange(1, last+1) # 1 based, like the julia
+    rows = np.arange(len(p))
+    # first j in npresamples+1:peak with p[j] > thresh10, idx10 = j-1, or npresamples+1 if there is none
+    above = (p > thresh10[:,None])&(cols >= npresamples+1)&(cols <= pk[:,None])
+    found = above.any(axis=1)
+    idx10 = np.where(found, cols[above.argmax(axis=1)]-1, npresamples+1)
+    # first j in idx10+1:peak with p[j] > thresh90, idx90 = j-1, or peak if there is none
+    above = (p > thresh90[:,None])&(cols >= idx10[:,None]+1)&(cols <= pk[:,None])
+    found = above.any(axis=1)
+    idx90 = np.where(found, cols[above.argmax(axis=1)]-1, pk)
+    # the julia subtracts UInt16 samples, which wraps around when the 90% sample is lower
+    rise = (p[rows, idx90-1]-p[rows, idx10-1]).astype(np.uint16).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fracrise = rise/(peakval-ptm)
+        rise_time[ok] = (idx90-idx10)*frametime/fracrise
+    return rise_time
+
+
+def summarize_batch(samples, npresamples, peak_index, frametime):
+    """
+    Return a dict of summary field -> array for the `(n, nsamples)` uint16 `samples`, like `summarize` in summarize.jl,
+    with `peak_index` the average pulse peak index (1 based) that `postpeak_deriv` starts after. `peak_index` in the
+    result is 1 based as Pope writes it.
+    """
+    n, nsamples = samples.shape
+    x = np.asarray(samples, dtype=np.float64) # sums of squares of uint16 samples are exact in float64
+    pre, post = x[:,:npresamples], x[:,npresamples:]
+    s, s2 = pre.sum(axis=1), np.einsum("ij,ij->i", pre, pre)
+    ptm = s/npresamples
+    pretrig_rms = np.sqrt(np.abs(s2/npresamples-ptm*ptm))
+    npost = nsamples-npresamples
+    s, s2 = post.sum(axis=1), np.einsum("ij,ij->i", post, post)
+    pulse_average = s/npost-ptm
+    pulse_rms = np.sqrt(np.abs(s2/npost-ptm*(ptm+2*pulse_average)))
+    # the running peak starts at 0 and takes the first maximum; the running minimum only sees samples that
+    # did not set a new peak (the elseif in summarize.jl)
+    peak_val = samples.max(axis=1)
+    peak_idx = np.where(peak_val > 0, samples.argmax(axis=1)+1, 0)
+    # a sample that sets a new peak is above everything before it, so it can only be the minimum if it is the
+    # first sample, only those rows need the running peak
+    min_val = samples.min(axis=1)
+    slow = np.nonzero((samples.argmin(axis=1) == 0)&(samples[:,0] > 0))[0]
+    if len(slow) > 0:
+        p = samples[slow]
+        newpeak = np.empty(p.shape, dtype=bool)
+        newpeak[:,0] = True
+        np.greater(p[:,1:], np.maximum.accumulate(p, axis=1)[:,:-1], out=newpeak[:,1:])
+        min_val[slow] = np.where(newpeak, np.iinfo(np.uint16).max, p).min(axis=1)
+    peak_rel = peak_val-ptm
+    peak_value = np.where((peak_rel >= 0)&(peak_rel <= np.iinfo(np.uint16).max), np.round(peak_rel), 0)
+    return dict(
+        pretrig_mean=ptm,
+        pretrig_rms=pretrig_rms,
+        pulse_average=pulse_average,
+        pulse_rms=pulse_rms,
+        rise_time=estimate_rise_time_batch(samples, npresamples, peak_idx, peak_val, ptm, frametime),
+        postpeak_deriv=max_timeseries_deriv_mass_batch(samples, peak_index),
+        peak_index=peak_idx,
+        peak_value=peak_value,
+        min_value=min_val,
+    )
+
+
+def filter_single_lag_batch(samples, filters, pretrig_mean, npresamples, shift_threshold):
+    """
+    `filter_single_lag` of apply_filter.jl for every row of `samples`, return `(filt_phase, filt_value)`. `filters` is
+    the `(nsamples-1, 2)` matrix of the filter and its arrival time component. Records that want to shift (sample
+    npresamples+3, 1 based, more than `shift_threshold` above the pretrigger mean) use samples 1:end-1, the rest 2:end.
+    """
+    x = samples.astype(np.float64)
+    shift = x[:,npresamples+2]-pretrig_mean > shift_threshold
+    conv = x[:,1:].dot(filters)
+    if np.any(shift):
+        conv[shift] = x[shift,:-1].dot(filters)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return conv[:,1]/conv[:,0], conv[:,0]
+
+
+def analyze_ljh(job):
+    """
+    analyze_ljh(job)
+    Run every record of `job["ljh_filename"]` through `job["analysis"]` (a `MassCompatibleAnalysis`), `job["block"]`
+    records at a time, for use with a multiprocessing.Pool. Returns `(job, records, elapsed_s)`.
+    """
+    tstart = time.time()
+    f = ljh.LJHFile(job["ljh_filename"])
+    analysis = job["analysis"]
+    analysis.check_compatibility(f)
+    records = np.zeros(len(f), dtype_MassCompatibleDataProductFeb2017)
+    rowcount, timestamp_usec = f.rowcount, f.timestamp_usec
+    for (first, end, segnum, samples) in f.iter_segments(job.get("block", 4096)):
+        records[first:end] = analysis.analyze(samples, rowcount[first:end], timestamp_usec[first:end])
+    return job, records, time.time()-tstart
+
+
+def write_channel(h5, channum, records, analysis, ljh_filename):
+    """Write `records` of one channel to the open hdf5 file `h5` in the layout of Pope's hdf5 output."""
+    g = h5.create_group("chan%d"%channum)
+    for name in dtype_MassCompatibleDataProductFeb2017.names:
+        g.create_dataset(name, data=records[name], chunks=(min(len(records), 1000),) if len(records) > 0 else None)
+    cg = g.create_group("calculated_cuts")
+    cg["pretrig_rms"] = analysis.pretrigger_rms_cuts
+    cg["postpeak_deriv"] = analysis.postpeak_deriv_cuts
+    g.attrs["filename"] = ljh_filename
+    g.attrs["pope_preknowledge_file"] = analysis.pk_filename
+    g.attrs["channum"] = channum
+    g.attrs["noise_filename"] = "analyzed by batch_filter.py, see `pope_preknowledge_file`"
+
+
+def reprocess(ljh_filenames, pk_filename, output, workers=None, block=4096):
+    """
+    Analyze each LJH file in `ljh_filenames` with its channel's preknowledge from `pk_filename` (either layout) and
+    write the results to the hdf5 file `output`, one channel per worker process in a pool of `workers` (default one
+    per core). Channels without preknowledge are skipped. Returns a dict of channum -> (nrecords, elapsed_s).
+    """
+    with PreknowledgeFile(pk_filename) as pk:
+        channels = set(pk.channels)
+        jobs = []
+        for fname in ljh_filenames:
+            ch = ljh.LJHFile(fname).channum
+            if ch not in channels:
+                print("chan%d: no preknowledge, skipping %s"%(ch, fname))
+                continue
+            jobs.append(dict(channum=ch, ljh_filename=fname, block=block,
+                analysis=MassCompatibleAnalysis.from_preknowledge(pk.channel(ch), os.path.abspath(pk_filename))))
+    if len(jobs) == 0:
+        raise ValueError("none of the LJH files have preknowledge in %s"%pk_filename)
+    summary = {}
+    pool = multiprocessing.Pool(workers)
+    try:
+        with h5py.File(output, "w") as h5:
+            a = jobs[0]["analysis"]
+            h5.attrs["nsamples"] = a.nsamples
+            h5.attrs["npresamples"] = a.npresamples
+            h5.attrs["frametime"] = a.frametime
+            # one writer, the parent, channels are written in whatever order they finish
+            for (job, records, elapsed_s) in pool.imap_unordered(analyze_ljh, jobs):
+                write_channel(h5, job["channum"], records, job["analysis"], job["ljh_filename"])
+                summary[job["channum"]] = (len(records), elapsed_s)
+    finally:
+        pool.close()
+        pool.join()
+    return summary
+
+
+parser = argparse.ArgumentParser(description='Reprocess LJH files with a preknowledge file in numpy, writing output like Pope\'s hdf5 output.')
+parser.add_argument('pk_filename', help="preknowledge file, grouped or packed")
+parser.add_argument('output', help="hdf5 file to write")
+parser.add_argument('ljh_filenames', help="LJH files to analyze, one per channel", nargs="+")
+parser.add_argument('--workers', help="worker processes, default one per core", default=None, type=int)
+parser.add_argument('--block', help="records per block", default=4096, type=int)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    tstart = time.time()
+    summary = reprocess(args.ljh_filenames, args.pk_filename, args.output, args.workers, args.block)
+    elapsed = time.time()-tstart
+    nrecords = sum(n for (n, t) in summary.values())
+    print("analyzed %d records from %d channels in %0.2f s, %0.0f records/s"%(nrecords, len(summary), elapsed, nrecords/elapsed))
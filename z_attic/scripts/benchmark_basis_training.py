@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Compare basis training with randomized, warm started SVDs against full SVDs (basis_training.py
+# --svd full) on synthetic pulses: two pulse shapes with random amplitudes, arrival jitter, some pileup,
+# and correlated noise with a known autocorrelation. Reports the training time, the median and 90th
+# percentile std residual of every pulse in the final basis, and the principal angles between the two
+# bases. The leading angles are the signal subspace and should be tiny; components past the signal rank
+# of the data only fit noise, and can point anywhere without changing the residuals.
+import time
+import argparse
+import numpy as np
+import scipy.linalg
+from basis_training import create_basis_one_channel
+
+parser = argparse.ArgumentParser(description='Benchmark randomized against full SVD basis training.')
+parser.add_argument('--npulses', help="synthetic pulses, training uses n_pulses_for_train of them", default=20000, type=int)
+parser.add_argument('--nsamples', help="samples per pulse", default=1000, type=int)
+parser.add_argument('--n_pulses_for_train', help="number of pulses for training", default=16000, type=int)
+parser.add_argument('--n_basis', help="number of basis vectors", default=6, type=int)
+parser.add_argument('--n_loop', help="number of training loops", default=5, type=int)
+parser.add_argument('--frac_keep', help="fraction of training pulses kept after all loops", default=0.8, type=float)
+parser.add_argument('--methods', help="tsvd methods to compare", default=["noisemass3", "TSVD"], nargs="+")
+
+
+def synthetic(npulses, nsamples, seed=0):
+    """Return `(data, autocorr, npresamples)`, `(nsamples, npulses)` float32 pulses and their noise autocorrelation."""
+    rng = np.random.RandomState(seed)
+    npre = nsamples//4
+    t = np.arange(nsamples)
+    def shape(t0, rise, fall):
+        x = np.clip(t-t0, 0, None)
+        return np.exp(-x/fall)-np.exp(-x/rise)
+    amps = rng.choice([3000.0, 6000.0], npulses)*rng.uniform(0.95, 1.05, npulses)
+    t0 = npre+rng.uniform(-0.5, 0.5, npulses)
+    data = np.empty((nsamples, npulses), dtype=np.float32)
+    for i in range(npulses):
+        data[:,i] = 1000+amps[i]*(0.9*shape(t0[i], 5.0, 80.0)+0.1*shape(t0[i], 5.0, 400.0))
+    pileup = rng.rand(npulses) < 0.05
+    for i in np.nonzero(pileup)[0]:
+        data[:,i] += 3000*shape(rng.uniform(npre+20, nsamples), 5.0, 80.0)
+    # AR(1) noise, autocorrelation sigma^2 phi^k
+    phi, sigma = 0.6, 10.0
+    white = rng.standard_normal((nsamples, npulses))*sigma*np.sqrt(1-phi**2)
+    noise = np.empty_like(white)
+    noise[0] = rng.standard_normal(npulses)*sigma
+    for k in range(1, nsamples):
+        noise[k] = phi*noise[k-1]+white[k]
+    data += noise
+    return data, sigma**2*phi**np.arange(nsamples), npre
+
+
+def principal_angles_deg(a, b):
+    s = scipy.linalg.svdvals(np.linalg.qr(a)[0].T.dot(np.linalg.qr(b)[0]))
+    return np.degrees(np.arccos(np.clip(s, -1, 1)))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    data, autocorr, npre = synthetic(args.npulses, args.nsamples)
+    print("%d pulses of %d samples, training on %d, %d basis vectors, %d loops"%(args.npulses, args.nsamples,
+        args.n_pulses_for_train, args.n_basis, args.n_loop))
+    for method in args.methods:
+        results = {}
+        for svd in ["full", "randomized"]:
+            tstart = time.time()
+            r = create_basis_one_channel(data, autocorr, args.frac_keep, args.n_loop, args.n_pulses_for_train,
+                args.n_basis, method, npre, svd=svd)
+            elapsed = time.time()-tstart
+            results[svd] = r
+            print("%-10s %-10s: %7.2f s, std residual median %0.4f, 90th percentile %0.4f"%(method, svd, elapsed,
+                np.median(r["std_residuals"]), np.percentile(r["std_residuals"], 90)))
+        print("%-10s principal angles between the bases (degrees): %s"%(method, " ".join("%0.2g"%x
+            for x in principal_angles_deg(results["full"]["basis"], results["randomized"]["basis"]))))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Compare reading cut filt_value from Pope hdf5 output the way open_pope_hdf5_only does (open the
+# file, read whole columns, evaluate cuts) against a columnar.ColumnarFile query with the same cuts
+# pushed down to chunk statistics, for a cuts only query and for cuts plus a timestamp range.
+# Writes a synthetic file in the Pope layout, with a few stretches of noisy data the cuts reject,
+# unless one is given.
+import os
+import time
+import argparse
+import numpy as np
+import h5py
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from cuts import CutSet
+import columnar
+
+parser = argparse.ArgumentParser(description='Benchmark columnar export queries against whole column reads of Pope hdf5 output.')
+parser.add_argument('--filename', help="Pope hdf5 file to read, default write a synthetic one", default=None)
+parser.add_argument('--nchannels', help="channels in the synthetic file", default=16, type=int)
+parser.add_argument('--nrecords', help="records per channel in the synthetic file", default=1000000, type=int)
+parser.add_argument('--chunksize', help="records per chunk of the columnar file", default=2**16, type=int)
+parser.add_argument('--compression', help="h5py compression for the columnar file, eg lzf or gzip", default=None)
+parser.add_argument('--repeat', help="repeat each query this many times and report the best", default=3, type=int)
+
+fields = ["filt_value", "timestamp"]
+cuts = CutSet({"pretrig_rms":(None, 30.0), "postpeak_deriv":(None, 20.0)})
+
+
+def write_synthetic(filename, nchannels, nrecords):
+    rng = np.random.RandomState(0)
+    with h5py.File(filename, "w") as h5:
+        for i in range(nchannels):
+            g = h5.create_group("chan%d"%(2*i+1))
+            records = np.zeros(nrecords, dtype_MassCompatibleDataProductFeb2017)
+            records["filt_value"] = rng.uniform(0, 20000, nrecords)
+            records["timestamp"] = np.cumsum(rng.exponential(0.01, nrecords))
+            records["pretrig_rms"] = rng.exponential(5, nrecords)
+            records["postpeak_deriv"] = rng.exponential(4, nrecords)
+            # noisy stretches, eg while the fridge was cycling, fail the cuts entirely
+            for start in rng.randint(0, nrecords, 4):
+                records["pretrig_rms"][start:start+nrecords//10] += 100
+            for name in dtype_MassCompatibleDataProductFeb2017.names:
+                g.create_dataset(name, data=records[name], chunks=(1000,))
+            g.create_group("calculated_cuts")
+            g["calculated_cuts"]["pretrig_rms"] = np.array([0.0, 30.0])
+            g["calculated_cuts"]["postpeak_deriv"] = np.array([0.0, 20.0])
+
+def query_hdf5(filename, where):
+    # open, read whole columns, cut, like open_pope_hdf5_only without the mass bookkeeping
+    total = 0
+    with h5py.File(filename, "r") as h5:
+        for g in h5.values():
+            cols = {name:g[name][:] for name in set(fields)|set(where.fields)}
+            good = np.ones(len(cols["filt_value"]), dtype=bool)
+            for (field, lo, hi) in zip(where.fields, where.lo, where.hi):
+                good &= (cols[field] >= lo)&(cols[field] <= hi)
+            total += sum(len(cols[name][good]) for name in fields)
+    return total
+
+def query_columnar(filename, where):
+    total = 0
+    nskipped = nchunks = 0
+    with columnar.ColumnarFile(filename) as cf:
+        for channel in cf:
+            columns, info = channel.query(fields, where)
+            total += sum(len(v) for v in columns.values())
+            nskipped += info["nskipped"]
+            nchunks += info["nchunks"]
+    return total, nskipped, nchunks
+
+def best_time(f, repeat):
+    best = np.inf
+    for i in range(repeat):
+        tstart = time.time()
+        result = f()
+        best = min(best, time.time()-tstart)
+    return best, result
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    filename = args.filename
+    if filename is None:
+        filename = "benchmark_columnar_temp.hdf5"
+        print("writing %s with %d channels of %d records"%(filename, args.nchannels, args.nrecords))
+        write_synthetic(filename, args.nchannels, args.nrecords)
+    colfilename = filename+".columnar"
+    tstart = time.time()
+    columnar.export_columnar(filename, colfilename, args.chunksize, args.compression)
+    print("export: %0.2f s, %0.1f MB -> %0.1f MB"%(time.time()-tstart, os.path.getsize(filename)/1e6, os.path.getsize(colfilename)/1e6))
+
+    with h5py.File(filename, "r") as h5:
+        tmax = max(g["timestamp"][-1] for g in h5.values())
+    queries = [("cuts", cuts),
+        ("cuts and last 10% of timestamps", CutSet(dict(pretrig_rms=(None, 30.0), postpeak_deriv=(None, 20.0), timestamp=(0.9*tmax, None))))]
+    for (name, where) in queries:
+        t_hdf5, n_hdf5 = best_time(lambda: query_hdf5(filename, where), args.repeat)
+        t_col, (n_col, nskipped, nchunks) = best_time(lambda: query_columnar(colfilename, where), args.repeat)
+        print("%s: hdf5 %0.3f s, columnar %0.3f s (%d of %d chunks skipped), speedup %0.1fx%s"%(
+            name, t_hdf5, t_col, nskipped, nchunks, t_hdf5/t_col, "" if n_hdf5 == n_col else ", RESULTS DIFFER"))
+    os.remove(colfilename)
+    if args.filename is None:
+        os.remove(filename)
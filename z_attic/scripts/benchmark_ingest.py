@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Measure records/s through the listener receive path, comparing the old one record at a time
+# path from zmq_listener_py34.py with zmq_ingest.BatchIngest. Messages are published over an
+# inproc zmq socket, so this measures decode, cut and calibrate cost rather than the network.
+import time
+import argparse
+import numpy as np
+import zmq
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from zmq_ingest import BatchIngest
+from cuts import CutSet
+
+parser = argparse.ArgumentParser(description='Benchmark the zmq listener receive path, reports records/s.')
+parser.add_argument('--nchannels', help="number of channels to publish", default=240, type=int)
+parser.add_argument('--nrecords', help="total number of records to publish", default=200000, type=int)
+parser.add_argument('--capacity', help="capacity of the BatchIngest ring buffer", default=65536, type=int)
+
+
+def make_info(channels):
+    # a stand in for mass.EnergyCalibration, which interpolates a spline and accepts arrays
+    knots_x = np.linspace(0,10000,100)
+    knots_y = 1.5*knots_x+1e-5*knots_x**2
+    cal = lambda x: np.interp(x, knots_x, knots_y)
+    cuts = CutSet({"pretrigger_rms":(0,20.0), "postpeak_deriv":(0,20.0)})
+    return {ch:(cuts,cal) for ch in channels}
+
+def make_legacy_info(channels):
+    # the (pt, md, cal) tuples the listeners used before cuts.CutSet
+    return {ch:((0,20.0),(0,20.0),cal) for (ch, (cuts, cal)) in make_info(channels).items()}
+
+def make_messages(nchannels, nrecords):
+    rng = np.random.RandomState(0)
+    records = np.zeros(nrecords, dtype_MassCompatibleDataProductFeb2017)
+    records["filt_value"] = rng.uniform(2000,7000,nrecords)
+    records["pretrig_rms"] = rng.uniform(0,20,nrecords)
+    records["postpeak_deriv"] = rng.uniform(0,20,nrecords)
+    records["rowcount"] = np.arange(nrecords)
+    channels = 2*rng.randint(0,nchannels,nrecords)+1
+    # one record per message, 56 bytes like Pope's, the dtype has Julia's trailing padding
+    return [(str(ch).encode(), records[i:i+1].tobytes()) for (i,ch) in enumerate(channels)]
+
+def publish(pub, messages):
+    for m in messages:
+        pub.send_multipart(m)
+
+def legacy_get_counts(socket, info):
+    # the per record path, as it was in zmq_listener_py34.py
+    energies = []
+    while True:
+        try:
+            m = socket.recv_multipart(flags=zmq.NOBLOCK)
+            if m[0].startswith(b"header"): continue
+            ch = int(m[0])
+            payload = np.frombuffer(m[1],dtype_MassCompatibleDataProductFeb2017,1)[0]
+            info_ch = info.get(ch, None)
+            if info_ch is None: continue
+            pt_lo,pt_hi = info_ch[0]
+            md_lo,md_hi = info_ch[1]
+            v=payload["filt_value"]
+            if not (pt_lo<v<pt_hi and md_lo<v<md_hi):
+                energies.append(info_ch[2](v))
+        except zmq.ZMQError:
+            break
+    return energies
+
+def run(name, ctx, messages, get_counts):
+    addr = "inproc://benchmark_ingest_%s"%name
+    pub = ctx.socket(zmq.PUB)
+    pub.set_hwm(0) # unlimited, so nothing is dropped while we publish everything up front
+    pub.bind(addr)
+    sub = ctx.socket(zmq.SUB)
+    sub.set_hwm(0)
+    sub.connect(addr)
+    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    time.sleep(0.2) # let the subscription propagate
+    publish(pub, messages)
+    t0 = time.time()
+    n = get_counts(sub)
+    elapsed = time.time()-t0
+    pub.close()
+    sub.close()
+    print("%s: %d records in %0.3f s, %0.0f records/s, %d energies"%(name, len(messages), elapsed, len(messages)/elapsed, n))
+    return len(messages)/elapsed
+
+if __name__ == "__main__":
+    args = vars(parser.parse_args())
+    channels = 2*np.arange(args["nchannels"])+1
+    info = make_info(channels)
+    legacy_info = make_legacy_info(channels)
+    messages = make_messages(args["nchannels"], args["nrecords"])
+    ctx = zmq.Context()
+    rate_legacy = run("legacy", ctx, messages, lambda sub: len(legacy_get_counts(sub, legacy_info)))
+    rate_batch = run("batch", ctx, messages,
+        lambda sub: len(BatchIngest(sub, info, capacity=args["capacity"]).get_energies()))
+    print("speedup %0.1fx"%(rate_batch/rate_legacy))
+    ctx.term()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Time ljh3.LJH3File on a synthetic LJH3 file: the first open, which walks the file and writes the offsets
+# sidecar, a second open, which reads the sidecar, random access to single records, and reading the whole
+# file in byte balanced ranges with a pool of processes.
+import os
+import time
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import ljh3
+
+parser = argparse.ArgumentParser(description='Benchmark opening and reading LJH3 files with an offsets sidecar.')
+parser.add_argument('--nrecords', help="records in the synthetic file", default=200000, type=int)
+parser.add_argument('--nsamples', help="samples in most records", default=500, type=int)
+parser.add_argument('--fraction_other', help="fraction of records with a random other length", default=0.02, type=float)
+parser.add_argument('--nrandom', help="records to read in random order", default=10000, type=int)
+parser.add_argument('--workers', help="processes for the range reads", default=4, type=int)
+
+
+def write_synthetic(filename, nrecords, nsamples, fraction_other):
+    rng = np.random.RandomState(0)
+    with ljh3.LJH3Writer(filename, 9.6e-6, {"channel":1}) as w:
+        for i in range(nrecords):
+            n = nsamples if rng.rand() >= fraction_other else rng.randint(1, 4*nsamples)
+            w.write(rng.randint(0, 2**16, n), 0, 100*i, 1000*i)
+
+
+def sum_range(job):
+    filename, first, end = job
+    with ljh3.LJH3File(filename) as f:
+        headers, samples = f.read_range(first, end)
+        return sum(int(s.sum(dtype=np.int64)) for s in samples)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    filename = "benchmark_ljh3_temp.ljh3"
+    write_synthetic(filename, args.nrecords, args.nsamples, args.fraction_other)
+    print("%d records, %0.1f MB"%(args.nrecords, os.path.getsize(filename)/1e6))
+    tstart = time.time()
+    f = ljh3.LJH3File(filename)
+    print("first open, walking the file: %7.1f ms"%(1e3*(time.time()-tstart)))
+    tstart = time.time()
+    f = ljh3.LJH3File(filename)
+    print("open with the sidecar:        %7.1f ms, len %d"%(1e3*(time.time()-tstart), len(f)))
+    order = np.random.RandomState(1).randint(0, len(f), args.nrandom)
+    tstart = time.time()
+    for i in order:
+        f[i]
+    print("random record reads:          %7.1f us per record"%(1e6*(time.time()-tstart)/args.nrandom))
+    tstart = time.time()
+    serial = sum_range((filename, 0, len(f)))
+    print("read all in one range:        %7.1f ms"%(1e3*(time.time()-tstart)))
+    tstart = time.time()
+    pool = Pool(args.workers)
+    parallel = sum(pool.map(sum_range, [(filename, a, b) for (a, b) in f.split(args.workers)]))
+    pool.close()
+    print("read all in %d ranges:         %7.1f ms%s"%(args.workers, 1e3*(time.time()-tstart), "" if parallel == serial else ", SUMS DIFFER"))
+    f.close()
+    for fname in [filename, ljh3.offsets_filename(filename)]:
+        os.remove(fname)
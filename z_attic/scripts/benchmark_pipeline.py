@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# End to end benchmark of the python consumer side. A stand in for Pope runs in a second process and
+# publishes one MassCompatibleDataProductFeb2017 record per message, with exponentially distributed
+# times between records like benchmark.jl, on `--nchannels` channels at `--cps` counts per second per
+# channel for `--runtime_s` seconds. This process receives them the way the live listeners do, with
+# BatchIngest.get_channel_energies and a histogram.Spectra, and BatchIngest's PipelineMetrics times each
+# stage of every batch. Each record carries its publish time in `timestamp`, so we also get the latency
+# from publish to histogram.
+# Results are printed and written as json to `--output` so runs can be compared.
+import sys
+import time
+import json
+import socket
+import resource
+import argparse
+import multiprocessing
+import numpy as np
+import zmq
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from zmq_ingest import BatchIngest
+from histogram import Spectra
+from cuts import CutSet
+from metrics import PipelineMetrics
+
+parser = argparse.ArgumentParser(description='End to end throughput and latency benchmark of the zmq listener ingest, cut, calibrate and histogram path.')
+parser.add_argument('--nchannels', help="number of channels to publish", default=240, type=int)
+parser.add_argument('--cps', help="average counts per second per channel", default=100, type=float)
+parser.add_argument('--runtime_s', help="publish for roughly this long, in seconds", default=30, type=float)
+parser.add_argument('--address', help="zmq address to publish on", default="tcp://127.0.0.1:2016")
+parser.add_argument('--hwm', help="send and receive high water mark, messages beyond it are dropped", default=10000, type=int)
+parser.add_argument('--capacity', help="capacity of the BatchIngest ring buffer", default=65536, type=int)
+parser.add_argument('--output', help="json file to write results to", default="benchmark_pipeline.json")
+
+STAGES = ["decode", "cut", "calibrate", "histogram"]
+PERCENTILES = [50, 90, 99, 100]
+
+
+class TimestampCuts():
+    """
+    TimestampCuts(cuts)
+    Applies the `cuts.CutSet` `cuts` and keeps the `timestamp` of every record that passes, so the latency of
+    the records BatchIngest histograms can be measured without reaching into its ring.
+    """
+    def __init__(self, cuts):
+        self.cuts = cuts
+        self.timestamps = []
+
+    def cut_mask(self, records):
+        cut = self.cuts.cut_mask(records)
+        self.timestamps.append(records["timestamp"][~cut])
+        return cut
+
+    def cut_mask_counts(self, records):
+        cut, counts = self.cuts.cut_mask_counts(records)
+        self.timestamps.append(records["timestamp"][~cut])
+        return cut, counts
+
+    def take_timestamps(self):
+        out, self.timestamps = self.timestamps, []
+        return np.hstack(out) if out else np.zeros(0)
+
+def make_info(channels, cuts):
+    # a stand in for the listeners' CalibrationTable, an np.interp over a table of knots
+    knots_x = np.linspace(0,10000,4096)
+    knots_y = 1.5*knots_x+1e-5*knots_x**2
+    cal = lambda x: np.interp(x, knots_x, knots_y)
+    return {ch:(cuts,cal) for ch in channels}
+
+def publisher(address, nchannels, cps, runtime_s, hwm, nsent, done, tick_s=0.01):
+    ctx = zmq.Context()
+    pub = ctx.socket(zmq.PUB)
+    pub.set_hwm(hwm)
+    pub.bind(address)
+    time.sleep(0.5) # let the subscriber connect
+    rng = np.random.RandomState(0)
+    channels = 2*np.arange(nchannels)+1
+    rate = nchannels*cps
+    records = np.zeros(int(rate*tick_s*4)+64, dtype_MassCompatibleDataProductFeb2017)
+    tstart = time.time()
+    tnext = tstart
+    rowcount = 0
+    n = 0
+    while tnext-tstart < runtime_s:
+        # the records due in this tick, exponential spacing means a poisson count
+        k = min(rng.poisson(rate*tick_s), len(records))
+        recs = records[:k]
+        recs["filt_value"] = rng.uniform(2000,7000,k)
+        recs["pretrig_rms"] = rng.exponential(8,k)
+        recs["postpeak_deriv"] = rng.exponential(8,k)
+        recs["rowcount"] = rowcount+np.arange(k)
+        rowcount += k
+        chans = channels[rng.randint(0,nchannels,k)]
+        for i in range(k):
+            recs["timestamp"][i] = time.time()
+            # one record per message, 56 bytes like Pope's, the dtype has Julia's trailing padding
+            pub.send_multipart([str(chans[i]).encode(), recs[i:i+1].tobytes()])
+        n += k
+        nsent.value = n
+        tnext += tick_s
+        delay = tnext-time.time()
+        if delay > 0:
+            time.sleep(delay)
+    nsent.value = n
+    done.set()
+    time.sleep(0.5)
+    pub.close()
+    ctx.term()
+
+def consume(ingest, spectra, cuts, done, idle_s=1.0, poll_ms=100):
+    """
+    Receive and process with `ingest.get_channel_energies()` until `done` is set and nothing has arrived for
+    `idle_s`, adding the histogram times to `ingest.metrics`. `cuts` is the `TimestampCuts` in `ingest.info`.
+    Returns `(latencies, active_s)`, an array of publish to histogram seconds per used record, and the time
+    from the first to the last batch.
+    """
+    latencies = []
+    poller = zmq.Poller()
+    poller.register(ingest.socket, zmq.POLLIN)
+    tlast = time.time()
+    tfirst = None
+    while True:
+        if not poller.poll(poll_ms):
+            if done.is_set() and time.time()-tlast > idle_s:
+                break
+            continue
+        tlast = time.time()
+        if tfirst is None:
+            tfirst = tlast
+        channel_energies = ingest.get_channel_energies()
+        t0 = time.time()
+        for (ch, energies) in channel_energies:
+            spectra.add(ch, energies, t=t0)
+        t1 = time.time()
+        ingest.metrics.add_batch(dict(histogram=t1-t0), [], [], [], {})
+        latencies.append(t1-cuts.take_timestamps())
+    latencies = np.hstack(latencies) if latencies else np.zeros(0)
+    return latencies, (tlast-tfirst if tfirst is not None else 0.0)
+
+def percentiles_us(x):
+    if len(x) == 0:
+        return {"p%d"%p:None for p in PERCENTILES}
+    return {"p%d"%p:float(v) for (p, v) in zip(PERCENTILES, np.percentile(np.asarray(x)*1e6, PERCENTILES))}
+
+if __name__ == "__main__":
+    args = vars(parser.parse_args())
+    channels = 2*np.arange(args["nchannels"])+1
+    cuts = TimestampCuts(CutSet({"pretrigger_rms":(0,20.0), "postpeak_deriv":(0,20.0)}))
+    info = make_info(channels, cuts)
+    spectra = Spectra.from_edges(np.arange(4000,10000,1.0), window_s=10)
+    nsent = multiprocessing.Value("l", 0)
+    done = multiprocessing.Event()
+    ctx = zmq.Context()
+    sub = ctx.socket(zmq.SUB)
+    sub.set_hwm(args["hwm"])
+    sub.connect(args["address"])
+    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    # enough recent durations that the stage percentiles cover every batch of a normal run
+    ingest = BatchIngest(sub, info, capacity=args["capacity"], metrics=PipelineMetrics(nrecent=65536))
+    proc = multiprocessing.Process(target=publisher, args=(args["address"], args["nchannels"], args["cps"],
+        args["runtime_s"], args["hwm"], nsent, done))
+    print("publishing %d channels at %g cps each for %g s"%(args["nchannels"], args["cps"], args["runtime_s"]))
+    proc.start()
+    latencies, active_s = consume(ingest, spectra, cuts, done)
+    stages = ingest.metrics.snapshot()["stages"]
+    proc.join()
+    sub.close()
+    ctx.term()
+
+    results = dict(
+        args=args,
+        host=socket.gethostname(),
+        date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        versions=dict(python=sys.version.split()[0], numpy=np.__version__, pyzmq=zmq.__version__),
+        active_s=active_s,
+        nsent=nsent.value,
+        nreceived=ingest.nrecords,
+        ndropped=nsent.value-ingest.nrecords,
+        nused=ingest.nused,
+        records_per_s=ingest.nrecords/active_s if active_s > 0 else 0.0,
+        # how fast this process could go if it never waited for messages
+        busy_s=float(sum(stages[stage]["total_s"] for stage in STAGES)),
+        nbatches=stages["decode"]["count"],
+        nbad=ingest.nbad,
+        stage_us={stage:{k:stages[stage][k] for k in ["p50_us", "p99_us", "max_us"]} for stage in STAGES},
+        stage_total_s={stage:float(stages[stage]["total_s"]) for stage in STAGES},
+        latency_us=percentiles_us(latencies),
+        maxrss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, # kilobytes on linux
+    )
+    print("sent %d, received %d, dropped %d, used %d, bad %d"%(results["nsent"], results["nreceived"], results["ndropped"], results["nused"], results["nbad"]))
+    print("%0.0f records/s sustained over %0.1f s in %d batches, busy %0.1f%% of the time, so capacity about %0.0f records/s"%(
+        results["records_per_s"], active_s, results["nbatches"], 100*results["busy_s"]/max(active_s, 1e-9),
+        results["nreceived"]/max(results["busy_s"], 1e-9)))
+    for stage in STAGES:
+        p = results["stage_us"][stage]
+        print("%-10s per batch us: p50 %0.0f p99 %0.0f max %0.0f, total %0.3f s"%(stage, p["p50_us"], p["p99_us"], p["max_us"],
+            results["stage_total_s"][stage]))
+    p = results["latency_us"]
+    if p["p50"] is not None:
+        print("publish to histogram latency us: p50 %0.0f p90 %0.0f p99 %0.0f max %0.0f"%(p["p50"], p["p90"], p["p99"], p["p100"]))
+    print("peak RSS %0.1f MB"%results["maxrss_mb"])
+    with open(args["output"], "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("wrote %s"%args["output"])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Compare peak memory and time for histogramming cut, calibrated filt_value from a Pope hdf5 file,
+# loading every field of a channel at once (which is what opening with mass.TESGroupHDF5 and running
+# apply_cuts does) against streaming it in chunks with pope_hdf5.stream_spectra. Each mode runs in
+# its own process so its peak RSS can be measured on its own. Writes a synthetic file in the Pope
+# layout unless one is given.
+import os
+import sys
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+import h5py
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from cuts import CutSet
+from histogram import Spectra
+import pope_hdf5
+
+parser = argparse.ArgumentParser(description='Benchmark peak RSS and time of eager vs streaming reads of Pope hdf5 output.')
+parser.add_argument('--filename', help="Pope hdf5 file to read, default write a synthetic one", default=None)
+parser.add_argument('--nchannels', help="channels in the synthetic file", default=16, type=int)
+parser.add_argument('--nrecords', help="records per channel in the synthetic file", default=2000000, type=int)
+parser.add_argument('--chunksize', help="records per chunk when streaming", default=2**16, type=int)
+parser.add_argument('--mode', help="run only this mode in this process and print its result, used internally", default=None, choices=["eager", "lazy"])
+
+bin_edges = np.arange(0, 20000, 2.0)
+
+
+def write_synthetic(filename, nchannels, nrecords, chunksize=1000):
+    # same layout as make_buffered_hdf5_writer in buffered_hdf5_dataset.jl, with chunked 1d datasets
+    rng = np.random.RandomState(0)
+    with h5py.File(filename, "w") as h5:
+        h5.attrs["nsamples"] = 520
+        h5.attrs["npresamples"] = 200
+        h5.attrs["frametime"] = 9.6e-6
+        for i in range(nchannels):
+            g = h5.create_group("chan%d"%(2*i+1))
+            for name in dtype_MassCompatibleDataProductFeb2017.names:
+                g.create_dataset(name, shape=(nrecords,), dtype=dtype_MassCompatibleDataProductFeb2017[name], chunks=(chunksize,))
+            for first in range(0, nrecords, 2**20):
+                n = min(2**20, nrecords-first)
+                g["filt_value"][first:first+n] = rng.uniform(0, 20000, n)
+                g["pretrig_rms"][first:first+n] = rng.exponential(10, n)
+                g["postpeak_deriv"][first:first+n] = rng.exponential(10, n)
+                g["timestamp"][first:first+n] = first+np.arange(n)
+            g.create_group("calculated_cuts")
+            g["calculated_cuts"]["pretrig_rms"] = np.array([0.0, 30.0])
+            g["calculated_cuts"]["postpeak_deriv"] = np.array([0.0, 20.0])
+
+def run_eager(filename):
+    spectra = Spectra.from_edges(bin_edges)
+    with h5py.File(filename, "r") as h5:
+        for (name, g) in h5.items():
+            ch = int(name[4:])
+            columns = {field:g[field][:] for field in dtype_MassCompatibleDataProductFeb2017.names}
+            records = np.zeros(len(columns["filt_value"]), dtype_MassCompatibleDataProductFeb2017)
+            for (field, v) in columns.items():
+                records[field] = v
+            good = CutSet.from_channel_group(g).good(records)
+            spectra.add(ch, records["filt_value"][good], t=0)
+    return spectra
+
+def run_lazy(filename, chunksize):
+    spectra, summary = pope_hdf5.stream_spectra(filename, bin_edges, chunksize=chunksize)
+    return spectra
+
+def run_mode(mode, filename, chunksize):
+    tstart = time.time()
+    if mode == "eager":
+        spectra = run_eager(filename)
+    else:
+        spectra = run_lazy(filename, chunksize)
+    elapsed = time.time()-tstart
+    maxrss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0 # kilobytes on linux
+    print("%s %0.3f %0.1f %d"%(mode, elapsed, maxrss_mb, spectra.counts.sum()))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.mode is not None:
+        run_mode(args.mode, args.filename, args.chunksize)
+        sys.exit()
+    filename = args.filename
+    if filename is None:
+        filename = "benchmark_pope_hdf5_temp.hdf5"
+        print("writing %s with %d channels of %d records"%(filename, args.nchannels, args.nrecords))
+        write_synthetic(filename, args.nchannels, args.nrecords)
+    results = {}
+    for mode in ["eager", "lazy"]:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--mode", mode,
+            "--filename", filename, "--chunksize", str(args.chunksize)]).decode()
+        _mode, elapsed, maxrss_mb, ncounts = out.split()[-4:]
+        results[mode] = (float(elapsed), float(maxrss_mb), int(ncounts))
+        print("%s: %0.2f s, peak RSS %0.1f MB, %d counts"%(mode, float(elapsed), float(maxrss_mb), int(ncounts)))
+    if results["eager"][2] != results["lazy"][2]:
+        print("WARNING: eager and lazy histograms differ")
+    if args.filename is None:
+        os.remove(filename)
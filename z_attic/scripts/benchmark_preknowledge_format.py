@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Compare the grouped preknowledge layout Pope reads against the packed layout of
+# preknowledge_format.py: time to write, file size, and time to open and read every channel, one
+# channel, and every channel's cuts (what the live listeners load). Uses synthetic preknowledge with
+# the same paths, types and array lengths as write_preknowledge_data, unless a file is given, in which
+# case it is converted to both layouts.
+import os
+import time
+import argparse
+import numpy as np
+import preknowledge_format
+from preknowledge_format import PreknowledgeFile, write_grouped, write_packed
+from cuts import load_cuts
+
+parser = argparse.ArgumentParser(description='Benchmark writing and reading grouped and packed preknowledge files.')
+parser.add_argument('--filename', help="preknowledge file to convert and read, default synthetic", default=None)
+parser.add_argument('--nchannels', help="channels in the synthetic preknowledge", default=240, type=int)
+parser.add_argument('--nsamples', help="samples per record in the synthetic preknowledge", default=520, type=int)
+parser.add_argument('--compression', help="h5py compression for the packed stacked datasets, none for no compression", default="gzip")
+parser.add_argument('--repeat', help="repeat each measurement this many times and report the best", default=5, type=int)
+
+
+def synthetic(nchannels, nsamples):
+    rng = np.random.RandomState(0)
+    t = np.arange(nsamples)
+    channel_values = {}
+    for i in range(nchannels):
+        pulse = np.where(t < nsamples//4, 0.0, np.exp(-(t-nsamples//4)/80.0)-np.exp(-(t-nsamples//4)/5.0))*rng.uniform(5000, 9000)
+        channel_values[2*i+1] = {
+            "physical/frametime":9.6e-6, "physical/number_of_rows":30, "physical/number_of_columns":8,
+            "trigger/nsamples":nsamples, "trigger/npresamples":nsamples//4,
+            "filter/data_file_used_to_generate_filters":"/data/20170913/20170913_B/20170913_B_chan%d.ljh"%(2*i+1),
+            "filter/values":rng.normal(0, 1e-3, nsamples-2), "filter/values_at":rng.normal(0, 1e-3, nsamples-2),
+            "filter/f3db":20000.0, "filter/average_pulse":pulse, "filter/description":"noconst",
+            "filter/shift_threshold":int(rng.randint(10, 30)), "summarize/peak_index":nsamples//4+12,
+            "cuts/pretrigger_rms":np.array([0.0, rng.uniform(8, 12)]), "cuts/postpeak_deriv":np.array([-np.inf, rng.uniform(15, 25)]),
+            "analysis_type":"mass compatible feb 2017",
+        }
+    return channel_values
+
+def best_time(f, repeat):
+    best = np.inf
+    for i in range(repeat):
+        tstart = time.time()
+        result = f()
+        best = min(best, time.time()-tstart)
+    return best, result
+
+def read_all(filename):
+    with PreknowledgeFile(filename) as pk:
+        return pk.read_all()
+
+def read_one(filename):
+    with PreknowledgeFile(filename) as pk:
+        return pk.channel(pk.channels[len(pk.channels)//2])
+
+def same(a, b):
+    if set(a.keys()) != set(b.keys()):
+        return False
+    for ch in a:
+        for (p, v) in a[ch].items():
+            if not np.array_equal(np.asarray(v), np.asarray(b[ch][p])):
+                return False
+    return True
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    compression = None if args.compression == "none" else args.compression
+    if args.filename is None:
+        channel_values = synthetic(args.nchannels, args.nsamples)
+    else:
+        channel_values = read_all(args.filename)
+    files = {"grouped":"benchmark_pk_grouped_temp.hdf5", "packed":"benchmark_pk_packed_temp.hdf5"}
+    writers = {"grouped":lambda: write_grouped(files["grouped"], channel_values),
+        "packed":lambda: write_packed(files["packed"], channel_values, compression)}
+    print("%d channels, packed compression %s"%(len(channel_values), compression))
+    results = {}
+    for layout in ["grouped", "packed"]:
+        t_write, _ = best_time(writers[layout], args.repeat)
+        t_all, values = best_time(lambda: read_all(files[layout]), args.repeat)
+        t_one, _ = best_time(lambda: read_one(files[layout]), args.repeat)
+        t_cuts, _ = best_time(lambda: load_cuts(files[layout]), args.repeat)
+        results[layout] = (t_write, t_all, t_one, t_cuts)
+        print("%-7s: %7.1f kB, write %7.1f ms, open and read all %7.1f ms, one channel %6.1f ms, all cuts %7.1f ms%s"%(
+            layout, os.path.getsize(files[layout])/1e3, 1e3*t_write, 1e3*t_all, 1e3*t_one, 1e3*t_cuts,
+            "" if same(values, channel_values) else ", VALUES DIFFER"))
+    print("packed speedup: write %0.1fx, read all %0.1fx, one channel %0.1fx, all cuts %0.1fx"%tuple(
+        g/p for (g, p) in zip(results["grouped"], results["packed"])))
+    for filename in files.values():
+        os.remove(filename)
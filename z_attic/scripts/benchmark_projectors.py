@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Time computing projectors for a whole array with projectors.compute_projectors, with each noise factor
+# kind, the first time (the noise factors are computed) and after a basis change (they come from the
+# cache), against a dense solve per channel like computeprojectors in projections.jl. Channels get AR(1)
+# like noise with different correlation and smooth random bases. Differences are relative to the largest
+# element of the dense projectors.
+import time
+import argparse
+import numpy as np
+import scipy.linalg
+from projectors import compute_projectors, NoiseFactorCache, FACTOR_KINDS
+
+parser = argparse.ArgumentParser(description='Benchmark batched projectors with cached noise factors against dense per channel solves.')
+parser.add_argument('--nchannels', help="channels in the array", default=240, type=int)
+parser.add_argument('--nsamples', help="samples per record, the length of the basis vectors", default=1000, type=int)
+parser.add_argument('--nbasis', help="basis vectors per channel", default=6, type=int)
+
+
+def synthetic(nchannels, nsamples, nbasis, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(nsamples)/float(nsamples)
+    autocorrs, bases = {}, {}
+    for ch in range(1, 2*nchannels, 2):
+        phi = rng.uniform(0.3, 0.9)
+        autocorrs[ch] = 100.0*phi**np.arange(nsamples)+np.where(np.arange(nsamples) == 0, 1.0, 0.0)
+        bases[ch] = np.column_stack([np.ones(nsamples)]+[np.cos(np.pi*(k+rng.uniform(0, 1))*t) for k in range(1, nbasis)])
+    return bases, autocorrs
+
+
+def dense_projectors(basis, autocorr):
+    R = scipy.linalg.toeplitz(autocorr[:len(basis)])
+    rinvb = np.linalg.solve(R, basis)
+    a = basis.T.dot(rinvb)
+    return np.linalg.solve(a, rinvb.T), np.linalg.inv(a)
+
+
+def max_difference(computed, reference):
+    return max(np.abs(computed[ch][0]-reference[ch][0]).max()/np.abs(reference[ch][0]).max() for ch in reference)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    bases, autocorrs = synthetic(args.nchannels, args.nsamples, args.nbasis)
+    print("%d channels, %d samples, %d basis vectors"%(args.nchannels, args.nsamples, args.nbasis))
+    tstart = time.time()
+    reference = {ch:dense_projectors(bases[ch], autocorrs[ch]) for ch in bases}
+    print("dense solve per channel:            %7.2f s"%(time.time()-tstart))
+    # a basis change, every channel's basis scaled and with its last vector replaced
+    changed = {ch:np.column_stack([2*b[:,:-1], b[:,-1]**2]) for (ch, b) in bases.items()}
+    reference_changed = {ch:dense_projectors(changed[ch], autocorrs[ch]) for ch in changed}
+    for kind in FACTOR_KINDS:
+        cache = NoiseFactorCache(kind)
+        tstart = time.time()
+        computed = compute_projectors(bases, autocorrs, cache)
+        t_first = time.time()-tstart
+        tstart = time.time()
+        computed_changed = compute_projectors(changed, autocorrs, cache)
+        t_change = time.time()-tstart
+        print("%-9s first %6.2f s, after a basis change %6.2f s, difference from dense %0.1e and %0.1e, cache hits %d"%(
+            kind, t_first, t_change, max_difference(computed, reference), max_difference(computed_changed, reference_changed),
+            cache.hits))
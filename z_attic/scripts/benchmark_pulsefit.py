@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Compare fitting the two exponential pulse shape one channel at a time with curve_fit, as
+# quality_check.py used to, against pulsefit.two_exp_fit_batch fitting every channel at once.
+# Pulses are synthetic with known time constants, so this also reports how well each recovers them.
+import time
+import argparse
+import numpy as np
+from pulsefit import two_exp_curve, two_exp_fit_pulse, two_exp_fit_batch
+
+parser = argparse.ArgumentParser(description='Benchmark two exponential average pulse fits, per channel loop vs batch.')
+parser.add_argument('--nchannels', help="number of channels", default=240, type=int)
+parser.add_argument('--nsamples', help="samples per pulse", default=520, type=int)
+parser.add_argument('--npresamples', help="pretrigger samples per pulse", default=100, type=int)
+parser.add_argument('--noise', help="rms noise relative to the pulse height", default=1e-3, type=float)
+
+
+def make_pulses(nchannels, nsamples, npresamples, noise):
+    rng = np.random.RandomState(0)
+    tau1 = rng.uniform(2,20,nchannels)
+    tau2 = rng.uniform(30,300,nchannels)
+    t = np.arange(nsamples-npresamples-1, dtype=np.float64)
+    pulses = np.zeros((nsamples, nchannels))
+    pulses[npresamples+1:] = two_exp_curve(t[:,np.newaxis], 1.0, tau1, tau2)
+    pulses /= pulses.max(axis=0)
+    pulses += rng.normal(0, noise, pulses.shape)
+    return pulses, tau1, tau2
+
+def fit_loop(pulses, npresamples):
+    tau1 = np.full(pulses.shape[1], np.nan)
+    tau2 = np.full(pulses.shape[1], np.nan)
+    for i in range(pulses.shape[1]):
+        try:
+            popt, sigma, ydata = two_exp_fit_pulse(pulses[:,i], npresamples)
+        except (RuntimeError, ValueError):
+            continue
+        tau1[i], tau2[i] = min(popt[1], popt[2]), max(popt[1], popt[2])
+    return tau1, tau2
+
+def report(name, elapsed, tau1, tau2, true_tau1, true_tau2):
+    ok = np.isfinite(tau1) & np.isfinite(tau2)
+    err1 = np.amax(np.abs(tau1[ok]/true_tau1[ok]-1)) if ok.any() else np.nan
+    err2 = np.amax(np.abs(tau2[ok]/true_tau2[ok]-1)) if ok.any() else np.nan
+    print("%s: %0.3f s, %d/%d fits ok, max relative error tau1 %0.2g tau2 %0.2g"%(name, elapsed, ok.sum(), len(ok), err1, err2))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    pulses, true_tau1, true_tau2 = make_pulses(args.nchannels, args.nsamples, args.npresamples, args.noise)
+
+    tstart = time.time()
+    tau1, tau2 = fit_loop(pulses, args.npresamples)
+    elapsed_loop = time.time()-tstart
+    report("curve_fit loop", elapsed_loop, tau1, tau2, true_tau1, true_tau2)
+
+    tstart = time.time()
+    fit = two_exp_fit_batch(pulses, args.npresamples)
+    elapsed_batch = time.time()-tstart
+    conv = fit["converged"]
+    report("batch", elapsed_batch, np.where(conv, fit["tau1"], np.nan), np.where(conv, fit["tau2"], np.nan), true_tau1, true_tau2)
+    print("speedup: %0.1fx"%(elapsed_loop/elapsed_batch))
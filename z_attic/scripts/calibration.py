@@ -0,0 +1,96 @@
+# Per-channel calibration lookup tables for the live spectrum listeners. Calling a
+# mass.EnergyCalibration means a spline evaluation behind python dispatch, so instead we
+# evaluate each channel's calibration once on a dense grid of filt_value, and calibrate
+# every batch with a single np.interp per channel.
+
+import numpy as np
+import h5py
+
+
+class CalibrationTable():
+    """
+    CalibrationTable(cal, lo, hi, npoints=4096)
+    A monotone interpolation table for `cal` (anything that maps an array of filt_value to an
+    array of energy, like `mass.EnergyCalibration`) over the filt_value range `[lo, hi]`.
+    Calling the table interpolates linearly between `npoints` knots; values outside `[lo, hi]`
+    fall back to `cal` itself so they are still correct, just slower.
+    `max_error()` reports the largest difference from `cal` (in energy units, usually eV).
+    """
+    def __init__(self, cal, lo, hi, npoints=4096):
+        if not hi > lo:
+            raise ValueError("need hi > lo, got lo=%g, hi=%g"%(lo, hi))
+        self.cal = cal
+        self.lo = float(lo)
+        self.hi = float(hi)
+        self.x = np.linspace(self.lo, self.hi, npoints)
+        self.y = np.asarray(cal(self.x), dtype=np.float64)
+        if not np.all(np.diff(self.y) > 0):
+            raise ValueError("calibration is not monotonically increasing over filt_value %g to %g"%(lo, hi))
+
+    @classmethod
+    def from_energy_range(cls, cal, energy_lo, energy_hi, max_error=0.01, margin=0.05, npoints=256, maxpoints=2**20):
+        """
+        Build a table for `cal` covering energies `energy_lo` to `energy_hi` widened by `margin` (a fraction of
+        the range) on both sides, using `cal.energy2ph` to find the filt_value range. Starting from `npoints`,
+        double the number of knots until `max_error()` is at most `max_error`.
+        """
+        de = margin*(energy_hi-energy_lo)
+        lo = max(0.0, float(cal.energy2ph(max(0.0, energy_lo-de))))
+        hi = float(cal.energy2ph(energy_hi+de))
+        return cls.with_max_error(cal, lo, hi, max_error, npoints, maxpoints)
+
+    @classmethod
+    def with_max_error(cls, cal, lo, hi, max_error=0.01, npoints=256, maxpoints=2**20):
+        """Build a table over `[lo, hi]`, doubling the knots from `npoints` until `max_error()` is at most `max_error`."""
+        while True:
+            table = cls(cal, lo, hi, npoints)
+            if table.max_error() <= max_error:
+                return table
+            if 2*npoints > maxpoints:
+                raise ValueError("could not reach max_error=%g with %d points, got %g"%(max_error, npoints, table.max_error()))
+            npoints *= 2
+
+    @property
+    def npoints(self):
+        return len(self.x)
+
+    def __call__(self, filt_value):
+        filt_value = np.asarray(filt_value, dtype=np.float64)
+        energy = np.interp(filt_value, self.x, self.y)
+        outside = (filt_value < self.lo)|(filt_value > self.hi)
+        if np.any(outside):
+            energy[outside] = self.cal(filt_value[outside])
+        return energy
+
+    def max_error(self, nsub=4):
+        """
+        Return the maximum absolute difference between the table and the exact calibration, checked at
+        `nsub` points inside every interval between knots (where linear interpolation error is largest).
+        """
+        frac = (np.arange(nsub)+0.5)/nsub
+        dx = self.x[1]-self.x[0]
+        probes = (self.x[:-1,np.newaxis]+dx*frac[np.newaxis,:]).ravel()
+        exact = np.asarray(self.cal(probes), dtype=np.float64)
+        return float(np.amax(np.abs(np.interp(probes, self.x, self.y)-exact)))
+
+
+class CalFile():
+    def __init__(self, filename, calname="p_filt_value"):
+        self.h5 = h5py.File(filename,"r")
+        self.calname = calname
+        print(self.h5)
+
+    def get_hdf5_group(self,ch):
+        return self.h5["chan"+str(ch)]["calibration"]
+
+    def get_calibration(self,ch):
+        import mass
+        hdf5_group = self.get_hdf5_group(ch)
+        return mass.EnergyCalibration.load_from_hdf5(hdf5_group,self.calname)
+
+    def get_calibration_table(self, ch, energy_lo, energy_hi, max_error=0.01):
+        """Return a `CalibrationTable` of channel `ch` covering `energy_lo` to `energy_hi` within `max_error` eV."""
+        return CalibrationTable.from_energy_range(self.get_calibration(ch), energy_lo, energy_hi, max_error)
+
+    def isbad(self,ch):
+        return "why_bad" in self.h5["chan"+str(ch)].attrs
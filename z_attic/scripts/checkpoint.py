@@ -0,0 +1,84 @@
+# Stage level checkpoints for make_preknowledge.py --resume. Each channel has a small json file
+# recording, for every stage it completed (summarize, cuts, noise_spectra, average_pulse, filter), a
+# key and the stage's small outputs (peak index, cut limits, noise autocorrelation and PSD). The big
+# outputs stay where mass puts them, in the temporary hdf5 files, which --resume keeps. A key is a
+# hash of the identity of the input files (path, size, mtime and a hash of the LJH header), the
+# stage's parameters, the keys of the stages it depends on and CHECKPOINT_VERSION, so changing an
+# input or a parameter invalidates that stage and everything downstream of it, and nothing else.
+
+import hashlib
+import json
+import os
+import ljh
+
+# bump when a stage's computation changes, so old checkpoints are not reused
+CHECKPOINT_VERSION = 1
+
+
+def file_identity(filename):
+    """Return a dict of the absolute path, size, mtime and sha1 of the LJH header of `filename`."""
+    st = os.stat(filename)
+    with open(filename, "rb") as f:
+        headerdict, datastartpos = ljh.ljh_get_header_dict(f)
+        f.seek(0)
+        header_sha1 = hashlib.sha1(f.read(datastartpos)).hexdigest()
+    return dict(path=os.path.abspath(filename), size=st.st_size, mtime=st.st_mtime, header_sha1=header_sha1)
+
+
+def stage_key(stage, filenames=(), params=None, upstream=()):
+    """
+    Return a hex digest identifying one run of `stage`: the `file_identity` of each of `filenames`, the json
+    serializable dict `params`, the keys of the `upstream` stages it used, and `CHECKPOINT_VERSION`.
+    """
+    d = dict(version=CHECKPOINT_VERSION, stage=stage, files=[file_identity(f) for f in filenames],
+        params=params or {}, upstream=list(upstream))
+    return hashlib.sha1(json.dumps(d, sort_keys=True).encode()).hexdigest()
+
+
+class ChannelCheckpoint():
+    """
+    ChannelCheckpoint(dirname, channum, resume=True, requires=())
+    The completed stages of one channel, kept in `dirname/chan<channum>.json`. With `resume` False, or if any of
+    the files in `requires` (the hdf5 files holding the stages' big outputs) is missing, previous checkpoints are
+    discarded. `get(stage, key)` returns the stage's outputs if it completed with that key, otherwise None, and
+    `put(stage, key, outputs)` records it; `put` writes the file right away, so an interrupted run keeps every
+    stage it finished. `reused` and `computed` list the stages that were looked up, for reporting.
+    """
+    def __init__(self, dirname, channum, resume=True, requires=()):
+        self.channum = channum
+        self.filename = os.path.join(dirname, "chan%d.json"%channum)
+        self.stages = {}
+        self.reused = []
+        self.computed = []
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if resume and os.path.isfile(self.filename) and all(os.path.isfile(f) for f in requires):
+            with open(self.filename) as f:
+                self.stages = json.load(f)
+        self._write()
+
+    def get(self, stage, key):
+        entry = self.stages.get(stage, None)
+        if entry is not None and entry["key"] == key:
+            self.reused.append(stage)
+            return entry["outputs"]
+        self.computed.append(stage)
+        return None
+
+    def put(self, stage, key, outputs=None):
+        self.stages[stage] = dict(key=key, outputs=outputs or {})
+        self._write()
+
+    def key(self, stage):
+        """Return the key `stage` last completed with, or None, for use as an upstream key."""
+        entry = self.stages.get(stage, None)
+        return None if entry is None else entry["key"]
+
+    def _write(self):
+        tmpname = self.filename+".part"
+        with open(tmpname, "w") as f:
+            json.dump(self.stages, f, indent=1, sort_keys=True)
+        os.rename(tmpname, self.filename) # so an interrupted run never leaves a truncated checkpoint
+
+    def describe(self):
+        return "chan%d: reused %s, computed %s"%(self.channum, ", ".join(self.reused) or "nothing", ", ".join(self.computed) or "nothing")
@@ -0,0 +1,186 @@
+# An optional columnar export of Pope hdf5 output for the python side. Each field of each channel
+# is one column, optionally compressed, cut into fixed size chunks, and next to it the min and max
+# of the non NaN values of every chunk and its NaN count. NaN fails every predicate, as in CutSet. A query with range predicates (a CutSet, or a dict of field -> (lo, hi)) first checks the
+# chunk statistics: chunks where some predicate can't match are never read, chunks where every
+# predicate matches everything are taken whole, and only the rest are filtered record by record.
+# Time ordered fields like timestamp make range queries skip almost everything; cuts skip whole
+# chunks where a bad stretch of data fails them.
+
+import numpy as np
+import h5py
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from cuts import CutSet, fails
+import pope_hdf5
+
+FORMAT = "pope columnar 2" # 1 had (nchunks, 2) stats without the NaN count
+
+
+def export_columnar(pope_filename, filename, chunksize=2**16, compression=None, fields=None):
+    """
+    Write the Pope hdf5 file `pope_filename` to `filename` in the columnar layout:
+    `chanN/<field>` chunked with `chunksize` records per chunk, `chanN/stats/<field>` an
+    `(nchunks, 3)` array of each chunk's min and max of the non NaN values (NaN if there are none) and number
+    of NaN values, `chanN/calculated_cuts` copied as is, and the file
+    attributes copied. `fields` defaults to all dataproduct fields. Reads the input one chunk at a time.
+    `compression` is passed to h5py, eg "lzf" makes files about a third the size, but decompressing costs
+    more than reading whole uncompressed columns unless most chunks are skipped.
+    """
+    with pope_hdf5.PopeFile(pope_filename, chunksize) as pope, h5py.File(filename, "w") as h5:
+        for (k, v) in pope.attrs.items():
+            h5.attrs[k] = v
+        h5.attrs["format"] = FORMAT
+        h5.attrs["chunksize"] = chunksize
+        for channel in pope:
+            chfields = channel.fields if fields is None else [f for f in fields if f in channel.fields]
+            n = len(channel)
+            nchunks = -(-n//chunksize)
+            g = h5.create_group("chan%d"%channel.channum)
+            g.attrs["nrecords"] = n
+            if "calculated_cuts" in channel.group:
+                pope.h5.copy(channel.group["calculated_cuts"], g)
+            for name in chfields:
+                g.create_dataset(name, shape=(n,), dtype=dtype_MassCompatibleDataProductFeb2017[name],
+                    chunks=(chunksize,) if n > 0 else None, compression=compression if n > 0 else None)
+            stats = {name:np.zeros((nchunks, 3)) for name in chfields}
+            for (i, (first, end, records)) in enumerate(channel.iter_chunks(chfields, chunksize)):
+                for name in chfields:
+                    v = records[name]
+                    g[name][first:end] = v
+                    stats[name][i] = chunk_stats(v)
+            sg = g.create_group("stats")
+            for name in chfields:
+                sg[name] = stats[name]
+
+
+def chunk_stats(v):
+    """Return `(min, max, nnan)` of `v`, min and max over the values that aren't NaN, or NaN when all of them are."""
+    nan = np.isnan(v)
+    nnan = int(np.count_nonzero(nan))
+    if nnan == len(v):
+        return np.nan, np.nan, nnan
+    if nnan:
+        v = v[~nan]
+    return v.min(), v.max(), nnan
+
+
+def _predicates(where):
+    """Return a list of `(field, lo, hi)` in record units from a `CutSet` or a dict of field -> (lo, hi)."""
+    if where is None:
+        return []
+    if not isinstance(where, CutSet):
+        where = CutSet(where)
+    return list(zip(where.fields, where.lo, where.hi))
+
+
+class ColumnarChannel():
+    """One channel of a `ColumnarFile`, see `query`."""
+    def __init__(self, group, channum, chunksize):
+        self.group = group
+        self.channum = channum
+        self.chunksize = chunksize
+        self.nrecords = int(group.attrs["nrecords"])
+        self.fields = [name for name in dtype_MassCompatibleDataProductFeb2017.names if name in group]
+        self._stats = {}
+
+    def __len__(self):
+        return self.nrecords
+
+    def cuts(self):
+        return CutSet.from_channel_group(self.group)
+
+    def stats(self, field):
+        """Return the `(nchunks, 3)` min, max and NaN count of `field` in each chunk, read once and kept."""
+        if field not in self._stats:
+            self._stats[field] = self.group["stats"][field][()]
+        return self._stats[field]
+
+    def chunk_plan(self, where):
+        """
+        Return `(skip, whole)`, bool arrays per chunk: `skip` where the chunk statistics show no record can pass
+        every predicate in `where`, `whole` where they show every record passes. NaN fails every predicate, so a
+        chunk of only NaN is skipped and a chunk with any NaN is never whole.
+        """
+        nchunks = -(-self.nrecords//self.chunksize)
+        sizes = np.minimum(self.chunksize, self.nrecords-self.chunksize*np.arange(nchunks))
+        skip = np.zeros(nchunks, dtype=bool)
+        whole = np.ones(nchunks, dtype=bool)
+        for (field, lo, hi) in _predicates(where):
+            st = self.stats(field)
+            skip |= (st[:,1] < lo)|(st[:,0] > hi)|(st[:,2] == sizes)
+            whole &= (st[:,0] >= lo)&(st[:,1] <= hi)&(st[:,2] == 0)
+        return skip, whole&~skip
+
+    def query(self, fields, where=None):
+        """
+        Return `(columns, info)`: `columns` is a dict of field -> array of `fields` for records passing every
+        predicate in `where` (a `CutSet` or a dict of field -> (lo, hi), inclusive like mass cuts, NaN failing as in
+        `CutSet.cut_mask`), `info` a dict
+        with `nchunks`, `nskipped` and `nwhole` chunk counts. Consecutive chunks with the same plan are read
+        with one slice per field.
+        """
+        preds = _predicates(where)
+        skip, whole = self.chunk_plan(where)
+        readfields = sorted(set(fields)|set(f for (f, lo, hi) in preds))
+        out = {name:[] for name in fields}
+        nchunks = len(skip)
+        i = 0
+        while i < nchunks:
+            if skip[i]:
+                i += 1
+                continue
+            # extend over the run of chunks with the same plan
+            j = i+1
+            while j < nchunks and not skip[j] and whole[j] == whole[i]:
+                j += 1
+            first, end = i*self.chunksize, min(j*self.chunksize, self.nrecords)
+            if whole[i]:
+                for name in fields:
+                    out[name].append(self.group[name][first:end])
+            else:
+                cols = {name:self.group[name][first:end] for name in readfields}
+                good = np.ones(end-first, dtype=bool)
+                for (field, lo, hi) in preds:
+                    good &= ~fails(cols[field], lo, hi)
+                for name in fields:
+                    out[name].append(cols[name][good])
+            i = j
+        columns = {}
+        for name in fields:
+            dtype = dtype_MassCompatibleDataProductFeb2017[name]
+            columns[name] = np.concatenate(out[name]) if out[name] else np.zeros(0, dtype)
+        return columns, dict(nchunks=nchunks, nskipped=int(skip.sum()), nwhole=int(whole.sum()))
+
+
+class ColumnarFile():
+    """
+    ColumnarFile(filename)
+    Open a file written by `export_columnar`. `channels` maps channel number to `ColumnarChannel`.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.h5 = h5py.File(filename, "r")
+        if self.h5.attrs.get("format", None) != FORMAT:
+            raise ValueError("%s is not a %s file"%(filename, FORMAT))
+        self.chunksize = int(self.h5.attrs["chunksize"])
+        self.channels = {}
+        for name in sorted((k for k in self.h5.keys() if k.startswith("chan")), key=lambda k:int(k[4:])):
+            channum = int(name[4:])
+            self.channels[channum] = ColumnarChannel(self.h5[name], channum, self.chunksize)
+
+    def __iter__(self):
+        return iter(self.channels.values())
+
+    def __getitem__(self, channum):
+        return self.channels[channum]
+
+    def __len__(self):
+        return len(self.channels)
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
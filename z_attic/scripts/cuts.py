@@ -0,0 +1,139 @@
+# One definition of cuts, shared by the live listeners and make_preknowledge.py. A CutSet holds
+# (lo, hi) limits keyed by MassCompatibleDataProductFeb2017 field and evaluates all of them over
+# a structured record batch at once, giving one boolean mask per channel.
+
+import numpy as np
+
+# mass AnalysisControl cut names (as written under cuts/ in preknowledge files) -> (record field, scale)
+# where value_in_mass_units = scale*record[field]. Pope writes calculated_cuts/ with the field names
+# themselves, so those map to themselves.
+CUT_FIELDS = {
+    "pretrigger_rms":("pretrig_rms",1.0),
+    "pretrigger_mean":("pretrig_mean",1.0),
+    "postpeak_deriv":("postpeak_deriv",1.0),
+    "pulse_average":("pulse_average",1.0),
+    "pulse_rms":("pulse_rms",1.0),
+    "rise_time_ms":("rise_time",1e3),
+    "peak_value":("peak_value",1.0),
+    "min_value":("min_value",1.0),
+    "timestamp_sec":("timestamp",1.0),
+    "pretrig_rms":("pretrig_rms",1.0),
+    "pretrig_mean":("pretrig_mean",1.0),
+    "rise_time":("rise_time",1.0),
+    "timestamp":("timestamp",1.0),
+    "filt_value":("filt_value",1.0),
+    "filt_phase":("filt_phase",1.0),
+    "peak_index":("peak_index",1.0),
+}
+
+
+def fails(v, lo, hi):
+    """Return a boolean array, True where `v` is outside `[lo, hi]` or NaN."""
+    return ~((v >= lo)&(v <= hi))
+
+
+class CutSet():
+    """
+    CutSet(limits)
+    `limits` maps cut names (mass names like "pretrigger_rms", or record field names like "pretrig_rms",
+    see `CUT_FIELDS`) to `(lo, hi)`, where `None` means unbounded. A record passes a cut when
+    `lo <= value <= hi`, as in mass, and a NaN value fails every cut it is tested by, so a record with a NaN
+    field is never kept by accident. `ColumnarChannel.query` uses the same rule. Limits are stored converted to
+    record field units, so evaluating is one pair of comparisons per cut over the whole batch.
+    """
+    def __init__(self, limits):
+        self.names = []
+        self.limits = [] # (lo, hi) in mass units as given, so write_hdf5 round trips exactly
+        self.fields = []
+        self.lo = []
+        self.hi = []
+        for (name, v) in limits.items():
+            if v is None:
+                continue
+            if name not in CUT_FIELDS:
+                raise ValueError("don't know how to evaluate cut %s on records, known cuts are %s"%(name, sorted(CUT_FIELDS.keys())))
+            field, scale = CUT_FIELDS[name]
+            lo, hi = v
+            self.names.append(name)
+            self.limits.append((-np.inf if lo is None else lo, np.inf if hi is None else hi))
+            self.fields.append(field)
+            self.lo.append(-np.inf if lo is None else float(lo)/scale)
+            self.hi.append(np.inf if hi is None else float(hi)/scale)
+
+    def __repr__(self):
+        return "CutSet(%s)"%", ".join("%s=(%g, %g)"%x for x in zip(self.names, self.lo, self.hi))
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_analysis_control(cls, cuts):
+        """Make a CutSet from a `mass.AnalysisControl`, as returned by `calc_cuts_from_noise` in make_preknowledge.py."""
+        return cls(cuts.cuts_prm)
+
+    @classmethod
+    def from_hdf5_group(cls, g):
+        """Make a CutSet from the 2 element datasets in `g`, eg a preknowledge `chan13/cuts` group."""
+        return cls({name:tuple(g[name][()]) for name in g.keys()})
+
+    @classmethod
+    def from_channel_group(cls, g):
+        """
+        Make a CutSet from a channel group, `g["cuts"]` in a preknowledge file or `g["calculated_cuts"]`
+        in a Pope output or mass hdf5 file. A channel without cuts gets an empty CutSet, which cuts nothing.
+        """
+        for name in ["cuts", "calculated_cuts"]:
+            if name in g:
+                return cls.from_hdf5_group(g[name])
+        return cls({})
+
+    def write_hdf5(self, g):
+        """Write each cut to `g[name] = [lo, hi]` in mass units, the layout of preknowledge `cuts` groups."""
+        for (name, (lo, hi)) in zip(self.names, self.limits):
+            g[name] = np.array([lo, hi])
+
+    def cut_mask(self, records):
+        """Return a boolean array, True for each record in `records` that fails any cut."""
+        cut = np.zeros(len(records), dtype=bool)
+        for (field, lo, hi) in zip(self.fields, self.lo, self.hi):
+            cut |= fails(records[field], lo, hi)
+        return cut
+
+    def cut_mask_counts(self, records):
+        """
+        Return `(cut, counts)`, `cut` as from `cut_mask` and `counts` a dict of name -> number of records failing
+        that cut, so a record failing two cuts counts for both. For instrumentation, it costs one sum per cut.
+        """
+        cut = np.zeros(len(records), dtype=bool)
+        counts = {}
+        for (name, field, lo, hi) in zip(self.names, self.fields, self.lo, self.hi):
+            fail = fails(records[field], lo, hi)
+            counts[name] = int(np.count_nonzero(fail))
+            cut |= fail
+        return cut, counts
+
+    def cut_masks(self, records):
+        """Return a dict of name -> boolean array that is True where that cut alone fails."""
+        return {name:fails(records[field], lo, hi)
+            for (name, field, lo, hi) in zip(self.names, self.fields, self.lo, self.hi)}
+
+    def good(self, records):
+        return ~self.cut_mask(records)
+
+
+def load_cuts(filename):
+    """Return a dict of channel number -> CutSet from a preknowledge (either layout), Pope output or mass hdf5 file."""
+    import h5py
+    import preknowledge_format
+    cuts = {}
+    with h5py.File(filename,"r") as h5:
+        packed = preknowledge_format.is_packed(h5)
+    if packed:
+        with preknowledge_format.PreknowledgeFile(filename) as pk:
+            return {ch:pk.cuts(ch) for ch in pk.channels}
+    with h5py.File(filename,"r") as h5:
+        for (k,g) in h5.items():
+            if not k.startswith("chan"):
+                continue
+            cuts[int(k[4:])] = CutSet.from_channel_group(g)
+    return cuts
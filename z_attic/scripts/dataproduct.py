@@ -0,0 +1,78 @@
+# Decoding of the MassCompatibleDataProductFeb2017 payloads that Pope publishes over zmq.
+# Payloads are wrapped with np.frombuffer, which makes a view of the received bytes rather than
+# a copy, and many payloads are gathered into one preallocated contiguous record array, so a
+# listener can run for hours without allocating a new array per message.
+
+import numpy as np
+
+# define a dtype to match the julia type, aligned like julia lays it out: the fields take 54 bytes but
+# sizeof(MassCompatibleDataProductFeb2017) is 56, the record is padded to the alignment of its Float64 and
+# Int64 fields, and Pope sends all 56 bytes per record
+dtype_MassCompatibleDataProductFeb2017=np.dtype([("filt_value","f4"),("filt_phase","f4"),("timestamp","f8"),("rowcount",
+"i8"),("pretrig_mean","f4"),("pretrig_rms","f4"),("pulse_average","f4"),("pulse_rms","f4"),
+("rise_time","f4"),("postpeak_deriv","f4"),("peak_index","u2"),("peak_value","u2"),("min_value","u2")], align=True)
+
+
+def payload_buffer(payload):
+    """Return a buffer for `payload` without copying, `payload` may be bytes, a memoryview or a `zmq.Frame`."""
+    # zmq.Frame, as returned by recv_multipart(copy=False), exposes its memory via .buffer
+    return getattr(payload, "buffer", payload)
+
+def decode_payload(payload, dtype=dtype_MassCompatibleDataProductFeb2017):
+    """
+    decode_payload(payload)
+    Return a read-only view of the records in `payload`, this replaces `np.fromstring(payload, dtype)`
+    without copying. The view is only valid as long as `payload` is alive.
+    """
+    return np.frombuffer(payload_buffer(payload), dtype)
+
+
+class RecordRing():
+    """
+    A preallocated buffer of `capacity` records plus the channel number each record arrived on.
+    Payloads are copied straight from the receive buffer into the next free slots, then the filled part
+    is handed out with `batch()` and the buffer is rewound with `reset()`, so the same memory is reused
+    for every batch.
+    """
+    def __init__(self, capacity=65536, dtype=dtype_MassCompatibleDataProductFeb2017):
+        self.capacity = capacity
+        self.dtype = dtype
+        self.records = np.zeros(capacity, dtype)
+        self.channels = np.zeros(capacity, np.int32)
+        self._raw = memoryview(self.records.view(np.uint8))
+        self.n = 0
+
+    def isfull(self):
+        return self.n >= self.capacity
+
+    def space(self):
+        return self.capacity-self.n
+
+    def push(self, ch, payload):
+        """
+        Copy the records in `payload` (bytes, memoryview or `zmq.Frame` holding a whole number
+        of records) into the next free slots. Return the number of records pushed.
+        """
+        buf = payload_buffer(payload)
+        nbytes = len(buf)
+        itemsize = self.dtype.itemsize
+        nrec = nbytes//itemsize
+        if nrec*itemsize != nbytes:
+            raise ValueError("payload of %d bytes is not a whole number of %d byte records"%(nbytes, itemsize))
+        if nrec > self.space():
+            raise ValueError("payload of %d records does not fit in %d free slots"%(nrec, self.space()))
+        i = self.n*itemsize
+        self._raw[i:i+nbytes] = buf # a single memcpy from the receive buffer into the ring
+        if nrec == 1:
+            self.channels[self.n] = ch
+        else:
+            self.channels[self.n:self.n+nrec] = ch
+        self.n += nrec
+        return nrec
+
+    def batch(self):
+        """Return `(channels, records)` views of the filled part of the buffer."""
+        return self.channels[:self.n], self.records[:self.n]
+
+    def reset(self):
+        self.n = 0
@@ -0,0 +1,190 @@
+# Incremental histograms for the live spectrum viewers. The listeners' bins are uniform, so
+# we map each energy to its bin with arithmetic instead of calling np.histogram (which searches
+# the bin edges) on every tick, and add each batch to the counts in place with np.bincount, or
+# np.add.at when the batch is much smaller than the number of bins.
+
+import time
+import numpy as np
+
+
+def accumulate(targets, i):
+    """Add one count at each bin index in `i` to every counts array in `targets`, in place."""
+    if len(targets) == 0 or len(i) == 0:
+        return
+    nbins = len(targets[0])
+    if 16*len(i) < nbins:
+        # sparse batch, don't pay for a full length bincount
+        for counts in targets:
+            np.add.at(counts, i, 1)
+    else:
+        bincounts = np.bincount(i, minlength=nbins)
+        for counts in targets:
+            counts += bincounts
+
+
+class UniformHistogram():
+    """
+    UniformHistogram(lo, hi, binsize)
+    Counts in uniform bins with edges `np.arange(lo, hi+binsize/2, binsize)`. Like `np.histogram`
+    every bin is half open except the last, which includes `hi`. Values outside `[lo, hi]` and
+    NaN are ignored. Use `add(x)` to accumulate.
+    """
+    def __init__(self, lo, hi, binsize):
+        self.lo = float(lo)
+        self.binsize = float(binsize)
+        self.nbins = int(round((hi-lo)/binsize))
+        if self.nbins < 1:
+            raise ValueError("need hi > lo, got lo=%g, hi=%g"%(lo, hi))
+        self.hi = self.lo+self.nbins*self.binsize
+        self.counts = np.zeros(self.nbins, dtype=np.int64)
+
+    @classmethod
+    def from_edges(cls, bin_edges):
+        """Make a `UniformHistogram` matching `bin_edges`, like `np.arange(4000,10000,1.0)`, which must be uniform."""
+        bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        binsize = bin_edges[1]-bin_edges[0]
+        if not np.allclose(np.diff(bin_edges), binsize):
+            raise ValueError("bin_edges are not uniform")
+        return cls(bin_edges[0], bin_edges[-1], binsize)
+
+    @property
+    def bin_edges(self):
+        return self.lo+self.binsize*np.arange(self.nbins+1)
+
+    @property
+    def bin_centers(self):
+        return self.lo+self.binsize*(np.arange(self.nbins)+0.5)
+
+    def index(self, x):
+        """Return the bin index of each value in `x` that falls in a bin, dropping the rest."""
+        x = np.asarray(x, dtype=np.float64)
+        with np.errstate(invalid="ignore"): # NaN compares False below, so it is dropped
+            x = x[(x>=self.lo)&(x<=self.hi)]
+        i = ((x-self.lo)/self.binsize).astype(np.intp)
+        i[i==self.nbins] = self.nbins-1 # the last bin includes hi
+        return i
+
+    def add_index(self, i):
+        accumulate([self.counts], i)
+
+    def add(self, x):
+        self.add_index(self.index(x))
+
+    def clear(self):
+        self.counts[:] = 0
+
+
+class RollingCounts():
+    """
+    RollingCounts(nbins, window_s, slice_s=1.0)
+    Counts from roughly the last `window_s` seconds. Time is divided into slices of `slice_s`
+    seconds, each with its own counts; `counts` is the running sum over the live slices, and
+    when time moves past a slice its counts are subtracted and the slice is reused, so nothing
+    is ever rebuilt from scratch. `counts` covers between `window_s-slice_s` and `window_s` seconds.
+    """
+    def __init__(self, nbins, window_s, slice_s=1.0):
+        self.window_s = float(window_s)
+        self.slice_s = float(slice_s)
+        self.nslices = max(1, int(np.ceil(window_s/slice_s)))
+        self.slices = np.zeros((self.nslices, nbins), dtype=np.int64)
+        self.counts = np.zeros(nbins, dtype=np.int64)
+        self.current = None # absolute number of the current slice, int(t/slice_s)
+
+    def advance(self, t):
+        """Expire slices older than the window ending at time `t`."""
+        k = int(t//self.slice_s)
+        if self.current is None:
+            self.current = k
+        elif k-self.current >= self.nslices:
+            self.slices[:] = 0
+            self.counts[:] = 0
+            self.current = k
+        while self.current < k:
+            self.current += 1
+            old = self.slices[self.current%self.nslices]
+            self.counts -= old
+            old[:] = 0
+
+    def targets(self, t):
+        """Advance to time `t`, then return the counts arrays that new counts at time `t` must be added to."""
+        self.advance(t)
+        return [self.slices[self.current%self.nslices], self.counts]
+
+
+class Spectra():
+    """
+    Spectra(lo, hi, binsize, rois=None, window_s=None, slice_s=1.0)
+    Accumulates calibrated energies into a coadded spectrum and one spectrum per channel, all
+    sharing one binning so each batch is binned once. Also keeps:
+    `rois`      a dict of name -> (lo, hi) energy ranges, counted coadded in `roi_counts[name]`
+                and per channel in `roi_channel_counts[name][ch]`
+    `window`    if `window_s` is given, a `RollingCounts` of the coadded spectrum over the last `window_s` seconds
+    `binnings`  extra coadded histograms with their own binning, added with `add_binning`
+    Call `add(ch, energies)` with the energies from one channel.
+    """
+    def __init__(self, lo, hi, binsize, rois=None, window_s=None, slice_s=1.0):
+        self.coadded = UniformHistogram(lo, hi, binsize)
+        self.channels = {}
+        self.rois = dict(rois) if rois is not None else {}
+        self.roi_counts = {name:0 for name in self.rois}
+        self.roi_channel_counts = {name:{} for name in self.rois}
+        self.window = None
+        if window_s is not None:
+            self.window = RollingCounts(self.coadded.nbins, window_s, slice_s)
+        self.binnings = {}
+
+    @classmethod
+    def from_edges(cls, bin_edges, **kwargs):
+        h = UniformHistogram.from_edges(bin_edges)
+        return cls(h.lo, h.hi, h.binsize, **kwargs)
+
+    @property
+    def bin_edges(self):
+        return self.coadded.bin_edges
+
+    @property
+    def bin_centers(self):
+        return self.coadded.bin_centers
+
+    @property
+    def counts(self):
+        return self.coadded.counts
+
+    def add_binning(self, name, lo, hi, binsize):
+        self.binnings[name] = UniformHistogram(lo, hi, binsize)
+
+    def add_roi(self, name, lo, hi):
+        self.rois[name] = (lo, hi)
+        self.roi_counts[name] = 0
+        self.roi_channel_counts[name] = {}
+
+    def channel(self, ch):
+        """Return the `UniformHistogram` for channel `ch`, creating it if needed."""
+        h = self.channels.get(ch, None)
+        if h is None:
+            c = self.coadded
+            h = UniformHistogram(c.lo, c.hi, c.binsize)
+            self.channels[ch] = h
+        return h
+
+    def add(self, ch, energies, t=None):
+        """Add `energies` from channel `ch` at time `t` (default now, only used for the rolling window)."""
+        energies = np.asarray(energies, dtype=np.float64)
+        targets = [self.coadded.counts, self.channel(ch).counts]
+        if self.window is not None:
+            targets.extend(self.window.targets(time.time() if t is None else t))
+        accumulate(targets, self.coadded.index(energies))
+        for (name, (lo, hi)) in self.rois.items():
+            n = int(np.count_nonzero((energies>=lo)&(energies<hi)))
+            self.roi_counts[name] += n
+            chancounts = self.roi_channel_counts[name]
+            chancounts[ch] = chancounts.get(ch, 0)+n
+        for h in self.binnings.values():
+            h.add(energies)
+
+    def window_counts(self, t=None):
+        """Return the coadded counts from the rolling window, expiring old slices first."""
+        if self.window is None:
+            raise ValueError("Spectra was created without window_s")
+        self.window.advance(time.time() if t is None else t)
+        return self.window.counts
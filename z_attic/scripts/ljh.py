@@ -0,0 +1,159 @@
+# A lightweight memory mapped LJH reader, for the python tools that only need to look at records,
+# not the rest of mass. Parses the same header as src/LJH.jl, and exposes the records of an LJH 2.x
+# file as a read only np.memmap so looking at a few records anywhere in the file reads only
+# those pages, and iterating over segments hands out views instead of copies.
+
+import os
+import time
+import numpy as np
+
+# bytes before the samples in each record, by version, see header_nbytes in LJH.jl
+HEADER_NBYTES = {"2.0.0":6, "2.1.0":6, "2.2.0":16, "2.2.1":16}
+
+
+def ljh_get_header_dict(f):
+    """Read the text header from the open binary file `f`, return `(headerdict, datastartpos)`."""
+    headerdict = {}
+    while True:
+        line = f.readline()
+        if line == b"":
+            raise ValueError("eof while reading header")
+        line = line.decode("latin-1")
+        if line.startswith("#End of Header"):
+            break
+        elif line.startswith("#"):
+            continue
+        splitline = line.split(":")
+        if len(splitline) != 2:
+            continue
+        a, b = splitline
+        headerdict[a.strip()] = b.strip()
+    return headerdict, f.tell()
+
+
+def record_dtype(version, nsamples):
+    """Return the numpy dtype of one record in an LJH file of `version` with `nsamples` samples per record."""
+    if version not in HEADER_NBYTES:
+        raise ValueError("LJH version %s is not one of %s"%(version, sorted(HEADER_NBYTES.keys())))
+    if HEADER_NBYTES[version] == 16:
+        return np.dtype([("rowcount",np.int64),("timestamp_usec",np.int64),("samples",np.uint16,nsamples)])
+    return np.dtype([("header",np.uint8,6),("samples",np.uint16,nsamples)])
+
+
+def decode_record_headers(header, version, frametime, num_rows, row):
+    """
+    Return `(rowcount, timestamp_usec)` arrays decoded from the `(n,6)` uint8 record headers of LJH 2.0 or 2.1,
+    like parse_record_header in LJH.jl. These versions encode an approximate time: 2.1 in units of 4 microseconds
+    (bytes 3-6 hold milliseconds, byte 1 the 4 microsecond fraction), 2.0 in milliseconds in bytes 3-6.
+    """
+    h = np.asarray(header, dtype=np.int64)
+    ms = h[:,2]|(h[:,3]<<8)|(h[:,4]<<16)|(h[:,5]<<24)
+    if version == "2.1.0":
+        count_4usec = 250*ms+h[:,0]
+        count_nsec = count_4usec*4000
+        timestamp_usec = 4*count_4usec
+    elif version == "2.0.0":
+        count_nsec = ms*1000000
+        timestamp_usec = 1000*ms
+    else:
+        raise ValueError("LJH version %s has no encoded record headers"%version)
+    ns_per_frame = int(round(frametime*1e9))
+    count_frame = -(-count_nsec//ns_per_frame) # ceiling division, like cld
+    return count_frame*num_rows+row, timestamp_usec
+
+
+class LJHFile():
+    """
+    LJHFile(filename)
+    Open the LJH file `filename` and memory map its records. `records` is a structured np.memmap with
+    one entry per complete record, `samples` the `(nrecords, nsamples)` uint16 view of the samples, and
+    `rowcount` and `timestamp_usec` int64 arrays, views into the file for LJH 2.2, decoded from the record
+    headers for 2.0 and 2.1. Header fields are in `headerdict`, with the common ones also as attributes.
+    Use `iter_segments` to walk the file in blocks of records, `refresh` or `follow` to pick up records
+    appended by a writer that still has the file open.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.headerdict, self.datastartpos = ljh_get_header_dict(f)
+        h = self.headerdict
+        self.version = h["Save File Format Version"]
+        self.nsamples = int(h["Total Samples"])
+        self.npresamples = int(h["Presamples"])
+        self.frametime = float(h["Timebase"])
+        self.channum = int(round(float(h["Channel"])))
+        self.num_rows = int(h.get("Number of rows", "1"))
+        self.num_columns = int(h.get("Number of columns", "0"))
+        self.row = int(h.get("Row number (from 0-%d inclusive)"%(self.num_rows-1), "0"))
+        self.column = int(h.get("Column number (from 0-%d inclusive)"%(self.num_columns-1), "0"))
+        self.dtype = record_dtype(self.version, self.nsamples)
+        self.records = self._map()
+
+    def _map(self):
+        nrecords = (os.path.getsize(self.filename)-self.datastartpos)//self.dtype.itemsize
+        if nrecords == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.filename, dtype=self.dtype, mode="r", offset=self.datastartpos, shape=(nrecords,))
+
+    @property
+    def record_nbytes(self):
+        return self.dtype.itemsize
+
+    @property
+    def samples(self):
+        return self.records["samples"]
+
+    @property
+    def rowcount(self):
+        if "rowcount" in self.dtype.names:
+            return self.records["rowcount"]
+        return decode_record_headers(self.records["header"], self.version, self.frametime, self.num_rows, self.row)[0]
+
+    @property
+    def timestamp_usec(self):
+        if "timestamp_usec" in self.dtype.names:
+            return self.records["timestamp_usec"]
+        return decode_record_headers(self.records["header"], self.version, self.frametime, self.num_rows, self.row)[1]
+
+    def iter_segments(self, segment_nrecords=2**14, first=0):
+        """
+        Yield `(first_pnum, end_pnum, segnum, samples)` for consecutive blocks of `segment_nrecords` records
+        starting at record `first`, like `mass.LJHFile.iter_segments`, but `samples` is a view, not a copy.
+        """
+        for (segnum, a) in enumerate(range(first, len(self), segment_nrecords)):
+            b = min(a+segment_nrecords, len(self))
+            yield a, b, segnum, self.samples[a:b]
+
+    def refresh(self):
+        """Remap the file if complete records were appended since it was last mapped, return the number of new records."""
+        n = len(self)
+        if (os.path.getsize(self.filename)-self.datastartpos)//self.dtype.itemsize > n:
+            self.records = self._map()
+        return len(self)-n
+
+    def follow(self, poll_s=0.1, timeout_s=None, first=None):
+        """
+        Yield `(first_pnum, end_pnum, records)` for each batch of records as a live writer appends them, starting
+        with the records already in the file (or at record `first`). Polls the file size every `poll_s` seconds,
+        and returns once no new record has arrived for `timeout_s` seconds (never, if `timeout_s` is None).
+        Only complete records are handed out, a partially written record waits for the next poll.
+        """
+        a = 0 if first is None else first
+        tlast = time.time()
+        while True:
+            self.refresh()
+            if len(self) > a:
+                b = len(self)
+                yield a, b, self.records[a:b]
+                a = b
+                tlast = time.time()
+            elif timeout_s is not None and time.time()-tlast > timeout_s:
+                return
+            else:
+                time.sleep(poll_s)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return "LJHFile(%r) version %s, channel %d, %d records of %d samples"%(self.filename, self.version, self.channum, len(self), self.nsamples)
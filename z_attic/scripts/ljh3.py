@@ -0,0 +1,303 @@
+# An LJH 3.0 reader for the python tools, see src/ljh3.jl. LJH3 files are a json header and a newline,
+# then records of different lengths, each an int32 number of samples, int32 first rising sample, int64
+# frame1index, int64 timestamp_usec and the uint16 samples, so record i's position is only known after
+# walking every record before it. LJH3File walks the file once and keeps the record offsets in a sidecar
+# file next to it (`<filename>.offsets`), which later opens read instead of walking the file again, and
+# which `refresh` extends as a writer appends records. With the offsets, `len`, reading any record and
+# reading any range of records take one seek, and `split` hands out byte balanced ranges to read in parallel.
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+
+RECORD_HEADER = np.dtype([("nsamples","<i4"),("first_rising_sample","<i4"),("frame1index","<i8"),("timestamp_usec","<i8")])
+RECORD_HEADER_NBYTES = RECORD_HEADER.itemsize # 24
+OFFSETS_MAGIC = b"LJH3OFF1"
+# sidecar header, followed by one little endian int64 byte offset per record
+OFFSETS_HEADER = np.dtype([("magic","S8"),("datastartpos","<i8"),("header_sha1","S20"),("pad","S4")])
+# records checked at once when guessing a run of records is all the same length, the block doubles from
+# the first to the second size while the guess holds
+SCAN_BLOCK = (64, 2**18)
+
+
+def ljh3_get_header(f):
+    """Read the json header from the open binary file `f`, return `(header, datastartpos)`, like the LJH3File constructor in ljh3.jl."""
+    f.seek(0)
+    text = b""
+    decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+    while True:
+        chunk = f.read(4096)
+        text += chunk
+        try:
+            s = text.decode("utf-8", "surrogateescape") # the chunk may run into the binary records
+            header, end = decoder.raw_decode(s)
+        except ValueError:
+            if chunk == b"":
+                raise ValueError("eof while reading LJH3 header")
+            continue
+        datastartpos = len(s[:end].encode("utf-8", "surrogateescape"))
+        break
+    f.seek(datastartpos)
+    if f.read(1) != b"\n":
+        raise ValueError("LJH3 header is not followed by a newline")
+    if header.get("File Format", None) != "LJH3":
+        raise ValueError("not an LJH3 file, File Format is %r"%header.get("File Format", None))
+    if header.get("File Format Version", None) != "3.0.0":
+        raise ValueError("LJH3 File Format Version %r is not 3.0.0"%header.get("File Format Version", None))
+    return header, datastartpos+1
+
+
+def is_ljh3(filename):
+    """Return True if `filename` starts like an LJH3 file (a json header), rather than LJH 2.x."""
+    with open(filename, "rb") as f:
+        return f.read(1) == b"{"
+
+
+def _gather(buf, starts, dtype):
+    """Return the `dtype` values at byte offsets `starts` in the uint8 array `buf`."""
+    dtype = np.dtype(dtype)
+    idx = np.asarray(starts, dtype=np.int64)[:,None]+np.arange(dtype.itemsize)
+    return np.ascontiguousarray(buf[idx]).view(dtype).ravel()
+
+
+def scan_offsets(buf, pos=0):
+    """
+    Walk the records in the uint8 array `buf` starting at byte `pos`, return `(offsets, end)`, the int64 byte offset
+    of each complete record and the offset just past the last one. A trailing partial record is left for the next
+    scan. Most files have runs of records of the same length, so instead of one record at a time this guesses that
+    the following records have the length of the current one, checks the guess for a block of them at once, and
+    accepts the records up to the first one whose length differs.
+    """
+    found = []
+    n = len(buf)
+    block = SCAN_BLOCK[0]
+    while pos+RECORD_HEADER_NBYTES <= n:
+        nsamples = int(_gather(buf, [pos], "<i4")[0])
+        if nsamples < 0:
+            raise ValueError("LJH3 record at byte %d has %d samples, the file or its offsets are corrupt"%(pos, nsamples))
+        reclen = RECORD_HEADER_NBYTES+2*nsamples
+        nfit = min((n-pos)//reclen, block)
+        if nfit == 0:
+            break
+        starts = pos+reclen*np.arange(nfit, dtype=np.int64)
+        differ = np.nonzero(_gather(buf, starts, "<i4") != nsamples)[0]
+        k = nfit if len(differ) == 0 else int(differ[0])
+        block = min(2*block, SCAN_BLOCK[1]) if len(differ) == 0 else SCAN_BLOCK[0]
+        found.append(starts[:k])
+        pos += k*reclen
+    offsets = np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+    return offsets, pos
+
+
+def offsets_filename(filename):
+    return filename+".offsets"
+
+
+class LJH3File():
+    """
+    LJH3File(filename, persist_offsets=True)
+    Open the LJH3 file `filename`. `header` is the json header, with `frameperiod` also an attribute. `offsets` is the
+    int64 byte offset of every complete record, read from the sidecar `offsets_filename(filename)` if it is there and
+    matches the file, extended by walking whatever the file has past the last offset it holds. With `persist_offsets`
+    the sidecar is written or extended, if possible. `f[i]` or `record(i)` returns `(header, samples)`, a `RECORD_HEADER`
+    record and the uint16 samples, `read_range(first, end)` the records `first:end` in one read. Use `refresh` or
+    `follow` to pick up records appended by a writer that still has the file open.
+    """
+    def __init__(self, filename, persist_offsets=True):
+        self.filename = filename
+        self.persist_offsets = persist_offsets
+        self.f = open(filename, "rb")
+        self.header, self.datastartpos = ljh3_get_header(self.f)
+        self.f.seek(0)
+        self.header_sha1 = hashlib.sha1(self.f.read(self.datastartpos)).digest()
+        self.frameperiod = self.header["frameperiod"]
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.end = self.datastartpos
+        self.nsaved = 0 # offsets already in the sidecar
+        self._load_offsets()
+        self.refresh()
+
+    def _record_nbytes_at(self, pos):
+        self.f.seek(pos)
+        b = self.f.read(4)
+        if len(b) < 4:
+            return None
+        return RECORD_HEADER_NBYTES+2*int(np.frombuffer(b, "<i4")[0])
+
+    def _load_offsets(self):
+        """Use the offsets in the sidecar if it was written for this file and its last offsets agree with the file."""
+        fname = offsets_filename(self.filename)
+        if not os.path.isfile(fname):
+            return
+        with open(fname, "rb") as f:
+            b = f.read()
+        if len(b) < OFFSETS_HEADER.itemsize:
+            return
+        h = np.frombuffer(b[:OFFSETS_HEADER.itemsize], OFFSETS_HEADER)[0]
+        if h["magic"] != OFFSETS_MAGIC or h["datastartpos"] != self.datastartpos or h["header_sha1"] != self.header_sha1:
+            return
+        nvalid = (len(b)-OFFSETS_HEADER.itemsize)//8 # a partially written last offset is dropped
+        offsets = np.frombuffer(b, "<i8", count=nvalid, offset=OFFSETS_HEADER.itemsize).astype(np.int64)
+        end = self.datastartpos
+        if len(offsets) > 0:
+            size = os.fstat(self.f.fileno()).st_size
+            nbytes = self._record_nbytes_at(offsets[-1])
+            if offsets[0] != self.datastartpos or nbytes is None or offsets[-1]+nbytes > size:
+                return
+            if len(offsets) > 1 and offsets[-2]+self._record_nbytes_at(offsets[-2]) != offsets[-1]:
+                return
+            end = int(offsets[-1])+nbytes
+        self.offsets, self.end, self.nsaved = offsets, end, len(offsets)
+
+    def _save_offsets(self):
+        """Write the sidecar, or append the offsets it doesn't have yet. Offsets never change, so a race between two readers extending it is harmless."""
+        if not self.persist_offsets or self.nsaved == len(self.offsets):
+            return
+        fname = offsets_filename(self.filename)
+        try:
+            if self.nsaved == 0:
+                h = np.zeros(1, OFFSETS_HEADER)
+                h["magic"], h["datastartpos"], h["header_sha1"] = OFFSETS_MAGIC, self.datastartpos, self.header_sha1
+                tmpname = fname+".part"
+                with open(tmpname, "wb") as f:
+                    f.write(h.tobytes())
+                    f.write(self.offsets.astype("<i8").tobytes())
+                os.rename(tmpname, fname) # a stale sidecar is replaced whole, never left half rewritten
+            else:
+                with open(fname, "r+b") as f:
+                    f.seek(OFFSETS_HEADER.itemsize+8*self.nsaved)
+                    f.write(self.offsets[self.nsaved:].astype("<i8").tobytes())
+                    f.truncate()
+        except (IOError, OSError):
+            self.persist_offsets = False # eg a read only data directory, keep the offsets in memory only
+            return
+        self.nsaved = len(self.offsets)
+
+    def refresh(self):
+        """Walk any complete records past the last known one, extend `offsets` and the sidecar, return the number of new records."""
+        size = os.fstat(self.f.fileno()).st_size
+        if size-self.end < RECORD_HEADER_NBYTES:
+            return 0
+        buf = np.memmap(self.filename, dtype=np.uint8, mode="r", offset=self.end, shape=(size-self.end,))
+        new, end = scan_offsets(buf)
+        del buf
+        if len(new) > 0:
+            self.offsets = np.concatenate([self.offsets, new+self.end])
+            self.end += end
+            self._save_offsets()
+        return len(new)
+
+    def follow(self, poll_s=0.1, timeout_s=None, first=None):
+        """
+        Yield `(first_pnum, end_pnum)` for each batch of records as a live writer appends them, starting with the
+        records already in the file (or at record `first`), like `ljh.LJHFile.follow`. Read them with `read_range`.
+        """
+        a = 0 if first is None else first
+        tlast = time.time()
+        while True:
+            self.refresh()
+            if len(self) > a:
+                b = len(self)
+                yield a, b
+                a = b
+                tlast = time.time()
+            elif timeout_s is not None and time.time()-tlast > timeout_s:
+                return
+            else:
+                time.sleep(poll_s)
+
+    def _end_offset(self, i):
+        return int(self.offsets[i]) if i < len(self.offsets) else self.end
+
+    @property
+    def record_nsamples(self):
+        """The number of samples in each record, from the offsets alone."""
+        return (np.diff(np.append(self.offsets, self.end))-RECORD_HEADER_NBYTES)//2
+
+    def read_range(self, first, end):
+        """
+        Return `(headers, samples)` for the records `first:end`, read with one seek and one read: `headers` a
+        `RECORD_HEADER` array, `samples` a list of uint16 arrays, views into one buffer.
+        """
+        first, end, _ = slice(first, end).indices(len(self))
+        if end <= first:
+            return np.zeros(0, RECORD_HEADER), []
+        pos = int(self.offsets[first])
+        self.f.seek(pos)
+        buf = np.frombuffer(self.f.read(self._end_offset(end)-pos), dtype=np.uint8)
+        starts = self.offsets[first:end]-pos
+        headers = _gather(buf, starts, RECORD_HEADER)
+        samples = [buf[s+RECORD_HEADER_NBYTES:s+RECORD_HEADER_NBYTES+2*n].view("<u2")
+            for (s, n) in zip(starts, headers["nsamples"])]
+        return headers, samples
+
+    def record(self, i):
+        """Return `(header, samples)` of record `i`, negative `i` counting from the end."""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("record %d of an LJH3 file with %d records"%(i, len(self)))
+        headers, samples = self.read_range(i, i+1)
+        return headers[0], samples[0]
+
+    def __getitem__(self, i):
+        return self.record(i)
+
+    def split(self, nparts):
+        """Return up to `nparts` `(first, end)` record ranges covering the file with about the same number of bytes each, to read in parallel."""
+        if len(self) == 0:
+            return []
+        targets = self.datastartpos+(self.end-self.datastartpos)*np.arange(1, nparts)/float(nparts)
+        bounds = np.unique(np.concatenate([[0], np.searchsorted(self.offsets, targets), [len(self)]]))
+        return [(int(a), int(b)) for (a, b) in zip(bounds[:-1], bounds[1:])]
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return "LJH3File(%r) frameperiod %g, %d records"%(self.filename, self.frameperiod, len(self))
+
+
+class LJH3Writer():
+    """
+    LJH3Writer(filename, frameperiod, header_extra=None)
+    Create the LJH3 file `filename`, like `create3` in ljh3.jl, and append records to it with
+    `write(samples, first_rising_sample, frame1index, timestamp_usec)`.
+    """
+    def __init__(self, filename, frameperiod, header_extra=None):
+        self.filename = filename
+        header = OrderedDict([("File Format", "LJH3"), ("File Format Version", "3.0.0"), ("frameperiod", frameperiod)])
+        header.update(header_extra or {})
+        self.f = open(filename, "wb")
+        self.f.write(json.dumps(header, indent=4).encode("utf-8")+b"\n")
+
+    def write(self, samples, first_rising_sample, frame1index, timestamp_usec):
+        samples = np.asarray(samples, dtype="<u2")
+        h = np.zeros(1, RECORD_HEADER)
+        h["nsamples"], h["first_rising_sample"], h["frame1index"], h["timestamp_usec"] = len(samples), first_rising_sample, frame1index, timestamp_usec
+        self.f.write(h.tobytes())
+        self.f.write(samples.tobytes())
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -7,6 +7,13 @@ import os
 import time
 import h5py
 import argparse
+import multiprocessing
+from preknowledge import (summarize_and_cut_ds, cut_stats_ds, write_preknowledge_data,
+    make_channel_preknowledge, merge_hdf5_files, run_group_stage, average_pulse_key, filter_key)
+from checkpoint import ChannelCheckpoint
+from noise_analysis import write_noise_results
+from run_aggregates import average_pulses_multirun
+from cuts import CutSet
 
 
 def query_yes_no(question, default="yes"):
@@ -41,101 +48,6 @@ def query_yes_no(question, default="yes"):
             sys.stdout.write("Please respond with 'yes' or 'no' "
                              "(or 'y' or 'n').\n")
 
-def estimate_peak_index_ds(ds):
-    first, end, data = ds.pulse_records.datafile.read_segment(0)
-    peakinds = data.argmax(axis=1)
-    peakind = np.argmax(np.bincount(peakinds)) # find the mode peak index (most frequent peak index)
-    mad = np.median(np.abs(peakinds-peakind))
-    return peakind, mad
-
-def estimate_peak_time_microsec_ds(ds):
-    peakind_abs, mad = estimate_peak_index_ds(ds)
-    peakind_rel = peakind_abs-ds.nPresamples
-    # add the median absolute deviation (or 1) to the peakind to avoid cutting low energy pulses that peak earlier
-    peakind = peakind_rel+max(1,mad)
-    return peakind*ds.timebase*1e6
-
-def calc_cuts_from_noise(self, nsigma_max_deriv=7, nsigma_pt_rms=7):
-    """
-    calc_cuts_from_noise(self, nsigma=7)
-    Use noise files to calculate ranges that encompass nsigma sigmas worth of deviation in the
-    pretrigger mean and max deriv. Uses median absolute deviation to be robust to outliers.
-    return a mass.core.controller.AnalysisControl() object with cuts defined for pretrigger_rms and postpeak_deriv
-    """
-
-    max_deriv = np.zeros(self.noise_records.nPulses)
-    pretrigger_rms = np.zeros(self.noise_records.nPulses)
-    for _first_pnum, _end_pnum, _seg_num, data_seg in self.noise_records.datafile.iter_segments():
-        max_deriv[_first_pnum:_end_pnum]=mass.analysis_algorithms.compute_max_deriv(data_seg,ignore_leading=0)
-        pretrigger_rms[_first_pnum:_end_pnum]=data_seg[:,:self.nPresamples].std(axis=1)
-
-    md_med = np.median(max_deriv)
-    md_mad = np.median(np.abs(max_deriv-md_med))
-    pt_med = np.median(pretrigger_rms)
-    pt_mad = np.median(np.abs(pretrigger_rms-pt_med))
-    # for gausssian distributed data sigma = 1.4826*median_absolute_deviation
-    # so if we want 5 sigma deviation, we want 5*1.4826*mad
-    nmad_max_deriv = nsigma_max_deriv*1.4826
-    nmad_pt_rms    = nsigma_pt_rms*1.4826
-    # md_min = max(0.0,md_med-md_mad*nmad_max_deriv)
-    md_min = -np.inf
-    md_max = md_med+md_mad*nmad_max_deriv
-    # pt_min = pt_med-pt_mad*nmad_pt_rms
-    pt_min = 0.0 # lower limit on pretrigger mean is not normally used, and when I tried I found many channels failing with lots cut due to this. I guess the noise had reduced over time.
-    pt_max = max(0.0,pt_med+pt_mad*nmad_pt_rms)
-
-    cuts = mass.core.controller.AnalysisControl(
-        pretrigger_rms=(pt_min, pt_max),
-        postpeak_deriv=(md_min, md_max),
-    )
-    return cuts
-
-def write_preknowledge_data(filename,data,exclude_channels):
-    with h5py.File(filename,"w") as h5:
-        for ds in data:
-            g = h5.require_group("chan%g"%ds.channum)
-            write_preknowledge_ds(g,ds)
-    return filename
-
-def write_preknowledge_ds(g,ds):
-        g.require_group("physical")
-        # g["physical"]["x_um_from_array_center"]=0
-        # g["physical"]["y_um_from_array_center"]=0
-        # g["physical"]["collimator open area"]=0
-        g["physical"]["frametime"]=ds.timebase
-        g["physical"]["number_of_rows"]=ds.number_of_rows
-        g["physical"]["number_of_columns"]=ds.number_of_columns
-
-        g.require_group("trigger")
-        g["trigger"]["nsamples"]=ds.nSamples
-        g["trigger"]["npresamples"]=ds.nPresamples
-        # g["trigger"]["avoid_edge"]=True
-        # g["trigger"]["type"]="edge"
-        # g["trigger"]["level_specify_units_in_name"]=0.1
-
-        g.require_group("filter")
-        g["filter"]["data_file_used_to_generate_filters"]=ds.filename
-        g["filter"]["values"] = ds.filter.filt_noconst
-        g["filter"]["values_at"] = ds.filter.filt_aterms.reshape((-1,))
-        if ds.filter.f_3db is None:
-            g["filter"]["f3db"] = 100000000.0 # its none, want a float, justmake it obviously odd
-        else:
-            g["filter"]["f3db"] = ds.filter.f_3db
-        g["filter"]["average_pulse"] = ds.filter.avg_signal
-        # g["filter"]["average_pulse_energy_eV"]=5989.0
-        g["filter"]["description"] = "noconst"
-        g["filter"]["shift_threshold"] = int(round(4.3*np.median(ds.p_pretrig_rms[ds.good()])))
-
-        g.require_group("summarize")
-        g["summarize"]["peak_index"]=ds.peakindex1
-
-        g.require_group("cuts")
-        for (k,v) in ds.usedcuts.cuts_prm.items():
-            if v is not None:
-                g["cuts"][k] = np.array([v[0],v[1]])
-
-        g["analysis_type"]="mass compatible feb 2017"
-
 parser = argparse.ArgumentParser(description='Create a prekowledge file for Pope.jl',
     epilog="""For each channel, calcuates the peak index based on the mode plus median absolute deviation in the first segment of the pulse_file.
     Then summarizes data. Thenit calculated a pretrigger_rms and post_peak deriv cut based on applying thos alogritms to a noise file and choosing
@@ -159,6 +71,16 @@ parser.add_argument('--filter_data',help="run data.filter_data in addition to ba
 parser.add_argument('--apply_filters',help="for testing this will apply filters with mass, this has no effect on the preknowledge file",action="store_true")
 parser.add_argument('--temp_out_dir',default=".", help="directory in which make_preknowledge_temp and make_preknowledge_noise_temp are created. These are mass hdf5 files created as a byproduct of make_preknowledge, and they inspected for testing purposes.")
 parser.add_argument('--overwriteoutput',help="pass this if you want to overwrite an exsiting output file with the same name",action="store_true")
+parser.add_argument('--workers',help="number of worker processes, with more than 1 each channel's pipeline (peak estimate through filter) runs in its own process with its own temporary hdf5 files, which are merged at the end. The output matches a serial run.",default=1,type=int)
+parser.add_argument('--streaming_noise_stats',help="calculate the noise based cuts in one pass with memory per channel that does not grow with the noise file, using a quantile sketch with log spaced buckets, the median is then within 0.1%% of the exact value and the MAD within 0.2%% of the median plus the MAD",action="store_true")
+parser.add_argument('--noise_stats_rtol',help="with --streaming_noise_stats, stop reading a channel's noise once its cut limits change by less than this fraction for two segments in a row",default=None,type=float)
+parser.add_argument('--peak_time_budget_s',help="estimate each channel's peak index from records sampled across the whole pulse file, spending at most this many seconds per channel, instead of from all of the first segment",default=None,type=float)
+parser.add_argument('--extra_pulse_files',help="pulse ljh files from more runs (any one channel's file per run, like pulse_file) whose pulses are added to pulse_file's for the cut statistics and average pulses. Each run is summarized per channel on its own and the summaries merged, records are never concatenated. Peak index and summarize_data still use pulse_file only. Implies the serial path",default=[],nargs="*")
+parser.add_argument('--io_threads',help="with --extra_pulse_files, number of threads reading runs' files concurrently",default=4,type=int)
+parser.add_argument('--resume',help="keep the temporary hdf5 files and reuse each channel's completed stages (summarize, cuts, noise_spectra, average_pulse, filter) from the last run, recomputing only the stages whose input files (path, size, mtime, header) or parameters changed, and the stages after them. Without it every stage is recomputed and old checkpoints are discarded",action="store_true")
+parser.add_argument('--checkpoint_dir',help="directory for the per channel stage checkpoints, default make_preknowledge_checkpoints in --temp_out_dir",default=None)
+parser.add_argument('--noise_analysis_file',help="also compute each channel's noise autocorrelation and power spectral density, like scripts/noise_analysis.jl but without the ARMA fit, in the same pass over the noise file as the cuts (channels in parallel with --workers), and write them to this hdf5 file in the <channum>/noise layout of NoiseAnalysis.hdf5save",default=None)
+parser.add_argument('--report_cache_dir',help="with --quality_report, keep rendered channel pages in this directory and reuse the ones whose inputs have not changed. Pages are rendered with --workers processes. Defaults to a directory next to the report when --workers is more than 1. Cached pages are png images at 100 dpi, not vector graphics like the pages drawn straight into the report",default=None)
 args = vars(parser.parse_args())
 for (k,v) in args.items():
     print("%s: %s"%(k, v))
@@ -192,6 +114,12 @@ if len(available_chans) == 0:
 chan_nums = available_chans[:maxnchans]
 pulse_files = mass.ljh_util.ljh_chan_names(path.join(dir_base, dir_p), chan_nums)
 noise_files = mass.ljh_util.ljh_chan_names(path.join(dir_base, dir_n), chan_nums)
+# channel number -> that channel's pulse files in every run, pulse_file's run first
+run_pulse_files = {ch:[fname] for (ch, fname) in zip(chan_nums, pulse_files)}
+for extra in args["extra_pulse_files"]:
+    for (ch, fname) in zip(chan_nums, mass.ljh_util.ljh_chan_names(path.join(dir_base, extra), chan_nums)):
+        if path.isfile(fname):
+            run_pulse_files[ch].append(fname)
 
 f=mass.LJHFile(pulse_files[0])
 pkfilename0 = args["basename"]+"_%gx%g_%gsamples.preknowledge"%(f.number_of_columns, f.number_of_rows, f.nSamples)
@@ -213,6 +141,9 @@ print("Channels: %s"%chan_nums)
 print("Excluded Channels: %s"%exclude_channels)
 print("First pulse file: %s"%pulse_files[0])
 print("First noise file: %s"%noise_files[0])
+if args["extra_pulse_files"]:
+    print("Pulse runs: %d, channels missing from some runs: %s"%(1+len(args["extra_pulse_files"]),
+        [ch for (ch, fnames) in sorted(run_pulse_files.items()) if len(fnames) < 1+len(args["extra_pulse_files"])]))
 if not args["dont_popeonceafter"]:
     print("Will run popeonce after with this command:")
     print(popeoncecommand)
@@ -227,62 +158,128 @@ if not args["noprompt"]:
         print("aborting")
         sys.exit()
 
+def print_cut_stats(stats):
+    fracuncut = np.array([st["fracuncut"] for st in stats])
+    nuncut = np.array([st["nuncut"] for st in stats])
+    print("Mean fraction of uncut pulses: %0.3f"%np.mean(fracuncut))
+    print("Std deviation of fraction of uncut pulses: %0.3f"%np.std(fracuncut))
+    print("Mean number of uncut pulses: %0.1f"%np.mean(nuncut))
+    print("Channels with less than 90% of pulses uncut or less than 100 puluses uncut: ")
+    inds = np.where(np.logical_or(fracuncut<0.9, nuncut<100))[0]
+    s=""
+    for i in inds[np.argsort(fracuncut[inds])]:
+        st = stats[i]
+        s+="Ch %g: %g/%g=%0.2f, "%(st["channum"], st["nuncut"], st["npulses"], st["fracuncut"])
+    if not s=="": print(s[:-2])
+
 hdf5_filename = path.join(args["temp_out_dir"],"make_preknowledge_temp.hdf5")
 hdf5_noisefilename =  path.join(args["temp_out_dir"],"make_preknowledge_noise_temp.hdf5")
-if path.isfile(hdf5_filename):
-    os.remove(hdf5_filename)
-if path.isfile(hdf5_noisefilename):
-    os.remove(hdf5_noisefilename)
-data = mass.TESGroup(pulse_files, noise_files, hdf5_filename=hdf5_filename, hdf5_noisefilename=hdf5_noisefilename)
-# data.updater = mass.utilities.NullUpdater
-data.set_chan_good(data.why_chan_bad.keys())
-fracuncut = []
-nuncut = []
-chnums = []
-for ds in data:
-    peak_time_microsec = estimate_peak_time_microsec_ds(ds)
-    ds.peakindex1 = int(1e-6*peak_time_microsec/ds.timebase)+ds.nPresamples+1 # peak index from first 1 based index
-    ds.summarize_data(peak_time_microsec, forceNew=forceNew)
-    ds.usedcuts = calc_cuts_from_noise(ds,nsigma_max_deriv=nsigma_max_deriv, nsigma_pt_rms=nsigma_pt_rms)
-    ds.apply_cuts(ds.usedcuts, clear=True) # forceNew is true by default
-    fracuncut.append(ds.good().sum()/float(ds.nPulses))
-    nuncut.append(ds.good().sum())
-    chnums.append(ds.channum)
-
-print("Mean fraction of uncut pulses: %0.3f"%np.mean(fracuncut))
-print("Std deviation of fraction of uncut pulses: %0.3f"%np.std(fracuncut))
-print("Mean number of uncut pulses: %0.1f"%np.mean(nuncut))
-print("Channels with less than 90% of pulses uncut or less than 100 puluses uncut: ")
-inds = np.where(np.logical_or(np.array(fracuncut)<0.9, np.array(nuncut)<100))[0]
-indsall = np.arange(len(nuncut))
-s=""
-for i in inds[np.argsort(np.array(fracuncut)[inds])]:
-    ch = chnums[i]
-    ds = data.channel[ch]
-    npulses = ds.nPulses
-    s+="Ch %g: %g/%g=%0.2f, "%(ch, nuncut[i], npulses, fracuncut[i])
-if not s=="": print(s[:-2])
-# keepgoing = query_yes_no("Do these cut stats look ok?")
-# if not keepgoing:
-#     print("aborting")
-#     sys.exit()
-
-
-data.avg_pulses_auto_masks(forceNew=forceNew)  # creates masks and compute average pulses
-data.compute_filters(f_3db=args["f3db"], forceNew=forceNew)
-if args["apply_filters"]:
-    print("applying filters per command line argument")
-    data.filter_data()
-
-
-print("writing preknowledge file")
-write_preknowledge_data(pkfilename,data,exclude_channels)
-print("wrote: %s"%pkfilename)
+checkpoint_dir = args["checkpoint_dir"]
+if checkpoint_dir is None:
+    checkpoint_dir = path.join(args["temp_out_dir"],"make_preknowledge_checkpoints")
+serial = args["workers"] <= 1 or args["extra_pulse_files"]
+if serial:
+    # before the temporary files are touched, checkpoints are only valid if the files they describe still exist
+    checkpoints = {ch:ChannelCheckpoint(checkpoint_dir, ch, args["resume"], requires=[hdf5_filename, hdf5_noisefilename])
+        for ch in chan_nums}
+if not (serial and args["resume"]):
+    if path.isfile(hdf5_filename):
+        os.remove(hdf5_filename)
+    if path.isfile(hdf5_noisefilename):
+        os.remove(hdf5_noisefilename)
+if not serial:
+    # each channel's pipeline runs in a worker with its own temporary files, then we merge them in channel order
+    jobs = []
+    for (ch, pulse_file, noise_file) in zip(chan_nums, pulse_files, noise_files):
+        jobs.append(dict(pulse_file=pulse_file, noise_file=noise_file,
+            hdf5_filename=path.join(args["temp_out_dir"],"make_preknowledge_temp_chan%d.hdf5"%ch),
+            hdf5_noisefilename=path.join(args["temp_out_dir"],"make_preknowledge_noise_temp_chan%d.hdf5"%ch),
+            pk_filename=path.join(args["temp_out_dir"],"make_preknowledge_pk_temp_chan%d.hdf5"%ch),
+            nsigma_max_deriv=nsigma_max_deriv, nsigma_pt_rms=nsigma_pt_rms, f3db=args["f3db"],
+            apply_filters=args["apply_filters"], noise_streaming=args["streaming_noise_stats"],
+            noise_rtol=args["noise_stats_rtol"], peak_time_budget_s=args["peak_time_budget_s"],
+            channum=ch, checkpoint_dir=checkpoint_dir, resume=args["resume"],
+            noise_spectra=args["noise_analysis_file"] is not None))
+    print("processing %d channels with %d workers"%(len(jobs), args["workers"]))
+    pool = multiprocessing.Pool(args["workers"])
+    stats = pool.map(make_channel_preknowledge, jobs, chunksize=1)
+    pool.close()
+    pool.join()
+    print_cut_stats(stats)
+    noise_results = {st["channum"]:st.pop("noise_spectra") for st in stats if "noise_spectra" in st}
+    print("writing preknowledge file")
+    merge_hdf5_files(pkfilename, [job["pk_filename"] for job in jobs])
+    # with --resume the per channel files are kept, they hold the checkpointed stages
+    merge_hdf5_files(hdf5_filename, [job["hdf5_filename"] for job in jobs], remove_parts=not args["resume"])
+    merge_hdf5_files(hdf5_noisefilename, [job["hdf5_noisefilename"] for job in jobs], remove_parts=not args["resume"])
+    print("wrote: %s"%pkfilename)
+    if args["quality_report"]:
+        # reopen the merged temp files, mass loads the summaries, cuts and average pulses from them
+        data = mass.TESGroup(pulse_files, noise_files, hdf5_filename=hdf5_filename, hdf5_noisefilename=hdf5_noisefilename)
+        data.set_chan_good(data.why_chan_bad.keys())
+        for (ds, st) in zip(data, stats):
+            ds.usedcuts = mass.core.controller.AnalysisControl(**st["cuts"])
+else:
+    data = mass.TESGroup(pulse_files, noise_files, hdf5_filename=hdf5_filename, hdf5_noisefilename=hdf5_noisefilename)
+    # data.updater = mass.utilities.NullUpdater
+    data.set_chan_good(data.why_chan_bad.keys())
+    stats = []
+    for ds in data:
+        summarize_and_cut_ds(ds, nsigma_max_deriv, nsigma_pt_rms, forceNew=forceNew,
+            noise_streaming=args["streaming_noise_stats"], noise_rtol=args["noise_stats_rtol"],
+            peak_time_budget_s=args["peak_time_budget_s"], checkpoint=checkpoints[ds.channum],
+            noise_spectra=args["noise_analysis_file"] is not None)
+        stats.append(cut_stats_ds(ds))
+    if args["noise_analysis_file"] is not None:
+        noise_results = {ds.channum:ds.noise_spectra for ds in data}
+
+    def average_pulses(forceNew):
+        if not args["extra_pulse_files"]:
+            data.avg_pulses_auto_masks(forceNew=forceNew)  # creates masks and compute average pulses
+            return {}
+        # cut stats and average pulses over every run, from per run aggregates merged per channel
+        print("averaging pulses over %d runs with %d threads"%(1+len(args["extra_pulse_files"]), args["io_threads"]))
+        aggs = average_pulses_multirun({ds.channum:run_pulse_files[ds.channum] for ds in data},
+            {ds.channum:CutSet.from_analysis_control(ds.usedcuts) for ds in data},
+            {ds.channum:ds.peakindex1-1 for ds in data}, threads=args["io_threads"])
+        for ds in data:
+            ds.average_pulse[:] = aggs[ds.channum].average_pulse()
+        return {ch:agg.cut_stats() for (ch, agg) in aggs.items()}
+    outputs = run_group_stage(data, checkpoints, "average_pulse",
+        {ch:average_pulse_key(checkpoints[ch], run_pulse_files[ch][1:]) for ch in chan_nums}, average_pulses)
+    if args["extra_pulse_files"]:
+        for (ds, st) in zip(data, stats):
+            st.update(outputs[ds.channum])
+    print_cut_stats(stats)
+    # keepgoing = query_yes_no("Do these cut stats look ok?")
+    # if not keepgoing:
+    #     print("aborting")
+    #     sys.exit()
+
+
+    run_group_stage(data, checkpoints, "filter", {ch:filter_key(checkpoints[ch], args["f3db"]) for ch in chan_nums},
+        lambda forceNew: data.compute_filters(f_3db=args["f3db"], forceNew=forceNew), rerun_current=True)
+    if args["resume"]:
+        for ch in chan_nums:
+            print(checkpoints[ch].describe())
+    if args["apply_filters"]:
+        print("applying filters per command line argument")
+        data.filter_data()
+
+
+    print("writing preknowledge file")
+    write_preknowledge_data(pkfilename,data,exclude_channels)
+    print("wrote: %s"%pkfilename)
+
+if args["noise_analysis_file"] is not None:
+    write_noise_results(args["noise_analysis_file"], noise_results)
+    print("wrote: %s"%args["noise_analysis_file"])
 
 if args["quality_report"]:
     import quality_check
     print("writing quality report")
-    quality_check.write_pdf_report(data,pkfilename+"_quality.pdf",nsigma_pt_rms, nsigma_max_deriv,noise_files[0],pulse_files[0])
+    quality_check.write_pdf_report(data,pkfilename+"_quality.pdf",nsigma_pt_rms, nsigma_max_deriv,noise_files[0],pulse_files[0],
+        workers=args["workers"], cache_dir=args["report_cache_dir"])
     print("done writing quality report")
 
 
@@ -0,0 +1,164 @@
+# Cheap live metrics for the listener pipeline, so an operator can see which stage is falling
+# behind. Everything is counted per batch, never per record, into arrays allocated up front:
+# stage durations go into fixed size rings (for percentiles over the recent past) plus running
+# totals, per channel counts into arrays indexed by channel number. `snapshot()` turns them into a
+# plain dict with rates since the previous snapshot, for the GUI overlay or `SnapshotWriter`.
+
+import json
+import threading
+import time
+import numpy as np
+
+STAGES = ["decode", "cut", "calibrate", "histogram", "render"]
+
+
+class StageTimer():
+    """
+    StageTimer(nrecent=1024)
+    Durations of one pipeline stage: `count`, `total_s` and `max_s` over the whole run, and the last `nrecent`
+    durations in a ring for percentiles.
+    """
+    def __init__(self, nrecent=1024):
+        self.recent = np.zeros(nrecent)
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    def add(self, dt):
+        self.recent[self.count%len(self.recent)] = dt
+        self.count += 1
+        self.total_s += dt
+        if dt > self.max_s:
+            self.max_s = dt
+
+    def summary(self):
+        recent = self.recent[:min(self.count, len(self.recent))]
+        if len(recent) == 0:
+            p50 = p99 = 0.0
+        else:
+            p50, p99 = np.percentile(recent, [50, 99])
+        return dict(count=self.count, total_s=self.total_s, p50_us=1e6*p50, p99_us=1e6*p99, max_us=1e6*self.max_s)
+
+
+class PipelineMetrics():
+    """
+    PipelineMetrics(maxchannel=1023, nrecent=1024)
+    Counters for the listener pipeline. Updated once per batch with `add_batch`, and by the GUI with `add_render`.
+    All methods take an internal lock, so the receiver thread and the GUI thread can both use one instance.
+    Channels above `maxchannel` grow the per channel arrays.
+    """
+    def __init__(self, maxchannel=1023, nrecent=1024):
+        self.lock = threading.Lock()
+        self.stages = {name:StageTimer(nrecent) for name in STAGES}
+        self.nrecords_channel = np.zeros(maxchannel+1, dtype=np.int64)
+        self.nused_channel = np.zeros(maxchannel+1, dtype=np.int64)
+        self.ncut_by = {} # cut name -> records failing that cut, a record failing two cuts counts for both
+        self.nmessages = 0
+        self.messages_per_wake = 0
+        self.max_messages_per_wake = 0
+        self.tstart = time.time()
+        self._last = None # (time, nrecords_channel copy, nused total) at the previous snapshot
+
+    def _grow(self, ch):
+        n = max(ch+1, 2*len(self.nrecords_channel))
+        for name in ["nrecords_channel", "nused_channel"]:
+            old = getattr(self, name)
+            new = np.zeros(n, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add_batch(self, timings, chans, nrecords, nused, ncut_by, nmessages=0, messages_per_wake=None):
+        """
+        Record one batch: `timings` a dict of stage -> seconds, `chans`, `nrecords` and `nused` equal length
+        sequences of channel number and that channel's records received and used, `ncut_by` a dict of cut name ->
+        records failing it, `nmessages` received and `messages_per_wake` the messages the receiver drained when it
+        last woke up.
+        """
+        with self.lock:
+            for (stage, dt) in timings.items():
+                self.stages[stage].add(dt)
+            if len(chans) > 0:
+                chans = np.asarray(chans)
+                if chans.max() >= len(self.nrecords_channel):
+                    self._grow(int(chans.max()))
+                self.nrecords_channel[chans] += nrecords
+                self.nused_channel[chans] += nused
+            for (name, n) in ncut_by.items():
+                self.ncut_by[name] = self.ncut_by.get(name, 0)+int(n)
+            self.nmessages += nmessages
+            if messages_per_wake is not None:
+                self.messages_per_wake = messages_per_wake
+                self.max_messages_per_wake = max(self.max_messages_per_wake, messages_per_wake)
+
+    def add_render(self, dt):
+        with self.lock:
+            self.stages["render"].add(dt)
+
+    def snapshot(self):
+        """
+        Return a dict of everything, with `rate_hz` (records/s overall), `used_rate_hz` and `channel_rate_hz`
+        (records/s for each channel that had any) measured since the previous call to `snapshot`.
+        """
+        with self.lock:
+            t = time.time()
+            nrecords = int(self.nrecords_channel.sum())
+            nused = int(self.nused_channel.sum())
+            if self._last is None:
+                t0, nrecords_channel0, nused0 = self.tstart, np.zeros_like(self.nrecords_channel), 0
+            else:
+                t0, nrecords_channel0, nused0 = self._last
+                if len(nrecords_channel0) < len(self.nrecords_channel):
+                    nrecords_channel0 = np.hstack((nrecords_channel0, np.zeros(len(self.nrecords_channel)-len(nrecords_channel0), dtype=np.int64)))
+            dt = max(t-t0, 1e-9)
+            dchannel = self.nrecords_channel-nrecords_channel0
+            active = np.nonzero(dchannel)[0]
+            self._last = (t, self.nrecords_channel.copy(), nused)
+            return dict(
+                time=t,
+                uptime_s=t-self.tstart,
+                nmessages=self.nmessages,
+                nrecords=nrecords,
+                nused=nused,
+                fraction_cut=1-nused/float(nrecords) if nrecords > 0 else 0.0,
+                fraction_cut_by={name:n/float(nrecords) if nrecords > 0 else 0.0 for (name, n) in self.ncut_by.items()},
+                rate_hz=dchannel.sum()/dt,
+                used_rate_hz=(nused-nused0)/dt,
+                channel_rate_hz={int(ch):dchannel[ch]/dt for ch in active},
+                messages_per_wake=self.messages_per_wake,
+                max_messages_per_wake=self.max_messages_per_wake,
+                stages={name:timer.summary() for (name, timer) in self.stages.items()},
+            )
+
+
+def format_snapshot(snap, nchannels=3):
+    """Return a few lines of text summarizing `snap` from `PipelineMetrics.snapshot`, for a GUI overlay or a log."""
+    lines = ["%0.0f records/s (%0.0f used), %d messages/wake (max %d)"%(snap["rate_hz"], snap["used_rate_hz"],
+        snap["messages_per_wake"], snap["max_messages_per_wake"])]
+    lines.append("cut %0.1f%%: "%(100*snap["fraction_cut"])+", ".join("%s %0.1f%%"%(name, 100*f) for (name, f) in sorted(snap["fraction_cut_by"].items())))
+    for name in STAGES:
+        s = snap["stages"][name]
+        lines.append("%-9s p50 %6.0f us  p99 %6.0f us  max %6.0f us"%(name, s["p50_us"], s["p99_us"], s["max_us"]))
+    busiest = sorted(snap["channel_rate_hz"].items(), key=lambda x:-x[1])[:nchannels]
+    if busiest:
+        lines.append("busiest channels: "+", ".join("%d %0.0f/s"%(ch, r) for (ch, r) in busiest))
+    return "\n".join(lines)
+
+
+class SnapshotWriter():
+    """
+    SnapshotWriter(filename, period_s=10.0)
+    Appends a metrics snapshot as one json line to `filename` whenever `maybe_write` is called and at least
+    `period_s` seconds have passed since the last one.
+    """
+    def __init__(self, filename, period_s=10.0):
+        self.filename = filename
+        self.period_s = period_s
+        self.tlast = 0.0
+
+    def maybe_write(self, snap):
+        if snap["time"]-self.tlast < self.period_s:
+            return False
+        self.tlast = snap["time"]
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(snap, sort_keys=True)+"\n")
+        return True
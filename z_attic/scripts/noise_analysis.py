@@ -0,0 +1,149 @@
+# Noise autocorrelation and power spectral density in numpy, with the same definitions as
+# compute_autocorr and compute_psd in src/NoiseAnalysis.jl and the defaults of scripts/noise_analysis.jl,
+# so make_preknowledge.py can characterize the noise in the same pass over each noise file that
+# calc_cuts_from_noise makes. Those functions treat the records of a noise file as one continuous
+# stream of samples; NoiseSpectra takes the stream a segment of records at a time, keeping only the
+# samples a later autocorrelation chunk or PSD segment still needs, and does the FFTs of every chunk or
+# segment that is complete in one batched call. Results are written in the `<channum>/noise` layout of
+# NoiseAnalysis.hdf5save.
+
+import numpy as np
+import h5py
+import ljh
+
+
+def round_up_dft_length(n):
+    """A length at least `n` convenient for a DFT, (1, 3 or 5) times a power of 2, like round_up_dft_length in NoiseAnalysis.jl."""
+    pow2 = 2**int(np.ceil(np.log2(n)))
+    if n > 0.75*pow2:
+        return pow2
+    elif n > 0.625*pow2:
+        return int(round(0.75*pow2))
+    return int(round(0.625*pow2))
+
+
+def hann(n):
+    """The Hann window of NoiseAnalysis.jl, which is twice the usual one, it gets normalized anyway."""
+    return 1-np.cos(2*np.pi*np.arange(n)/(n-1))
+
+
+def psd_freq(nfreq, dt):
+    return np.linspace(0, 0.5/dt, nfreq)
+
+
+class NoiseSpectra():
+    """
+    NoiseSpectra(nsamples_total, frametime, nlags, nfreq, chunk_multiple=7, max_exc=1000, source="")
+    Accumulate the autocorrelation at lags `0:nlags` and the power spectral density at `nfreq` frequencies of a
+    stream of `nsamples_total` noise samples, fed in order with `add(samples)`, any shape, one or more records at a
+    time. Samples past `nsamples_total` are ignored. `result()` returns a dict with the datasets of
+    NoiseAnalysis.hdf5save: `autocorr`, `powerspectrum`, `samplesused`, `freqstep` and `source`.
+    The autocorrelation is averaged over chunks of `nlags*chunk_multiple` samples, leaving out chunks whose extreme
+    deviates from the chunk mean by more than `max_exc`, the PSD over Hann windowed segments of `2(nfreq-1)` samples
+    spread over the whole stream, like compute_autocorr and compute_psd.
+    """
+    def __init__(self, nsamples_total, frametime, nlags, nfreq, chunk_multiple=7, max_exc=1000, source=""):
+        self.ntotal = nsamples_total
+        self.frametime = frametime
+        self.nlags = nlags
+        self.nfreq = nfreq
+        self.max_exc = max_exc
+        self.source = source
+        self.m = nlags*chunk_multiple
+        if self.ntotal//self.m < 1:
+            raise ValueError("%d noise samples is less than one autocorrelation chunk of %d"%(self.ntotal, self.m))
+        self.m_padded = round_up_dft_length(self.m+nlags)
+        self.nsamp = 2*(nfreq-1)
+        if self.ntotal < self.nsamp:
+            raise ValueError("%d noise samples is less than one PSD segment of 2(nfreq-1) = %d"%(self.ntotal, self.nsamp))
+        self.npsd = int(np.ceil(self.ntotal/float(self.nsamp)))
+        self.psd_step = (self.ntotal+1-self.nsamp)//(self.npsd-1) if self.npsd > 1 else 1
+        window = hann(self.nsamp)
+        self.window = window/np.sqrt(np.sum(window**2))
+        self.ac_sum = np.zeros(nlags)
+        self.nchunks = 0 # complete autocorrelation chunks seen
+        self.nchunks_used = 0
+        self.psd_sum = np.zeros(nfreq)
+        self.nsegments = 0 # PSD segments done
+        self.buf = np.zeros(0)
+        self.bufstart = 0 # stream index of buf[0]
+        self.nseen = 0
+        self.vmin, self.vmax = np.inf, -np.inf
+
+    def add(self, samples):
+        x = np.asarray(samples).ravel()[:max(self.ntotal-self.nseen, 0)]
+        if len(x) == 0:
+            return
+        self.vmin, self.vmax = min(self.vmin, x.min()), max(self.vmax, x.max())
+        self.nseen += len(x)
+        self.buf = np.concatenate([self.buf, x.astype(np.float64)])
+        self._autocorr()
+        self._psd()
+        keep = min(self.nchunks*self.m, self.nsegments*self.psd_step)-self.bufstart
+        self.buf = self.buf[keep:]
+        self.bufstart += keep
+
+    def _autocorr(self):
+        nchunks = min(self.nseen, (self.ntotal//self.m)*self.m)//self.m
+        if nchunks == self.nchunks:
+            return
+        a = self.nchunks*self.m-self.bufstart
+        chunks = self.buf[a:a+(nchunks-self.nchunks)*self.m].reshape(-1, self.m)
+        chunks = chunks-chunks.mean(axis=1)[:,None]
+        chunks = chunks[np.abs(chunks).max(axis=1) <= self.max_exc]
+        if len(chunks) > 0:
+            r = np.fft.rfft(chunks, n=self.m_padded, axis=1)
+            self.ac_sum += np.fft.irfft(np.abs(r)**2, n=self.m_padded, axis=1)[:,:self.nlags].sum(axis=0)
+        self.nchunks_used += len(chunks)
+        self.nchunks = nchunks
+
+    def _psd(self):
+        starts = self.psd_step*np.arange(self.nsegments, self.npsd)
+        starts = starts[starts+self.nsamp <= self.nseen]
+        if len(starts) == 0:
+            return
+        segs = self.buf[(starts-self.bufstart)[:,None]+np.arange(self.nsamp)]
+        segs = self.window*(segs-segs.mean(axis=1)[:,None])
+        self.psd_sum += (np.abs(np.fft.rfft(segs, axis=1))**2).sum(axis=0)
+        self.nsegments += len(starts)
+
+    def result(self):
+        if self.nseen < self.ntotal:
+            raise ValueError("only %d of %d noise samples were added"%(self.nseen, self.ntotal))
+        if self.vmin == self.vmax:
+            raise ValueError("noise samples are all the same value %g for %s"%(self.vmin, self.source))
+        if self.nchunks_used == 0:
+            raise ValueError("all autocorrelation chunks excluded by max excursion for %s"%self.source)
+        autocorr = self.ac_sum/self.nchunks_used/(self.m-np.arange(self.nlags))
+        freq = psd_freq(self.nfreq, self.frametime)
+        return dict(autocorr=autocorr, powerspectrum=self.psd_sum*2*self.frametime/self.npsd,
+            samplesused=int(self.ntotal), freqstep=float(freq[1]-freq[0]), source=self.source)
+
+
+def noise_spectra_for_file(filename, nlags=0, nfreq=0, max_samples=50000000, max_exc=1000):
+    """
+    Return a `NoiseSpectra` for the LJH 2.x noise file `filename` and the number of its records it uses, with the defaults
+    of analyze_one_file in scripts/noise_analysis.jl: `nlags` 0 means the record length, `nfreq` 0 means
+    `round_up_dft_length(nsamples//2)+1`, and only whole records within the first `max_samples` samples are used.
+    """
+    f = ljh.LJHFile(filename)
+    nrecords = len(f)
+    if f.nsamples*nrecords > max_samples:
+        nrecords = max_samples//f.nsamples
+    nlags = nlags if nlags > 0 else f.nsamples
+    nfreq = nfreq if nfreq > 0 else round_up_dft_length(f.nsamples//2)+1
+    return NoiseSpectra(nrecords*f.nsamples, f.frametime, nlags, nfreq, max_exc=max_exc, source=filename), nrecords
+
+
+def write_noise_results(filename, results):
+    """
+    Write `results`, a dict of channel number -> `NoiseSpectra.result()`, to `filename` in the layout of
+    NoiseAnalysis.hdf5save, `<channum>/noise/{samplesused,freqstep,autocorr,powerspectrum,source}`. There is no ARMA
+    fit here, so NoiseAnalysis.hdf5load, which also reads `ARMAModel`, can't load these groups until one is added.
+    """
+    with h5py.File(filename, "w") as h5:
+        for (ch, result) in sorted(results.items()):
+            g = h5.require_group("%d/noise"%ch)
+            for name in ["samplesused", "freqstep", "autocorr", "powerspectrum", "source"]:
+                g[name] = result[name]
+    return filename
@@ -0,0 +1,146 @@
+# Lazy access to the hdf5 files Pope writes (`chanN/filt_value`, `chanN/pretrig_rms`, ... as one 1d
+# dataset per MassCompatibleDataProductFeb2017 field, plus `chanN/calculated_cuts`). Nothing is read
+# until it is asked for, and `iter_chunks` hands out one bounded block of records at a time, so cuts,
+# calibration and histogramming can stream over a multi day, 240 channel file in constant memory.
+
+import numpy as np
+import h5py
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from cuts import CutSet
+
+
+class PopeChannel():
+    """
+    PopeChannel(group, channum, chunksize=2**16)
+    One channel of a Pope hdf5 file. `channel[field]` is the h5py dataset for a dataproduct field, which
+    reads only the slices you index. `iter_chunks` yields consecutive record arrays of at most `chunksize`
+    records with just the fields asked for.
+    """
+    def __init__(self, group, channum, chunksize=2**16):
+        self.group = group
+        self.channum = channum
+        self.chunksize = chunksize
+        self.fields = [name for name in dtype_MassCompatibleDataProductFeb2017.names if name in group]
+
+    def __repr__(self):
+        return "PopeChannel(chan%d, %d records)"%(self.channum, len(self))
+
+    def __getitem__(self, field):
+        return self.group[field]
+
+    def __len__(self):
+        # datasets are appended to one at a time while Pope is running, only records in all of them are complete
+        return min(self.group[field].shape[0] for field in self.fields) if self.fields else 0
+
+    def cuts(self):
+        """Return the `CutSet` Pope used for this channel, from `calculated_cuts`."""
+        return CutSet.from_channel_group(self.group)
+
+    def iter_chunks(self, fields=None, chunksize=None, start=0, stop=None):
+        """
+        Yield `(first, end, records)` for records `start` to `stop` (default all complete records) in blocks of
+        `chunksize`, where `records` is a structured array with the dataproduct dtype restricted to `fields`
+        (default all). Each block is read with one hdf5 slice per field into a buffer that is reused, so copy
+        anything you keep.
+        """
+        fields = self.fields if fields is None else list(fields)
+        chunksize = self.chunksize if chunksize is None else chunksize
+        stop = len(self) if stop is None else min(stop, len(self))
+        dtype = np.dtype([(name, dtype_MassCompatibleDataProductFeb2017[name]) for name in fields])
+        buf = np.zeros(chunksize, dtype)
+        column = {name:np.zeros(chunksize, dtype[name]) for name in fields}
+        for first in range(start, stop, chunksize):
+            end = min(first+chunksize, stop)
+            n = end-first
+            for name in fields:
+                self.group[name].read_direct(column[name], np.s_[first:end], np.s_[0:n])
+                buf[name][:n] = column[name][:n]
+            yield first, end, buf[:n]
+
+
+class PopeFile():
+    """
+    PopeFile(filename, chunksize=2**16, swmr=False)
+    Open a Pope hdf5 output file read only, without reading any data. `channels` maps channel number to
+    `PopeChannel`, in channel order. Pass `swmr=True` to read a file Pope is still writing.
+    """
+    def __init__(self, filename, chunksize=2**16, swmr=False):
+        self.filename = filename
+        self.h5 = h5py.File(filename, "r", swmr=swmr)
+        self.attrs = dict(self.h5.attrs)
+        self.channels = {}
+        for name in sorted((k for k in self.h5.keys() if k.startswith("chan")), key=lambda k:int(k[4:])):
+            channum = int(name[4:])
+            self.channels[channum] = PopeChannel(self.h5[name], channum, chunksize)
+
+    def __iter__(self):
+        return iter(self.channels.values())
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, channum):
+        return self.channels[channum]
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def reduce_channel(channel, reducers, cuts=None, calibration=None, chunksize=None, field="filt_value"):
+    """
+    Stream over `channel` (a `PopeChannel`) one chunk at a time: drop records cut by `cuts` (a `CutSet`,
+    default the channel's own `calculated_cuts`), apply `calibration` to `field` (anything that maps an array
+    to an array, like `calibration.CalibrationTable`; default leave `field` as it is), and pass the result to
+    `reducer.add(values)` for each of `reducers`, eg a `histogram.UniformHistogram` or a
+    `robust_stats.QuantileSketch`. Only the fields the cuts and `field` need are read.
+    Returns `(nrecords, ngood)`.
+    """
+    cuts = channel.cuts() if cuts is None else cuts
+    fields = sorted(set(cuts.fields+[field]))
+    nrecords = ngood = 0
+    for (first, end, records) in channel.iter_chunks(fields, chunksize):
+        good = cuts.good(records)
+        values = records[field][good]
+        if calibration is not None:
+            values = calibration(values)
+        for reducer in reducers:
+            reducer.add(values)
+        nrecords += len(records)
+        ngood += len(values)
+    return nrecords, ngood
+
+
+def stream_spectra(filename, bin_edges, calibrations=None, cuts=None, chunksize=2**16, field="filt_value"):
+    """
+    Return `(spectra, summary)` for the Pope hdf5 file `filename`. `spectra` is a `histogram.Spectra` with
+    a coadded and a per channel histogram over `bin_edges` of calibrated `field` of records that pass cuts,
+    `summary` maps channel number to `(nrecords, ngood)`. `calibrations` and `cuts` are optional dicts keyed
+    by channel number, channels not in them use no calibration and their own `calculated_cuts`. Memory use
+    is bounded by `chunksize` and the histograms, not by the length of the file.
+    """
+    from histogram import Spectra
+    spectra = Spectra.from_edges(bin_edges)
+    summary = {}
+    with PopeFile(filename, chunksize) as pope:
+        for channel in pope:
+            ch = channel.channum
+            cal = None if calibrations is None else calibrations.get(ch, None)
+            cutset = None if cuts is None else cuts.get(ch, None)
+            summary[ch] = reduce_channel(channel, [_SpectraReducer(spectra, ch)], cutset, cal, field=field)
+    return spectra, summary
+
+
+class _SpectraReducer():
+    # adapt Spectra.add(ch, values) to the reducer.add(values) interface of reduce_channel
+    def __init__(self, spectra, ch):
+        self.spectra = spectra
+        self.ch = ch
+
+    def add(self, values):
+        self.spectra.add(self.ch, values, t=0)
@@ -0,0 +1,398 @@
+# The per channel steps of make_preknowledge.py, kept in their own module so they can run in
+# worker processes (see make_channel_preknowledge) as well as in the serial loop of the script.
+import os
+import time
+from os import path
+import mass
+import numpy as np
+import h5py
+from cuts import CutSet
+from robust_stats import QuantileSketch, ConvergenceCheck
+from checkpoint import ChannelCheckpoint, stage_key
+from preknowledge_format import write_values, write_grouped
+from noise_analysis import noise_spectra_for_file
+import ljh
+
+def estimate_peak_index_ds(ds):
+    first, end, data = ds.pulse_records.datafile.read_segment(0)
+    peakinds = data.argmax(axis=1)
+    peakind = np.argmax(np.bincount(peakinds)) # find the mode peak index (most frequent peak index)
+    mad = np.median(np.abs(peakinds-peakind))
+    return peakind, mad
+
+def estimate_peak_index_sampled(ljhfile, time_budget_s=0.2, max_records=4096, nstrata=16, batchsize=64, npilot=64, halfwidth=None, seed=0):
+    """
+    estimate_peak_index_sampled(ljhfile, time_budget_s=0.2)
+    Estimate the mode peak index of the records in `ljhfile` (an `ljh.LJHFile`) from a random sample
+    spread over the whole file, rather than from the first segment. The file is split into `nstrata`
+    equal strata and each batch draws records evenly from all of them, so every part of the run is
+    represented even if we stop early. The first `npilot` records are scanned from the end of the
+    pretrigger to the end of the record to find a rough peak; later records only look at
+    `+/- halfwidth` samples around it (default a quarter of the post trigger length). Stops after
+    `max_records` records or once `time_budget_s` has passed, whichever comes first, so the cost does
+    not depend on the file size. Only the sampled records are read, through the memory map.
+    Returns a dict with `peakind` (the mode), `mad` (median absolute deviation from the mode),
+    `confidence` (fraction of strata whose own mode is within `max(1,2*mad)` of `peakind`),
+    `nrecords` sampled and `elapsed_s`.
+    """
+    tstart = time.time()
+    nrec = len(ljhfile)
+    if nrec == 0:
+        raise ValueError("%s has no records"%ljhfile.filename)
+    samples = ljhfile.samples
+    rng = np.random.RandomState(seed)
+    nstrata = min(nstrata, nrec)
+    edges = np.linspace(0, nrec, nstrata+1).astype(np.int64)
+    lo, hi = ljhfile.npresamples, ljhfile.nsamples
+    peakinds = []
+    strata = []
+    n = 0
+    nmax = min(max_records, nrec)
+    while n < nmax:
+        perstratum = max(1, min(batchsize, nmax-n)//nstrata)
+        s = np.repeat(np.arange(nstrata), perstratum)
+        if len(s) > nmax-n: # fewer records left than strata, the last round takes them from random strata
+            s = np.sort(rng.permutation(s)[:nmax-n])
+        inds = edges[s]+(rng.random_sample(len(s))*(edges[s+1]-edges[s])).astype(np.int64)
+        order = np.argsort(inds) # read in file order
+        inds, s = inds[order], s[order]
+        peakinds.append(lo+samples[inds, lo:hi].argmax(axis=1))
+        strata.append(s)
+        n += len(inds)
+        if n >= npilot and hi-lo == ljhfile.nsamples-ljhfile.npresamples:
+            pilot = np.concatenate(peakinds)
+            rough = np.argmax(np.bincount(pilot))
+            w = halfwidth if halfwidth is not None else max(2, (ljhfile.nsamples-ljhfile.npresamples)//4)
+            lo, hi = max(ljhfile.npresamples, rough-w), min(ljhfile.nsamples, rough+w+1)
+        if time.time()-tstart > time_budget_s:
+            break
+    peakinds = np.concatenate(peakinds)
+    strata = np.concatenate(strata)
+    peakind = np.argmax(np.bincount(peakinds))
+    mad = np.median(np.abs(peakinds-peakind))
+    agree = [abs(np.argmax(np.bincount(peakinds[strata==k]))-peakind) <= max(1,2*mad)
+        for k in range(nstrata) if np.any(strata==k)]
+    return dict(peakind=int(peakind), mad=float(mad), confidence=float(np.mean(agree)),
+        nrecords=len(peakinds), elapsed_s=time.time()-tstart)
+
+def estimate_peak_time_microsec_ds(ds, time_budget_s=None):
+    """
+    Return the time after the trigger, in microseconds, that `summarize_data` should use as the peak.
+    If `time_budget_s` is given use `estimate_peak_index_sampled` on the pulse file with that budget,
+    otherwise `estimate_peak_index_ds`.
+    """
+    if time_budget_s is None:
+        peakind_abs, mad = estimate_peak_index_ds(ds)
+    else:
+        est = estimate_peak_index_sampled(ljh.LJHFile(ds.pulse_records.datafile.filename), time_budget_s)
+        if est["confidence"] < 0.5:
+            print("chan %d: peak index estimate %d has low confidence %0.2f (mad %g from %d records)"%(
+                ds.channum, est["peakind"], est["confidence"], est["mad"], est["nrecords"]))
+        peakind_abs, mad = est["peakind"], est["mad"]
+    peakind_rel = peakind_abs-ds.nPresamples
+    # add the median absolute deviation (or 1) to the peakind to avoid cutting low energy pulses that peak earlier
+    peakind = peakind_rel+max(1,mad)
+    return peakind*ds.timebase*1e6
+
+def calc_cuts_from_noise(self, nsigma_max_deriv=7, nsigma_pt_rms=7, streaming=False, rel_error=1e-3, rtol=None, noise_spectra=None):
+    """
+    calc_cuts_from_noise(self, nsigma=7)
+    Use noise files to calculate ranges that encompass nsigma sigmas worth of deviation in the
+    pretrigger mean and max deriv. Uses median absolute deviation to be robust to outliers.
+    If `streaming`, fold each noise segment into a `robust_stats.QuantileSketch` instead of keeping
+    every value, so memory does not grow with the file and the median is within `rel_error` (relative)
+    of the exact one, the MAD within twice that of the median plus the MAD. With `rtol` also set, stop reading noise once both cut
+    limits have changed by less than `rtol` (relative) for two segments in a row.
+    With a `noise_analysis.NoiseSpectra` as `noise_spectra`, every noise segment read is also added to it, so the
+    autocorrelation and PSD come from the same pass; it is fed the rest of the file if the cut limits converge early.
+    return a mass.core.controller.AnalysisControl() object with cuts defined for pretrigger_rms and postpeak_deriv
+    """
+    # for gausssian distributed data sigma = 1.4826*median_absolute_deviation
+    # so if we want 5 sigma deviation, we want 5*1.4826*mad
+    nmad_max_deriv = nsigma_max_deriv*1.4826
+    nmad_pt_rms    = nsigma_pt_rms*1.4826
+
+    if streaming:
+        md_sketch = QuantileSketch(rel_error)
+        pt_sketch = QuantileSketch(rel_error)
+        convergence = ConvergenceCheck(rtol) if rtol is not None else None
+        # segments are views into the memory mapped noise file, so nothing but the sketches grows with the file
+        noise_file = ljh.LJHFile(self.noise_records.datafile.filename)
+        nread = 0 # records folded into the sketches, the rest of the file only goes to noise_spectra
+        for _first_pnum, _end_pnum, _seg_num, data_seg in noise_file.iter_segments():
+            nread = _end_pnum
+            if noise_spectra is not None:
+                noise_spectra.add(data_seg)
+            md_sketch.add(mass.analysis_algorithms.compute_max_deriv(data_seg,ignore_leading=0))
+            pt_sketch.add(data_seg[:,:self.nPresamples].std(axis=1))
+            if convergence is not None:
+                md_med = md_sketch.median()
+                pt_med = pt_sketch.median()
+                limits = [md_med+md_sketch.mad(md_med)*nmad_max_deriv, pt_med+pt_sketch.mad(pt_med)*nmad_pt_rms]
+                if convergence.update(limits):
+                    break
+        if noise_spectra is not None:
+            for _first_pnum, _end_pnum, _seg_num, data_seg in noise_file.iter_segments(first=nread):
+                noise_spectra.add(data_seg)
+        md_med = md_sketch.median()
+        md_mad = md_sketch.mad(md_med)
+        pt_med = pt_sketch.median()
+        pt_mad = pt_sketch.mad(pt_med)
+    else:
+        max_deriv = np.zeros(self.noise_records.nPulses)
+        pretrigger_rms = np.zeros(self.noise_records.nPulses)
+        for _first_pnum, _end_pnum, _seg_num, data_seg in self.noise_records.datafile.iter_segments():
+            if noise_spectra is not None:
+                noise_spectra.add(data_seg)
+            max_deriv[_first_pnum:_end_pnum]=mass.analysis_algorithms.compute_max_deriv(data_seg,ignore_leading=0)
+            pretrigger_rms[_first_pnum:_end_pnum]=data_seg[:,:self.nPresamples].std(axis=1)
+
+        md_med = np.median(max_deriv)
+        md_mad = np.median(np.abs(max_deriv-md_med))
+        pt_med = np.median(pretrigger_rms)
+        pt_mad = np.median(np.abs(pretrigger_rms-pt_med))
+    # md_min = max(0.0,md_med-md_mad*nmad_max_deriv)
+    md_min = -np.inf
+    md_max = md_med+md_mad*nmad_max_deriv
+    # pt_min = pt_med-pt_mad*nmad_pt_rms
+    pt_min = 0.0 # lower limit on pretrigger mean is not normally used, and when I tried I found many channels failing with lots cut due to this. I guess the noise had reduced over time.
+    pt_max = max(0.0,pt_med+pt_mad*nmad_pt_rms)
+
+    cuts = mass.core.controller.AnalysisControl(
+        pretrigger_rms=(pt_min, pt_max),
+        postpeak_deriv=(md_min, md_max),
+    )
+    return cuts
+
+def write_preknowledge_data(filename,data,exclude_channels):
+    """
+    Write the preknowledge of every channel in `data` to `filename` in the grouped layout Pope reads. Python
+    consumers that open it often can convert it to the packed layout with `preknowledge_format.py`.
+    """
+    return write_grouped(filename, {ds.channum:preknowledge_values_ds(ds) for ds in data})
+
+def write_preknowledge_ds(g,ds):
+    write_values(g, preknowledge_values_ds(ds))
+
+def preknowledge_values_ds(ds):
+    """Return the preknowledge of `ds` as a dict of path within its chanN group -> value."""
+    v = {}
+    # v["physical/x_um_from_array_center"]=0
+    # v["physical/y_um_from_array_center"]=0
+    # v["physical/collimator open area"]=0
+    v["physical/frametime"]=ds.timebase
+    v["physical/number_of_rows"]=ds.number_of_rows
+    v["physical/number_of_columns"]=ds.number_of_columns
+
+    v["trigger/nsamples"]=ds.nSamples
+    v["trigger/npresamples"]=ds.nPresamples
+    # v["trigger/avoid_edge"]=True
+    # v["trigger/type"]="edge"
+    # v["trigger/level_specify_units_in_name"]=0.1
+
+    v["filter/data_file_used_to_generate_filters"]=ds.filename
+    v["filter/values"] = ds.filter.filt_noconst
+    v["filter/values_at"] = ds.filter.filt_aterms.reshape((-1,))
+    if ds.filter.f_3db is None:
+        v["filter/f3db"] = 100000000.0 # its none, want a float, justmake it obviously odd
+    else:
+        v["filter/f3db"] = ds.filter.f_3db
+    v["filter/average_pulse"] = ds.filter.avg_signal
+    # v["filter/average_pulse_energy_eV"]=5989.0
+    v["filter/description"] = "noconst"
+    v["filter/shift_threshold"] = int(round(4.3*np.median(ds.p_pretrig_rms[ds.good()])))
+
+    v["summarize/peak_index"]=ds.peakindex1
+
+    # via CutSet, so the listeners evaluate exactly the cuts that were applied here
+    cuts = CutSet.from_analysis_control(ds.usedcuts)
+    for (name, (lo, hi)) in zip(cuts.names, cuts.limits):
+        v["cuts/"+name] = np.array([lo, hi])
+
+    v["analysis_type"]="mass compatible feb 2017"
+    return v
+
+def summarize_and_cut_ds(ds, nsigma_max_deriv, nsigma_pt_rms, forceNew=True, noise_streaming=False, noise_rtol=None, peak_time_budget_s=None, checkpoint=None, noise_spectra=False):
+    """
+    The per channel steps before average pulses: estimate the peak index, summarize, calculate cuts
+    from noise with `calc_cuts_from_noise` and apply them. Sets `ds.peakindex1` and `ds.usedcuts`.
+    `noise_streaming` and `noise_rtol` are passed to `calc_cuts_from_noise` as `streaming` and `rtol`,
+    `peak_time_budget_s` to `estimate_peak_time_microsec_ds` as `time_budget_s`.
+    With a `checkpoint.ChannelCheckpoint` as `checkpoint`, the summarize stage (peak index and summarize_data)
+    and the cuts stage are skipped if it holds them for the same input files and parameters, the summaries
+    are then already in the channel's hdf5 file. Completed stages are recorded in it.
+    With `noise_spectra`, also set `ds.noise_spectra` to the `noise_analysis.NoiseSpectra` result of the noise file,
+    computed in the pass that calculates the cuts, or in a pass of its own if the cuts stage was checkpointed and the
+    noise_spectra stage was not.
+    """
+    done = None
+    if checkpoint is not None:
+        summarize_key = stage_key("summarize", [ds.filename], dict(peak_time_budget_s=peak_time_budget_s))
+        done = checkpoint.get("summarize", summarize_key)
+    if done is None:
+        peak_time_microsec = estimate_peak_time_microsec_ds(ds, peak_time_budget_s)
+        ds.peakindex1 = int(1e-6*peak_time_microsec/ds.timebase)+ds.nPresamples+1 # peak index from first 1 based index
+        ds.summarize_data(peak_time_microsec, forceNew=forceNew)
+        if checkpoint is not None:
+            checkpoint.put("summarize", summarize_key, dict(peak_time_microsec=peak_time_microsec, peakindex1=ds.peakindex1))
+    else:
+        ds.peakindex1 = done["peakindex1"]
+        ds.summarize_data(done["peak_time_microsec"], forceNew=False) # mass finds the summaries in the hdf5 file and skips
+    spectra = None
+    if noise_spectra:
+        done = None
+        if checkpoint is not None:
+            spectra_key = stage_key("noise_spectra", [ds.noise_records.datafile.filename])
+            done = checkpoint.get("noise_spectra", spectra_key)
+        if done is None:
+            spectra, _ = noise_spectra_for_file(ds.noise_records.datafile.filename)
+        else:
+            ds.noise_spectra = {k:(np.array(v) if isinstance(v, list) else v) for (k,v) in done.items()}
+    done = None
+    if checkpoint is not None:
+        cuts_key = stage_key("cuts", [ds.noise_records.datafile.filename], dict(nsigma_max_deriv=nsigma_max_deriv,
+            nsigma_pt_rms=nsigma_pt_rms, noise_streaming=noise_streaming, noise_rtol=noise_rtol))
+        done = checkpoint.get("cuts", cuts_key)
+    if done is None:
+        ds.usedcuts = calc_cuts_from_noise(ds,nsigma_max_deriv=nsigma_max_deriv, nsigma_pt_rms=nsigma_pt_rms,
+            streaming=noise_streaming, rtol=noise_rtol, noise_spectra=spectra)
+        if checkpoint is not None:
+            checkpoint.put("cuts", cuts_key, dict(cuts={k:list(v) for (k,v) in ds.usedcuts.cuts_prm.items() if v is not None}))
+    else:
+        ds.usedcuts = mass.core.controller.AnalysisControl(**{k:tuple(v) for (k,v) in done["cuts"].items()})
+        if spectra is not None:
+            noise_file = ljh.LJHFile(ds.noise_records.datafile.filename)
+            for _first_pnum, _end_pnum, _seg_num, data_seg in noise_file.iter_segments():
+                spectra.add(data_seg)
+    if spectra is not None:
+        ds.noise_spectra = spectra.result()
+        if checkpoint is not None:
+            checkpoint.put("noise_spectra", spectra_key, {k:(v.tolist() if isinstance(v, np.ndarray) else v)
+                for (k,v) in ds.noise_spectra.items()})
+    ds.apply_cuts(ds.usedcuts, clear=True) # forceNew is true by default
+
+def with_only_channels(data, channums, f):
+    """Call `f()` with every channel of the mass.TESGroup `data` not in `channums` marked bad, so group level steps skip them."""
+    others = [ds.channum for ds in data if ds.channum not in channums]
+    if len(others) > 0:
+        data.set_chan_bad(others, "skipped, checkpoint is current")
+    try:
+        return f()
+    finally:
+        if len(others) > 0:
+            data.set_chan_good(others)
+
+def run_group_stage(data, checkpoints, stage, keys, compute, rerun_current=False):
+    """
+    Run the group level `stage` (eg "average_pulse", "filter") of the mass.TESGroup `data`, skipping channels whose
+    `checkpoints[channum]` already completed it with `keys[channum]`. `compute(forceNew)` does the work on whichever
+    channels of `data` are good, and may return a dict of channum -> json serializable outputs to keep in the
+    checkpoint. It is called with `forceNew=True` on the channels that need the stage, then, if `rerun_current`, with
+    `forceNew=False` on the rest, for stages like filters whose results mass keeps in memory.
+    Returns a dict of channum -> outputs, computed or from the checkpoints.
+    """
+    outputs = {}
+    stale = []
+    for ds in data:
+        done = checkpoints[ds.channum].get(stage, keys[ds.channum])
+        if done is None:
+            stale.append(ds.channum)
+        else:
+            outputs[ds.channum] = done
+    current = list(outputs.keys())
+    if len(stale) > 0:
+        computed = with_only_channels(data, stale, lambda: compute(True)) or {}
+        for ch in stale:
+            outputs[ch] = computed.get(ch, {})
+            checkpoints[ch].put(stage, keys[ch], outputs[ch])
+    if rerun_current and len(current) > 0:
+        with_only_channels(data, current, lambda: compute(False))
+    return outputs
+
+def average_pulse_key(checkpoint, extra_pulse_files=()):
+    return stage_key("average_pulse", extra_pulse_files, upstream=[checkpoint.key("summarize"), checkpoint.key("cuts")])
+
+def filter_key(checkpoint, f3db):
+    return stage_key("filter", params=dict(f3db=f3db), upstream=[checkpoint.key("average_pulse")])
+
+def cut_stats_ds(ds):
+    """Return a dict with the channel number, pulse counts, and the cuts used, plain python so it can be pickled."""
+    nuncut = ds.good().sum()
+    return dict(channum=ds.channum, npulses=ds.nPulses, nuncut=nuncut, fracuncut=nuncut/float(ds.nPulses),
+        cuts={k:tuple(v) for (k,v) in ds.usedcuts.cuts_prm.items() if v is not None})
+
+def close_tesgroup(data):
+    """Close the hdf5 files backing a mass.TESGroup, so other processes can read them."""
+    for name in ["hdf5_file", "hdf5_noisefile"]:
+        h5 = getattr(data, name, None)
+        if h5 is not None:
+            h5.close()
+
+def make_channel_preknowledge(job):
+    """
+    make_channel_preknowledge(job)
+    Run the whole preknowledge pipeline for one channel, from peak estimate through filter, in a
+    mass.TESGroup of its own backed by per channel temporary hdf5 files. Intended to be mapped over
+    channels with a multiprocessing.Pool. `job` is a dict with keys
+    `pulse_file`, `noise_file`, `hdf5_filename`, `hdf5_noisefilename`, `pk_filename`,
+    `nsigma_max_deriv`, `nsigma_pt_rms`, `f3db` and `apply_filters`, and optionally `noise_streaming`, `noise_rtol`, `peak_time_budget_s`
+    and `noise_spectra`,
+    and `channum`, `checkpoint_dir` and `resume` to keep stage checkpoints (see `checkpoint.ChannelCheckpoint`)
+    and, with `resume`, reuse the stages that are current along with the temporary hdf5 files.
+    Writes the channel's preknowledge to `job["pk_filename"]`, returns `cut_stats_ds` of the channel, with `noise_spectra`
+    the `noise_analysis.NoiseSpectra` result under the key "noise_spectra".
+    """
+    checkpoint = None
+    if job.get("checkpoint_dir", None) is not None:
+        checkpoint = ChannelCheckpoint(job["checkpoint_dir"], job["channum"], job.get("resume", False),
+            requires=[job["hdf5_filename"], job["hdf5_noisefilename"]])
+    if not job.get("resume", False):
+        for fname in [job["hdf5_filename"], job["hdf5_noisefilename"]]:
+            if path.isfile(fname):
+                os.remove(fname)
+    data = mass.TESGroup([job["pulse_file"]], [job["noise_file"]],
+        hdf5_filename=job["hdf5_filename"], hdf5_noisefilename=job["hdf5_noisefilename"])
+    data.set_chan_good(data.why_chan_bad.keys())
+    for ds in data:
+        summarize_and_cut_ds(ds, job["nsigma_max_deriv"], job["nsigma_pt_rms"],
+            noise_streaming=job.get("noise_streaming", False), noise_rtol=job.get("noise_rtol", None),
+            peak_time_budget_s=job.get("peak_time_budget_s", None), checkpoint=checkpoint,
+            noise_spectra=job.get("noise_spectra", False))
+    # the group level steps are per channel in mass, so running them on a one channel group gives the same result
+    if checkpoint is None:
+        data.avg_pulses_auto_masks(forceNew=True)  # creates masks and compute average pulses
+        data.compute_filters(f_3db=job["f3db"], forceNew=True)
+    else:
+        checkpoints = {ds.channum:checkpoint for ds in data}
+        run_group_stage(data, checkpoints, "average_pulse", {ch:average_pulse_key(checkpoint) for ch in checkpoints},
+            lambda forceNew: data.avg_pulses_auto_masks(forceNew=forceNew))
+        run_group_stage(data, checkpoints, "filter", {ch:filter_key(checkpoint, job["f3db"]) for ch in checkpoints},
+            lambda forceNew: data.compute_filters(f_3db=job["f3db"], forceNew=forceNew), rerun_current=True)
+        if job.get("resume", False):
+            print(checkpoint.describe())
+    if job["apply_filters"]:
+        data.filter_data()
+    write_preknowledge_data(job["pk_filename"], data, [])
+    stats = cut_stats_ds(data.first_good_dataset)
+    if job.get("noise_spectra", False):
+        stats["noise_spectra"] = data.first_good_dataset.noise_spectra
+    close_tesgroup(data)
+    return stats
+
+def merge_hdf5_files(filename, part_filenames, remove_parts=True):
+    """
+    Create the hdf5 file `filename` holding a copy of every top level group (and the root attributes)
+    of each file in `part_filenames`. Used to merge the per channel files written by
+    `make_channel_preknowledge`; h5py copies datasets exactly, so the merged file matches a serial run.
+    """
+    with h5py.File(filename,"w") as h5:
+        for part in part_filenames:
+            with h5py.File(part,"r") as src:
+                for (k,v) in src.attrs.items():
+                    h5.attrs[k] = v
+                for k in src.keys():
+                    src.copy(src[k], h5, name=k)
+    if remove_parts:
+        for part in part_filenames:
+            os.remove(part)
+    return filename
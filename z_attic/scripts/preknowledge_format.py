@@ -0,0 +1,190 @@
+# Two layouts for preknowledge files. "grouped" is the one Pope.jl reads (analyzer_from_preknowledge):
+# a chanN group per channel holding small groups of tiny datasets, physical/frametime, trigger/nsamples,
+# cuts/pretrigger_rms and so on. Every one of those is its own HDF5 object, so for a few hundred
+# channels writing and opening the file is mostly metadata work. "packed" stores the same values with
+# one row per channel in a compound `channels` table, and the long per channel arrays (filter values,
+# values_at and the average pulse) stacked into chunked, compressed 2-D datasets with one row per
+# channel. PreknowledgeFile reads either layout into the same dict per channel, keyed by the grouped
+# path ("filter/values"), so python consumers don't care which they were given. Pope can only read
+# grouped files, so make_preknowledge.py always writes grouped, and a packed copy for python tools is a
+# separate step, `convert_preknowledge` or running this script.
+
+import argparse
+import numpy as np
+import h5py
+from cuts import CutSet
+
+FORMAT_PACKED = "pope preknowledge packed 1"
+# per channel arrays stacked into (nchannels, n) datasets in packed files, the rest go in the table
+STACKED = ["filter/values", "filter/values_at", "filter/average_pulse"]
+
+
+def write_values(g, values):
+    """Write `values`, a dict of path -> value like "filter/values", as datasets under the hdf5 group `g`."""
+    for (p, v) in values.items():
+        groupname, name = p.rsplit("/", 1) if "/" in p else ("", p)
+        (g.require_group(groupname) if groupname else g)[name] = v
+
+
+def read_values(g):
+    """Return a dict of path -> value of every dataset under the hdf5 group `g`, paths relative to `g`, strings decoded."""
+    values = {}
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            values[name] = _decode(obj[()])
+    g.visititems(visit)
+    return values
+
+
+def _decode(v):
+    return v.decode() if isinstance(v, bytes) else v
+
+
+def write_grouped(filename, channel_values):
+    """Write `channel_values`, a dict of channel number -> dict of path -> value, in the grouped layout Pope reads."""
+    with h5py.File(filename, "w") as h5:
+        for (ch, values) in sorted(channel_values.items()):
+            write_values(h5.require_group("chan%g"%ch), values)
+    return filename
+
+
+def _table_dtype(channel_values, paths):
+    fields = [("channum", np.int64)]
+    for p in paths:
+        v = channel_values[p]
+        if isinstance(v, str):
+            fields.append((p, h5py.string_dtype()))
+        else:
+            a = np.asarray(v)
+            fields.append((p, a.dtype, a.shape) if a.ndim > 0 else (p, a.dtype))
+    return np.dtype(fields)
+
+
+def write_packed(filename, channel_values, compression="gzip", chunk_channels=16):
+    """
+    Write `channel_values`, a dict of channel number -> dict of path -> value, in the packed layout: a compound
+    dataset `channels` with a `channum` field and one field per scalar or short array path, and one
+    `(nchannels, n)` dataset per `STACKED` path, chunked `chunk_channels` rows at a time and compressed with
+    `compression` (and the shuffle filter). Channels must have the same paths and array lengths, except that cuts
+    missing from a channel are written as `(-inf, inf)`, which cut nothing.
+    """
+    channums = sorted(channel_values.keys())
+    if len(channums) == 0:
+        raise ValueError("no channels to write")
+    cutpaths = sorted(set(p for ch in channums for p in channel_values[ch] if p.startswith("cuts/")))
+    first = dict(channel_values[channums[0]])
+    for p in cutpaths:
+        first.setdefault(p, np.array([-np.inf, np.inf]))
+    tablepaths = sorted(p for p in first if p not in STACKED)
+    table = np.zeros(len(channums), _table_dtype(first, tablepaths))
+    stacked = {p:[] for p in STACKED if p in first}
+    for (i, ch) in enumerate(channums):
+        values = channel_values[ch]
+        if set(p for p in values if not p.startswith("cuts/")) != set(p for p in first if not p.startswith("cuts/")):
+            raise ValueError("chan%g has different preknowledge values than chan%g, use the grouped layout"%(ch, channums[0]))
+        table[i]["channum"] = ch
+        for p in tablepaths:
+            table[i][p] = values.get(p, np.array([-np.inf, np.inf]))
+        for p in stacked:
+            stacked[p].append(np.asarray(values[p]))
+    with h5py.File(filename, "w") as h5:
+        h5.attrs["format"] = FORMAT_PACKED
+        h5.create_dataset("channels", data=table)
+        for (p, rows) in stacked.items():
+            if len(set(len(r) for r in rows)) != 1:
+                raise ValueError("%s has different lengths in different channels, use the grouped layout"%p)
+            a = np.vstack(rows)
+            h5.create_dataset(p, data=a, chunks=(min(chunk_channels, a.shape[0]), a.shape[1]),
+                compression=compression, shuffle=compression is not None)
+    return filename
+
+
+def is_packed(h5):
+    return h5.attrs.get("format", None) == FORMAT_PACKED
+
+
+class PreknowledgeFile():
+    """
+    PreknowledgeFile(filename)
+    Read a preknowledge file in either layout. `channels` is the sorted list of channel numbers, `channel(ch)` (or
+    `pk[ch]`) a dict of grouped path -> value for one channel, `cuts(ch)` its `cuts.CutSet`. In packed files the
+    table is read once on open and `channel` reads one row of each stacked dataset; `read_all()` reads everything
+    in one go.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.h5 = h5py.File(filename, "r")
+        self.packed = is_packed(self.h5)
+        if self.packed:
+            self.table = self.h5["channels"][()]
+            self.channels = [int(ch) for ch in self.table["channum"]]
+            self._row = {ch:i for (i, ch) in enumerate(self.channels)}
+        else:
+            self.channels = sorted(int(k[4:]) for k in self.h5.keys() if k.startswith("chan"))
+
+    def _table_values(self, i):
+        row = self.table[i]
+        return {p:_decode(row[p]) for p in self.table.dtype.names if p != "channum"}
+
+    def channel(self, ch):
+        if not self.packed:
+            return read_values(self.h5["chan%g"%ch])
+        i = self._row[ch]
+        values = self._table_values(i)
+        for p in STACKED:
+            if p in self.h5:
+                values[p] = self.h5[p][i]
+        return values
+
+    def __getitem__(self, ch):
+        return self.channel(ch)
+
+    def read_all(self):
+        """Return a dict of channel number -> `channel(ch)` for every channel."""
+        if not self.packed:
+            return {ch:self.channel(ch) for ch in self.channels}
+        stacked = {p:self.h5[p][()] for p in STACKED if p in self.h5}
+        out = {}
+        for (i, ch) in enumerate(self.channels):
+            values = self._table_values(i)
+            for (p, a) in stacked.items():
+                values[p] = a[i]
+            out[ch] = values
+        return out
+
+    def cuts(self, ch):
+        if not self.packed:
+            g = self.h5["chan%g"%ch]
+            return CutSet({name:tuple(v) for (name, v) in read_values(g["cuts"]).items()} if "cuts" in g else {})
+        values = self._table_values(self._row[ch])
+        return CutSet({p[5:]:tuple(v) for (p, v) in values.items() if p.startswith("cuts/")})
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def convert_preknowledge(src, dst, packed, compression="gzip"):
+    """Write the preknowledge file `src`, in either layout, to `dst` in the packed layout if `packed`, otherwise grouped."""
+    with PreknowledgeFile(src) as pk:
+        channel_values = pk.read_all()
+    if packed:
+        return write_packed(dst, channel_values, compression)
+    return write_grouped(dst, channel_values)
+
+
+parser = argparse.ArgumentParser(description='Convert a preknowledge file between the grouped layout Pope reads and the packed layout that is faster for python tools to open.')
+parser.add_argument('src', help="preknowledge file, either layout")
+parser.add_argument('dst', help="file to write")
+parser.add_argument('--grouped', help="write the grouped layout instead of the packed one", action="store_true")
+parser.add_argument('--compression', help="hdf5 compression of the packed layout's stacked datasets", default="gzip")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print("wrote: %s"%convert_preknowledge(args.src, args.dst, not args.grouped, args.compression))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Projectors for pulse bases, like computeprojectors(basis, noisecovariance) in src/projections.jl, for
+# every channel of an array at once. The expensive half, factoring the Toeplitz noise covariance R built
+# from a channel's autocorrelation, depends only on the noise, so NoiseFactorCache keeps it keyed by a
+# hash of the autocorrelation (and on disk with `cache_dir`), and a basis change only redoes the cheap
+# half, applying R^-1 to the basis and solving the small normal equations. The default "levinson" factor
+# is x = R^-1 e_0, from the Levinson recursion, N numbers per channel: by the Gohberg-Semencul formula
+#     R^-1 = (L(x) L(x)^T - L(Zx') L(Zx')^T)/x_0,   Zx' = (0, x_N-1, ..., x_1)
+# with L(v) the lower triangular Toeplitz matrix with first column v, so R^-1 B is four triangular
+# Toeplitz products, which are done as FFT convolutions batched over every channel with the same record
+# length. "cholesky" keeps the N by N Cholesky factor instead, which is more robust for badly conditioned
+# noise, and solves one channel at a time.
+
+import os
+import hashlib
+import argparse
+import numpy as np
+import scipy.linalg
+import h5py
+from noise_analysis import round_up_dft_length
+
+FACTOR_KINDS = ["levinson", "cholesky"]
+
+
+def noise_key(autocorr, N, kind="levinson"):
+    """Hex digest identifying the factor of the `N` by `N` noise covariance with autocorrelation `autocorr`."""
+    a = np.ascontiguousarray(np.asarray(autocorr, dtype="<f8")[:N])
+    return hashlib.sha1(("%s %d "%(kind, N)).encode()+a.tobytes()).hexdigest()
+
+
+def factor_noise(autocorr, N, kind="levinson"):
+    """Return the `kind` factor of the `N` by `N` symmetric Toeplitz noise covariance with first column `autocorr[:N]`."""
+    autocorr = np.asarray(autocorr, dtype=np.float64)
+    if len(autocorr) < N:
+        raise ValueError("noise autocorrelation must be at least as long as the basis columns")
+    if kind == "levinson":
+        e0 = np.zeros(N)
+        e0[0] = 1.0
+        return scipy.linalg.solve_toeplitz(autocorr[:N], e0)
+    elif kind == "cholesky":
+        return scipy.linalg.cholesky(scipy.linalg.toeplitz(autocorr[:N]), lower=True)
+    raise ValueError("factor kind %r is not one of %s"%(kind, FACTOR_KINDS))
+
+
+class NoiseFactorCache():
+    """
+    NoiseFactorCache(kind="levinson", cache_dir=None)
+    Noise covariance factors from `factor_noise`, keyed by `noise_key`, so channels with the same noise, and the same
+    channel after a basis change, share one. With `cache_dir` they are also kept there as `<key>.npy` and survive the
+    process. `hits` and `misses` count lookups.
+    """
+    def __init__(self, kind="levinson", cache_dir=None):
+        if kind not in FACTOR_KINDS:
+            raise ValueError("factor kind %r is not one of %s"%(kind, FACTOR_KINDS))
+        self.kind = kind
+        self.cache_dir = cache_dir
+        self.factors = {}
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, autocorr, N):
+        key = noise_key(autocorr, N, self.kind)
+        factor = self.factors.get(key, None)
+        if factor is None and self.cache_dir is not None:
+            fname = os.path.join(self.cache_dir, key+".npy")
+            if os.path.isfile(fname):
+                factor = np.load(fname)
+        if factor is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            factor = factor_noise(autocorr, N, self.kind)
+            if self.cache_dir is not None:
+                tmpname = os.path.join(self.cache_dir, key+".part.npy")
+                np.save(tmpname, factor)
+                os.rename(tmpname, os.path.join(self.cache_dir, key+".npy")) # readers never see a partial factor
+        self.factors[key] = factor
+        return factor
+
+
+def _lower_toeplitz_product(vf, w, nfft, transpose=False):
+    """`L(v) w` (or `L(v)^T w`) for each channel, `vf` the rfft of the `(g, N)` first columns, `w` `(g, N, n)`."""
+    N = w.shape[1]
+    if transpose: # L^T = J L J
+        w = w[:,::-1]
+    out = np.fft.irfft(vf[:,:,None]*np.fft.rfft(w, nfft, axis=1), nfft, axis=1)[:,:N]
+    return out[:,::-1] if transpose else out
+
+
+def solve_levinson_batch(x, b):
+    """Return `R^-1 b` for each of the `g` channels, `x` the `(g, N)` "levinson" factors, `b` `(g, N, n)`."""
+    g, N = x.shape
+    nfft = round_up_dft_length(2*N)
+    x1 = np.fft.rfft(x, nfft, axis=1)
+    x2 = np.fft.rfft(np.concatenate([np.zeros((g, 1)), x[:,:0:-1]], axis=1), nfft, axis=1)
+    out = _lower_toeplitz_product(x1, _lower_toeplitz_product(x1, b, nfft, True), nfft)
+    out -= _lower_toeplitz_product(x2, _lower_toeplitz_product(x2, b, nfft, True), nfft)
+    return out/x[:,0,None,None]
+
+
+def compute_projectors(bases, autocorrs, cache=None):
+    """
+    Return a dict of channel number -> `(projectors, pcovar)` for `bases`, a dict of channel number -> `(N, n)` basis,
+    with the noise of `autocorrs`, a dict of channel number -> autocorrelation, like computeprojectors in
+    projections.jl: `projectors` is `(n, N)`, and `basis.dot(projectors.dot(data))` is the element of the span of
+    `basis` closest to `data` in the noise weighted (Mahalanobis) distance, `pcovar` the covariance of the
+    projected coefficients. Noise factors come from `cache`, a `NoiseFactorCache` (a "levinson" one by default).
+    Channels with the same basis shape are solved together.
+    """
+    cache = NoiseFactorCache() if cache is None else cache
+    shapes = {}
+    for (ch, basis) in bases.items():
+        shapes.setdefault(np.shape(basis), []).append(ch)
+    out = {}
+    for ((N, n), chans) in shapes.items():
+        if n > N:
+            raise ValueError("basis must not have more columns than rows")
+        b = np.array([bases[ch] for ch in chans], dtype=np.float64)
+        sv = np.linalg.svd(b, compute_uv=False)
+        for (ch, s) in zip(chans, sv):
+            if s[-1] < 1e-10*s[0]:
+                raise ValueError("chan%d: basis has (approximately) degenerate columns"%ch)
+        factors = [cache.get(autocorrs[ch], N) for ch in chans]
+        if cache.kind == "levinson":
+            rinvb = solve_levinson_batch(np.array(factors), b)
+        else:
+            rinvb = np.array([scipy.linalg.cho_solve((L, True), bi) for (L, bi) in zip(factors, b)])
+        for (ch, r) in zip(chans, rinvb):
+            if not np.all(np.isfinite(r)):
+                raise ZeroDivisionError("chan%d: noise covariance is singular"%ch)
+        a = np.einsum("gki,gkj->gij", b, rinvb)
+        projectors = np.linalg.solve(a, rinvb.transpose(0, 2, 1))
+        pcovar = np.linalg.inv(a)
+        for (i, ch) in enumerate(chans):
+            out[ch] = (projectors[i], pcovar[i])
+    return out
+
+
+def computeprojectors(basis, autocorr, cache=None):
+    """`compute_projectors` for one `(N, n)` basis, returns `(projectors, pcovar)`."""
+    return compute_projectors({0:basis}, {0:autocorr}, cache)[0]
+
+
+def read_model_bases(h5):
+    """Return `(bases, autocorrs, projectors)` dicts of channel number -> `(N, n)` arrays from a basis_create.jl or basis_training.py output file."""
+    bases, autocorrs, projectors = {}, {}, {}
+    for (name, g) in h5.items():
+        if "svdbasis" not in g:
+            continue
+        ch = int(name)
+        bases[ch] = g["svdbasis/basis"][()].T # stored transposed, for Julia's column major order
+        autocorrs[ch] = g["svdbasis/noise_result/autocorr"][()]
+        projectors[ch] = g["svdbasis/projectors"][()].T
+    return bases, autocorrs, projectors
+
+
+def check_model_projectors(filename, cache=None, write=False):
+    """
+    Recompute the projectors of every channel in the model file `filename` from its basis and noise autocorrelation,
+    return a dict of channel number -> largest difference from the stored projectors, relative to their largest value.
+    With `write`, replace the stored projectors and projector covariances, eg after editing the bases.
+    """
+    with h5py.File(filename, "r+" if write else "r") as h5:
+        bases, autocorrs, stored = read_model_bases(h5)
+        computed = compute_projectors(bases, autocorrs, cache)
+        diffs = {ch:float(np.abs(computed[ch][0]-stored[ch]).max()/np.abs(stored[ch]).max()) for ch in computed}
+        if write:
+            for (ch, (p, pcovar)) in computed.items():
+                g = h5["%d/svdbasis"%ch]
+                g["projectors"][...] = p.T.astype(np.float32)
+                g["projector_covariance"][...] = pcovar.T.astype(np.float32)
+    return diffs
+
+
+parser = argparse.ArgumentParser(description='Recompute and check (or rewrite) the projectors of a basis model file.')
+parser.add_argument('filename', help="model hdf5 file from basis_create.jl or basis_training.py")
+parser.add_argument('--write', help="replace the stored projectors and projector covariances with the recomputed ones", action="store_true")
+parser.add_argument('--factor', help="noise factorization, one of %s"%FACTOR_KINDS, default="levinson")
+parser.add_argument('--cache_dir', help="directory to keep noise factors in between runs", default=None)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    diffs = check_model_projectors(args.filename, NoiseFactorCache(args.factor, args.cache_dir), args.write)
+    for (ch, d) in sorted(diffs.items()):
+        print("chan%d: largest projector difference %0.2e (relative)"%(ch, d))
+    if args.write:
+        print("wrote projectors for %d channels to %s"%(len(diffs), args.filename))
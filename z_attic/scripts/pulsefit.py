@@ -0,0 +1,153 @@
+# Two exponential pulse shape fits for the quality report. `two_exp_fit_pulse` fits one average
+# pulse with scipy.optimize.curve_fit, as the report always has. `two_exp_fit_batch` fits every
+# channel at once: all channels share the sample times, so one Levenberg-Marquardt step for all of
+# them is a few array operations and a batched 3x3 solve, with the Jacobian written out analytically.
+
+import numpy as np
+import scipy.optimize
+
+
+def two_exp_model(t, amp,tau1, tau2,t0):
+    t0=0
+    tau1=float(tau1)
+    tau2=float(tau2)
+    if tau1==tau2:
+        y = (t-t0)*np.exp(-(t-t0)/tau1)
+    else:
+        y = -np.exp(-(t-t0)/tau1)+np.exp(-(t-t0)/tau2)
+    m = np.amax(y)
+    if m==0:
+        return y
+    else:
+        return amp*y/m
+
+def two_exp_fit_pulse(average_pulse, nPresamples):
+    guess = [1,50,51,-0.5]
+    ydata = average_pulse[nPresamples+1:]
+    xdata = np.arange(len(ydata))
+    popt, pcov = scipy.optimize.curve_fit(two_exp_model, xdata, ydata, guess, bounds = ([0,1,1,-2],[1e6,1e5,1e5,2]))
+    sigma = np.array([np.sqrt(pcov[i,i]) for i in np.arange(len(popt))])
+    ydata = np.hstack((np.zeros(len(average_pulse)-len(ydata)),two_exp_model(xdata, *popt)))
+    return popt, sigma, ydata
+
+
+def two_exp_curve(t, a, tau1, tau2):
+    """Return `a*(exp(-t/tau2)-exp(-t/tau1))` with broadcasting, the unnormalized form fit by `two_exp_fit_batch`."""
+    return a*(np.exp(-t/tau2)-np.exp(-t/tau1))
+
+def _masked_line_fit(t, y, mask):
+    """Least squares line through the points of each column of `y` where `mask` is True, return `(slope, intercept)` per column."""
+    w = mask.astype(np.float64)
+    n = np.maximum(w.sum(axis=0), 1)
+    tm = (w*t[:,np.newaxis]).sum(axis=0)/n
+    ym = (w*y).sum(axis=0)/n
+    dt = (t[:,np.newaxis]-tm)*w
+    slope = (dt*(y-ym)).sum(axis=0)/np.maximum((dt*dt).sum(axis=0), 1e-300)
+    return slope, ym-slope*tm
+
+def two_exp_initial_guess(t, y, tail_fraction=0.5, min_fraction=0.02):
+    """
+    Guess `(a, tau1, tau2)` for each column of `y` from log slopes. `tau2` (fall) comes from a line through
+    log(y) after the peak, over samples between `min_fraction` and `tail_fraction` of the peak height. `tau1`
+    (rise) comes from a line through the log of what is left before the peak after subtracting that tail.
+    """
+    ipeak = np.argmax(y, axis=0)
+    ymax = y[ipeak, np.arange(y.shape[1])]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        after = t[:,np.newaxis] > t[ipeak][np.newaxis,:]
+        frac = y/ymax
+        tail = after & (frac < tail_fraction) & (frac > min_fraction)
+        logy = np.where(y > 0, np.log(np.abs(y)), 0.0)
+        slope, intercept = _masked_line_fit(t, logy, tail)
+        tau2 = np.where(slope < 0, -1/slope, t[-1])
+        a = np.exp(intercept)
+        rest = a*np.exp(-t[:,np.newaxis]/tau2)-y
+        rise = (t[:,np.newaxis] <= t[ipeak][np.newaxis,:]) & (rest > min_fraction*ymax)
+        logrest = np.where(rest > 0, np.log(np.abs(rest)), 0.0)
+        slope1, _ = _masked_line_fit(t, logrest, rise)
+        tau1 = np.where(slope1 < 0, -1/slope1, 0.5*t[np.maximum(ipeak,1)])
+    tau1 = np.clip(tau1, 0.05, None)
+    tau2 = np.maximum(tau2, 1.5*tau1)
+    a = ymax/np.maximum(two_exp_curve(t[:,np.newaxis], 1.0, tau1, tau2).max(axis=0), 1e-12)
+    return a, tau1, tau2
+
+def two_exp_fit_batch(pulses, nPresamples, maxiter=100, ftol=1e-10, lam0=1e-3):
+    """
+    two_exp_fit_batch(pulses, nPresamples)
+    Fit `a*(exp(-t/tau2)-exp(-t/tau1))` to every column of the `(nSamples, nchannels)` array `pulses` (eg the
+    normalized average pulses of `quality_check.normalized_average_pulses`), using the samples after
+    `nPresamples+1` with t starting at 0 like `two_exp_fit_pulse`. All channels take Levenberg-Marquardt steps
+    together, in the parameters `(a, log(tau1), log(tau2))` so the time constants stay positive. Each channel has
+    its own damping and stops when its relative change in cost is below `ftol`. Starts from `two_exp_initial_guess`.
+    Returns a dict of arrays, one entry per channel:
+    `amp` (peak height of the fit), `tau1` (rise), `tau2` (fall), `damp`, `dtau1`, `dtau2` (1 sigma, scaled by the
+    residual variance like curve_fit), `converged`, `niter` and `cost` (sum of squared residuals).
+    """
+    y = np.asarray(pulses, dtype=np.float64)[nPresamples+1:]
+    n, nch = y.shape
+    t = np.arange(n, dtype=np.float64)
+    a, tau1, tau2 = two_exp_initial_guess(t, y)
+    p = np.vstack((a, np.log(tau1), np.log(tau2))).T # (nch, 3)
+    lam = np.full(nch, lam0)
+    active = np.ones(nch, dtype=bool)
+    converged = np.zeros(nch, dtype=bool)
+    niter = np.zeros(nch, dtype=np.int64)
+
+    def residual_and_jacobian(p):
+        a, tau1, tau2 = p[:,0], np.exp(p[:,1]), np.exp(p[:,2])
+        e1 = np.exp(-t[:,np.newaxis]/tau1)
+        e2 = np.exp(-t[:,np.newaxis]/tau2)
+        r = a*(e2-e1)-y
+        J = np.empty((n, p.shape[0], 3))
+        J[:,:,0] = e2-e1
+        J[:,:,1] = -a*e1*t[:,np.newaxis]/tau1 # d/dlog(tau1)
+        J[:,:,2] = a*e2*t[:,np.newaxis]/tau2 # d/dlog(tau2)
+        return r, J
+
+    r, J = residual_and_jacobian(p)
+    cost = (r*r).sum(axis=0)
+    for i in range(maxiter):
+        if not np.any(active):
+            break
+        JTJ = np.einsum("nci,ncj->cij", J, J)
+        g = np.einsum("nci,nc->ci", J, r)
+        diag = np.einsum("cii->ci", JTJ)
+        A = JTJ+lam[:,np.newaxis,np.newaxis]*(diag[:,:,np.newaxis]*np.eye(3))+1e-30*np.eye(3)
+        try:
+            step = np.linalg.solve(A, -g[:,:,np.newaxis])[:,:,0]
+        except np.linalg.LinAlgError:
+            step = np.array([np.linalg.lstsq(Ai, -gi, rcond=None)[0] for (Ai, gi) in zip(A, g)])
+        step[~active] = 0
+        ptrial = p+step
+        rtrial, Jtrial = residual_and_jacobian(ptrial)
+        costtrial = (rtrial*rtrial).sum(axis=0)
+        better = active & np.isfinite(costtrial) & (costtrial < cost)
+        done = better & ((cost-costtrial) <= ftol*cost)
+        p[better] = ptrial[better]
+        r[:,better] = rtrial[:,better]
+        J[:,better] = Jtrial[:,better]
+        cost[better] = costtrial[better]
+        lam[better] /= 10
+        lam[active & ~better] *= 10
+        # a step that can't lower the cost even with heavy damping means we are at the minimum
+        done |= active & ~better & (lam > 1e10)
+        niter[active] += 1
+        converged |= done
+        active &= ~done
+
+    JTJ = np.einsum("nci,ncj->cij", J, J)
+    s2 = cost/max(1, n-3)
+    cov = np.full((nch, 3, 3), np.nan)
+    ok = np.abs(np.linalg.det(JTJ)) > 0
+    cov[ok] = np.linalg.inv(JTJ[ok])*s2[ok,np.newaxis,np.newaxis]
+    a, tau1, tau2 = p[:,0], np.exp(p[:,1]), np.exp(p[:,2])
+    sig = np.sqrt(np.abs(np.einsum("cii->ci", cov)))
+    # the model is symmetric under swapping the time constants with a -> -a, report the rise as tau1
+    swap = tau1 > tau2
+    tau1[swap], tau2[swap] = tau2[swap], tau1[swap]
+    a[swap] *= -1
+    dlog1, dlog2 = np.where(swap, sig[:,2], sig[:,1]), np.where(swap, sig[:,1], sig[:,2])
+    peak = two_exp_curve(t[:,np.newaxis], 1.0, tau1, tau2).max(axis=0)
+    converged &= np.isfinite(cost) & ok & (tau1 < tau2)
+    return dict(amp=a*peak, tau1=tau1, tau2=tau2, damp=sig[:,0]*peak, dtau1=tau1*dlog1, dtau2=tau2*dlog2,
+        converged=converged, niter=niter, cost=cost)
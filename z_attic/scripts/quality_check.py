@@ -1,46 +1,53 @@
 from matplotlib.backends.backend_pdf import PdfPages
-import scipy.optimize
 import datetime
+import hashlib
+import multiprocessing
+import os
 import numpy as np
 import pylab as plt
+import ljh
+from average_pulses import AveragePulseStore
+from pulsefit import two_exp_model, two_exp_fit_pulse, two_exp_fit_batch, two_exp_curve
 
 def normalized_average_pulse(ds):
     return ds.average_pulse[:]/np.amax(ds.average_pulse[:])
 
 
-def channels_with_odd_average_pulse(data,nsigma=5):
-    channums = np.array([ds.channum for ds in data])
-    ds = data.first_good_dataset
-    norm_avg_pulses = np.zeros((ds.nSamples, len(channums)))
-    for i,ds in enumerate(data):
-        norm_avg_pulses[:,i]=normalized_average_pulse(ds)
-
-    avg_avg_pulse = np.mean(norm_avg_pulses,axis=1)
-    resid = norm_avg_pulses.T-avg_avg_pulse
-    weighted_resid = resid/avg_avg_pulse
-    std_resid = np.std(resid[:,ds.nPresamples:],axis=1)
-    std_weight_resid = np.std(weighted_resid[:,ds.nPresamples:],axis=1)
-    std_resid = std_weight_resid
-    mad_std_resid = np.median(np.abs(std_resid-np.median(std_resid)))
-    med_std_resid = np.median(std_resid)
-    sigma = mad_std_resid*1.4826
-    keep_below = med_std_resid+nsigma*sigma
-
-    bad_inds = np.where(std_resid>keep_below)[0]
-    # plt.figure()
-    # plt.plot(std_resid,".")
-    # plt.plot(bad_inds, std_resid[bad_inds],".")
-    bad_chans = [channums[i] for i in bad_inds]
-    return bad_chans
-
-def plot_odd_average_pulses(data):
-    bad_chans = channels_with_odd_average_pulse(data)
+def normalized_average_pulses(data, store=None):
+    """Return `(channums, norm_avg_pulses)`, with the normalized average pulse of each channel as a column of `norm_avg_pulses`."""
+    if store is None:
+        store = AveragePulseStore.from_data(data)
+    return np.array(store.channums), store.norm_avg_pulses
+
+def fit_average_pulses(data, store=None):
+    """
+    Fit the two exponential pulse shape to the average pulse of every channel in `data` at once with
+    `pulsefit.two_exp_fit_batch`, return a dict of channum -> dict of that channel's fit results.
+    The fits are to the normalized average pulses, `amp` is rescaled to the unnormalized pulse.
+    Pass an `average_pulses.AveragePulseStore` of `data` as `store` to reuse it.
+    """
+    if store is None:
+        store = AveragePulseStore.from_data(data)
+    fit = two_exp_fit_batch(store.norm_avg_pulses, store.npresamples)
+    fit["amp"] = fit["amp"]*store.scales
+    fit["damp"] = fit["damp"]*store.scales
+    return {ch:{k:v[i] for (k,v) in fit.items()} for (i,ch) in enumerate(store.channums)}
+
+def channels_with_odd_average_pulse(data,nsigma=5,store=None):
+    if store is None:
+        store = AveragePulseStore.from_data(data)
+    return store.odd_channels(nsigma)
+
+def plot_odd_average_pulses(data,store=None):
+    if store is None:
+        store = AveragePulseStore.from_data(data)
+    bad_chans = store.odd_channels()
     plt.figure()
-    for ds in data:
-        if ds.channum in bad_chans:
-            plt.plot(normalized_average_pulse(ds), label=ds.channum)
+    for ch in store.channums:
+        if ch in bad_chans:
+            plt.plot(store.normalized(ch), label=ch)
         else:
-            plt.plot(normalized_average_pulse(ds),"k",label=None)
+            plt.plot(store.normalized(ch),"k",label=None)
     plt.yscale("log")
     plt.ylim(1e-4,1)
     if len(bad_chans)>0:
@@ -50,71 +57,92 @@ def plot_odd_average_pulses(data):
 
 
 
-def two_exp_model(t, amp,tau1, tau2,t0):
-    t0=0
-    tau1=float(tau1)
-    tau2=float(tau2)
-    if tau1==tau2:
-        y = (t-t0)*np.exp(-(t-t0)/tau1)
-    else:
-        y = -np.exp(-(t-t0)/tau1)+np.exp(-(t-t0)/tau2)
-    m = np.amax(y)
-    if m==0:
-        return y
-    else:
-        return amp*y/m
-
 def two_exp_fit(ds):
-    guess = [1,50,51,-0.5]
-    ydata = ds.average_pulse[ds.nPresamples+1:]
-    xdata = np.arange(len(ydata))
-    popt, pcov = scipy.optimize.curve_fit(two_exp_model, xdata, ydata, guess, bounds = ([0,1,1,-2],[1e6,1e5,1e5,2]))
-    sigma = np.array([np.sqrt(pcov[i,i]) for i in np.arange(len(popt))])
-    ydata = np.hstack((np.zeros(ds.nSamples-len(ydata)),two_exp_model(xdata, *popt)))
-    return popt, sigma, ydata
-
+    return two_exp_fit_pulse(ds.average_pulse[:], ds.nPresamples)
 
 
 def midpoints(x):
     return 0.5*(x[1:]+x[:-1])
 
+def plot_ljh_traces(ljhfile, inds, axis):
+    """Plot records `inds` of `ljhfile` (an `ljh.LJHFile`) on `axis`, reading just those records through the memory map."""
+    t = np.arange(ljhfile.nsamples)
+    for i in inds:
+        axis.plot(t, ljhfile.samples[i])
+    axis.set_xlabel("sample number")
+    axis.set_ylabel("raw signal")
+
+def channel_page_inputs(ds, fit=None, store=None):
+    """
+    Collect everything `plot_channel_page` needs from the mass dataset `ds` into a dict of plain arrays
+    and numbers, so a page can be drawn in another process and cached by `page_cache_key`. `fit` is this
+    channel's entry from `fit_average_pulses`, if not given the page fits the average pulse itself.
+    With an `AveragePulseStore` as `store` the average pulse comes from there instead of from `ds`.
+    """
+    inds_pt = np.where(np.logical_and(ds.bad("pretrigger_rms"),ds.good("postpeak_deriv")))[0][:10]
+    inds_md = np.where(np.logical_and(ds.bad("postpeak_deriv"),ds.good("pretrigger_rms")))[0][:10]
+    return dict(channum=ds.channum, nSamples=ds.nSamples, nPresamples=ds.nPresamples, timebase=ds.timebase,
+        ljh_filename=ds.pulse_records.datafile.filename,
+        inds_good=np.where(ds.good())[0][:10], inds_pt=inds_pt, inds_md=inds_md,
+        average_pulse=np.array(ds.average_pulse[:]) if store is None else store.average_pulse(ds.channum),
+        p_pretrig_rms=np.array(ds.p_pretrig_rms[:]), p_postpeak_deriv=np.array(ds.p_postpeak_deriv[:]),
+        pt_hi=ds.usedcuts.cuts_prm["pretrigger_rms"][1], md_hi=ds.usedcuts.cuts_prm["postpeak_deriv"][1],
+        fit=fit)
+
 def plot_traces(ds):
+    plot_channel_page(channel_page_inputs(ds))
+
+def plot_channel_page(inputs):
+    """Draw the six panel page for one channel from `channel_page_inputs`, into a new current figure."""
+    d = inputs
     plt.figure(figsize=(18,10))
     ax1=plt.subplot(231)
     ax2=plt.subplot(232)
     ax3=plt.subplot(233)
-    ds.plot_traces(np.where(ds.good())[0][:10], axis=ax1, pulse_summary=False)
-    inds_pt = np.where(np.logical_and(ds.bad("pretrigger_rms"),ds.good("postpeak_deriv")))[0][:10]
-    ds.plot_traces(inds_pt, axis=ax2, pulse_summary=False)
-    inds_md = np.where(np.logical_and(ds.bad("postpeak_deriv"),ds.good("pretrigger_rms")))[0][:10]
-    ds.plot_traces(inds_md, axis=ax3, pulse_summary=False)
-    ax1.set_title("Channel %g: uncut pulses"%ds.channum)
+    ljhfile = ljh.LJHFile(d["ljh_filename"])
+    plot_ljh_traces(ljhfile, d["inds_good"], ax1)
+    inds_pt = d["inds_pt"]
+    plot_ljh_traces(ljhfile, inds_pt, ax2)
+    inds_md = d["inds_md"]
+    plot_ljh_traces(ljhfile, inds_md, ax3)
+    ax1.set_title("Channel %g: uncut pulses"%d["channum"])
     ax2.set_title("cut by pretrigger_rms only")
     ax3.set_title("cut by postpeak_deriv only")
 
     colors = [line.get_color() for line in ax1.lines]
 
     ax4=plt.subplot(234)
-    plt.plot(ds.average_pulse,label="average pulse")
+    plt.plot(d["average_pulse"],label="average pulse")
+    fit = d.get("fit", None)
     try:
-        popt, sigma,ydata = two_exp_fit(ds)
-        amp, tau1, tau2, t0 = popt
-        damp, dtau1, dtau2, dt0 = sigma
-        plt.plot(ydata, label="tau1=%0.1f+/-%0.1f\ntau2=%0.1f+/-%0.1f\ntau in samples\n%0.2f us/sample"%(tau1, dtau1, tau2, dtau2,ds.timebase*1e6))
-    except:
+        if fit is None:
+            popt, sigma,ydata = two_exp_fit_pulse(d["average_pulse"], d["nPresamples"])
+            amp, tau1, tau2, t0 = popt
+            damp, dtau1, dtau2, dt0 = sigma
+        elif fit["converged"]:
+            tau1, tau2, dtau1, dtau2 = fit["tau1"], fit["tau2"], fit["dtau1"], fit["dtau2"]
+            t = np.arange(d["nSamples"]-d["nPresamples"]-1)
+            y = two_exp_curve(t, 1.0, tau1, tau2)
+            ydata = np.hstack((np.zeros(d["nPresamples"]+1), fit["amp"]*y/np.amax(y)))
+        else:
+            raise RuntimeError("batch fit did not converge")
+        plt.plot(ydata, label="tau1=%0.1f+/-%0.1f\ntau2=%0.1f+/-%0.1f\ntau in samples\n%0.2f us/sample"%(tau1, dtau1, tau2, dtau2,d["timebase"]*1e6))
+    except (RuntimeError, ValueError) as e:
+        print("chan %g: average pulse fit failed: %s"%(d["channum"], e))
         plt.plot(0,0,label="fit failed")
     plt.xlabel("sample number")
     plt.ylabel("signal height")
-    plt.title("Channel %g: average pulse"%(ds.channum))
+    plt.title("Channel %g: average pulse"%(d["channum"]))
     plt.legend(loc="best")
 
     ax5=plt.subplot(235)
-    pt_lo,pt_hi=ds.usedcuts.cuts_prm["pretrigger_rms"]
-    i_pt = ds.p_pretrig_rms[:][inds_pt]
+    pt_hi = d["pt_hi"]
+    p_pretrig_rms = d["p_pretrig_rms"]
+    i_pt = p_pretrig_rms[inds_pt]
     bin_edges_uncut = np.arange(0,pt_hi*1.03,pt_hi/50.)
     bin_edges_cut    = np.arange(pt_hi,4*pt_hi,pt_hi/50.)
-    counts_uncut,_ = np.histogram(ds.p_pretrig_rms, bin_edges_uncut)
-    counts_cut,_ = np.histogram(ds.p_pretrig_rms, bin_edges_cut)
+    counts_uncut,_ = np.histogram(p_pretrig_rms, bin_edges_uncut)
+    counts_cut,_ = np.histogram(p_pretrig_rms, bin_edges_cut)
     plt.plot(midpoints(bin_edges_uncut), counts_uncut, drawstyle="steps-mid",label="uncut")
     plt.plot(midpoints(bin_edges_cut), counts_cut, drawstyle="steps-mid",label="cut")
     plt.xlabel("pretrigger_rms")
@@ -126,12 +154,13 @@ def plot_traces(ds):
     plt.xlim(0,4*pt_hi)
 
     ax6=plt.subplot(236)
-    md_lo,md_hi=ds.usedcuts.cuts_prm["postpeak_deriv"]
-    i_md = ds.p_postpeak_deriv[:][inds_md]
+    md_hi = d["md_hi"]
+    p_postpeak_deriv = d["p_postpeak_deriv"]
+    i_md = p_postpeak_deriv[inds_md]
     bin_edges_uncut = np.arange(0,md_hi*1.03,md_hi/50.)
     bin_edges_cut    = np.arange(md_hi,4*md_hi,md_hi/50.)
-    counts_uncut,_ = np.histogram(ds.p_postpeak_deriv, bin_edges_uncut)
-    counts_cut,_ = np.histogram(ds.p_postpeak_deriv, bin_edges_cut)
+    counts_uncut,_ = np.histogram(p_postpeak_deriv, bin_edges_uncut)
+    counts_cut,_ = np.histogram(p_postpeak_deriv, bin_edges_cut)
     plt.plot(midpoints(bin_edges_uncut), counts_uncut, drawstyle="steps-mid",label="uncut")
     plt.plot(midpoints(bin_edges_cut), counts_cut, drawstyle="steps-mid",label="cut")
     plt.xlabel("postpeak_deriv")
@@ -142,6 +171,115 @@ def plot_traces(ds):
     plt.scatter(i_md, i_counts, marker="o",color=colors)
     plt.xlim(0, 4*md_hi)
 
+# bump this when plot_channel_page changes, so cached pages drawn by older code are not reused
+PAGE_VERSION = 1
+
+def page_cache_key(inputs, dpi):
+    """
+    Return a hex digest of everything that determines a channel page: `inputs`, `dpi`, `PAGE_VERSION`,
+    and the size and modification time of the LJH file the traces are read from.
+    """
+    h = hashlib.sha1()
+    h.update(("%d %d"%(PAGE_VERSION, dpi)).encode())
+    st = os.stat(inputs["ljh_filename"])
+    h.update(("%d %r"%(st.st_size, st.st_mtime)).encode())
+    for k in sorted(inputs.keys()):
+        v = inputs[k]
+        h.update(k.encode())
+        if isinstance(v, np.ndarray):
+            h.update(str(v.dtype).encode())
+            h.update(np.ascontiguousarray(v).tobytes())
+        else:
+            h.update(repr(v).encode())
+    return h.hexdigest()
+
+# (datasets, fits, store) of the pages being rendered, set by render_channel_pages before it forks its workers
+# so they inherit it, mass datasets don't pickle
+_page_sources = None
+
+def page_filename(cache_dir, inputs, dpi):
+    """Return the cached png for `inputs`, `chan<channum>_v<PAGE_VERSION>_<page_cache_key>.png` in `cache_dir`."""
+    return os.path.join(cache_dir, "chan%d_v%d_%s.png"%(inputs["channum"], PAGE_VERSION, page_cache_key(inputs, dpi)))
+
+def render_channel_page(job):
+    """
+    Collect the inputs for channel page `job["index"]` of `_page_sources` with `channel_page_inputs`, and unless
+    the png for them is already in `job["cache_dir"]` draw the page and save it there. Return `(filename, rendered)`.
+    For use with a multiprocessing.Pool, so the inputs, which read the channel's pulse summaries, are collected in
+    the workers too.
+    """
+    datasets, fits, store = _page_sources
+    ds = datasets[job["index"]]
+    inputs = channel_page_inputs(ds, None if fits is None else fits[ds.channum], store)
+    filename = page_filename(job["cache_dir"], inputs, job["dpi"])
+    if os.path.isfile(filename):
+        return filename, False
+    plt.switch_backend("Agg")
+    plot_channel_page(inputs)
+    tmpname = filename+".part.png"
+    plt.savefig(tmpname, dpi=job["dpi"])
+    plt.close()
+    os.rename(tmpname, filename) # so an interrupted run never leaves a truncated page in the cache
+    return filename, True
+
+def prune_page_cache(cache_dir, filenames):
+    """
+    Delete the pages in `cache_dir` that will never be reused, so the cache holds one page per channel: pages drawn
+    by another `PAGE_VERSION`, other pages of the channels in `filenames` than those, and partial pages of an
+    interrupted run. Return the number of files deleted.
+    """
+    keep = set(os.path.basename(f) for f in filenames)
+    channels = set(name.split("_")[0] for name in keep)
+    version = "_v%d_"%PAGE_VERSION
+    ndeleted = 0
+    for name in os.listdir(cache_dir):
+        if not (name.startswith("chan") and name.endswith(".png")) or name in keep:
+            continue
+        if name.endswith(".part.png") or version not in name or name.split("_")[0] in channels:
+            os.remove(os.path.join(cache_dir, name))
+            ndeleted += 1
+    return ndeleted
+
+def render_channel_pages(data, cache_dir, maxchan=240, workers=1, dpi=100, fits=None, store=None):
+    """
+    Render the channel pages of `data` (up to `maxchan`) to png files in `cache_dir`, named by `page_cache_key`,
+    drawing only pages not already there, using `workers` forked processes that each collect their channels'
+    inputs, then delete pages `prune_page_cache` finds stale. Return the png filenames in channel order.
+    `fits` is the result of `fit_average_pulses` and `store` an `AveragePulseStore`, if given.
+    The pages are raster images at `dpi`, so unlike pages drawn straight into the pdf they don't zoom, in return
+    for being drawn in parallel and cached between runs.
+    """
+    global _page_sources
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    datasets = [ds for (i,ds) in zip(range(maxchan), data)]
+    _page_sources = (datasets, fits, store)
+    jobs = [dict(index=i, cache_dir=cache_dir, dpi=dpi) for i in range(len(datasets))]
+    try:
+        if workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.get_context("fork").Pool(workers)
+            results = pool.map(render_channel_page, jobs, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            results = [render_channel_page(job) for job in jobs]
+    finally:
+        _page_sources = None
+    filenames = [filename for (filename, rendered) in results]
+    nrendered = sum(rendered for (filename, rendered) in results)
+    ndeleted = prune_page_cache(cache_dir, filenames)
+    print("pdf: %d of %d channel pages cached, rendered %d with %d workers, deleted %d stale pages"%(
+        len(filenames)-nrendered, len(filenames), nrendered, workers, ndeleted))
+    return filenames
+
+def save_png_page(pdf, filename, dpi):
+    """Add the png `filename` to `pdf` as a full page, at its native size for `dpi`."""
+    img = plt.imread(filename)
+    fig = plt.figure(figsize=(img.shape[1]/float(dpi), img.shape[0]/float(dpi)), dpi=dpi)
+    fig.figimage(img)
+    pdf.savefig(fig, dpi=dpi)
+    plt.close(fig)
+
 
 def cuts_string(data):
     s=[]
@@ -171,8 +309,23 @@ def nsigma_figure(nsigma_pt_rms, nsigma_max_deriv,first_noise_file,first_pulse_f
     plt.axis("off")
     plt.text(0.02,0.9,s,va="top",fontsize=7)
 
-def write_pdf_report(data,fname,nsigma_pt_rms, nsigma_max_deriv,first_noise_file,first_pulse_file,maxchan=240):
+def write_pdf_report(data,fname,nsigma_pt_rms, nsigma_max_deriv,first_noise_file,first_pulse_file,maxchan=240,workers=1,cache_dir=None,dpi=100):
+    """
+    Write the quality report pdf `fname`. By default every channel page is drawn in turn straight into the pdf.
+    With `workers` > 1 or a `cache_dir`, channel pages are rendered to png files in `cache_dir` (default
+    `fname+"_pages"`) by `render_channel_pages`, in parallel and skipping pages whose inputs are unchanged since
+    an earlier run, then placed in the pdf in channel order. Those pages are raster images at `dpi`, which don't
+    zoom like the vector pages drawn straight into the pdf, in return for being drawn in parallel and cached.
+    """
     print("writing pdf report")
+    store = AveragePulseStore.from_data(data) # each average pulse is read once, for the fits and the odd pulse page
+    fits = fit_average_pulses(data, store)
+    if workers > 1 or cache_dir is not None:
+        if cache_dir is None:
+            cache_dir = fname+"_pages"
+        page_filenames = render_channel_pages(data, cache_dir, maxchan, workers, dpi, fits, store)
+    else:
+        page_filenames = None
     with PdfPages(fname) as pdf:
         d = pdf.infodict()
         d['Title'] = 'Pope channel report'
@@ -182,12 +335,16 @@ def write_pdf_report(data,fname,nsigma_pt_rms, nsigma_max_deriv,first_noise_file
         nsigma_figure(nsigma_pt_rms, nsigma_max_deriv,first_noise_file,first_pulse_file)
         pdf.savefig()
         plt.close()
-        plot_odd_average_pulses(data)
+        plot_odd_average_pulses(data, store)
         pdf.savefig()
         plt.close()
         cuts_figure(data)
         pdf.savefig()
         plt.close()
+        if page_filenames is not None:
+            for filename in page_filenames:
+                save_png_page(pdf, filename, dpi)
+            return
         channums = np.array([ds.channum for ds in data])
         count = 0
         for (i,ds) in enumerate(data):
@@ -195,6 +352,6 @@ def write_pdf_report(data,fname,nsigma_pt_rms, nsigma_max_deriv,first_noise_file
                 break
             count+=1
             print("pdf %g/%g"%(i+1, min(len(channums), maxchan)))
-            plot_traces(ds)
+            plot_channel_page(channel_page_inputs(ds, fits[ds.channum], store))
             pdf.savefig()  # saves the current figure into a pdf page
             plt.close()
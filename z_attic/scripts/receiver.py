@@ -0,0 +1,119 @@
+# A background thread that drains Pope's zmq publisher and histograms energies, so the live
+# spectrum viewers can redraw at their own pace without stalling ingest. The GUI thread
+# only calls `snapshot()`, which copies the shared spectra under a lock.
+
+import time
+import threading
+import zmq
+from zmq_ingest import BatchIngest
+from histogram import Spectra
+from metrics import PipelineMetrics
+
+
+class ReceiverThread(threading.Thread):
+    """
+    ReceiverThread(ctx, address, info, bin_edges, hwm=10000, rois=None, window_s=None)
+    Connect a SUB socket to `address` (the socket is created and used only inside this thread,
+    since zmq sockets are not thread safe), then continuously drain it with a `BatchIngest` using
+    `info`, and add the energies to a shared `histogram.Spectra` binned by the uniform `bin_edges`,
+    with optional `rois` and a rolling window of `window_s` seconds.
+    Call `start()` to begin, `snapshot()` from the GUI to get a copy of the counts and stats,
+    `stop()` then `join()` to finish. If the thread dies on an exception, `snapshot()` and `join()` raise it.
+
+    Stats:
+    `nmessages`             messages received
+    `nrecords`              records decoded
+    `nused`                 records that passed cuts and were histogrammed
+    `nbad`                  messages dropped because they could not be decoded, see `BatchIngest`
+    `messages_per_wake`     messages drained the last time the receiver woke up, including any that
+                            arrived while draining, so this is not the socket backlog
+    `max_messages_per_wake` largest `messages_per_wake` seen
+    zmq drops messages silently once `hwm` are waiting, so falling behind shows up as
+    `messages_per_wake` staying large rather than as a count of dropped messages.
+
+    `metrics` is a `metrics.PipelineMetrics` with per stage timings, per channel rates and why records were
+    cut, see `metrics_snapshot()`. The GUI adds its own render times with `metrics.add_render`.
+    """
+    def __init__(self, ctx, address, info, bin_edges, hwm=10000, capacity=65536, poll_ms=100, rois=None, window_s=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ctx = ctx
+        self.address = address
+        self.info = info
+        self.hwm = hwm
+        self.capacity = capacity
+        self.poll_ms = poll_ms
+        self.lock = threading.Lock()
+        self.spectra = Spectra.from_edges(bin_edges, rois=rois, window_s=window_s)
+        self.stats = dict(nmessages=0, nrecords=0, nused=0, nbad=0, messages_per_wake=0, max_messages_per_wake=0)
+        self.metrics = PipelineMetrics()
+        self.error = None # the exception that ended run, if any
+        self._stop_event = threading.Event()
+
+    def run(self):
+        socket = None
+        try:
+            # setup errors, eg a bad address, are kept in self.error like errors while receiving
+            socket = self.ctx.socket(zmq.SUB) # make a subscriber socket
+            socket.set_hwm(self.hwm) # set the recieve side message buffer limit
+            socket.connect(self.address) # connect to the server
+            socket.setsockopt(zmq.SUBSCRIBE, b"") # subscribe to all message, since all start with ""
+            ingest = BatchIngest(socket, self.info, capacity=self.capacity, metrics=self.metrics)
+            poller = zmq.Poller()
+            poller.register(socket, zmq.POLLIN)
+            while not self._stop_event.is_set():
+                if not poller.poll(self.poll_ms):
+                    continue
+                nmessages0 = ingest.nmessages
+                channel_energies = ingest.get_channel_energies()
+                nwake = ingest.nmessages-nmessages0
+                with self.lock:
+                    tstart = time.time()
+                    for (ch, energies) in channel_energies:
+                        self.spectra.add(ch, energies)
+                    histogram_s = time.time()-tstart
+                    s = self.stats
+                    s["nmessages"] = ingest.nmessages
+                    s["nrecords"] = ingest.nrecords
+                    s["nused"] = ingest.nused
+                    s["nbad"] = ingest.nbad
+                    s["messages_per_wake"] = nwake
+                    s["max_messages_per_wake"] = max(s["max_messages_per_wake"], nwake)
+                self.metrics.add_batch(dict(histogram=histogram_s), [], [], [], {}, nmessages=nwake, messages_per_wake=nwake)
+        except Exception as e:
+            # kept for snapshot and join, otherwise the spectra would just stop updating
+            self.error = e
+        finally:
+            if socket is not None:
+                socket.close()
+
+    def snapshot(self, ch=None, window=False):
+        """
+        Return `(counts, stats)`, copies that the caller can use without holding the lock.
+        `counts` is coadded, or from channel `ch` if given, or from the rolling window if `window`.
+        `stats` also holds the coadded `roi_counts`. Raises the exception that stopped the thread, if any.
+        """
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            if window:
+                counts = self.spectra.window_counts()
+            elif ch is not None:
+                counts = self.spectra.channel(ch).counts
+            else:
+                counts = self.spectra.counts
+            stats = dict(self.stats)
+            stats["roi_counts"] = dict(self.spectra.roi_counts)
+            return counts.copy(), stats
+
+    def metrics_snapshot(self):
+        """Return `self.metrics.snapshot()`, rates are since the previous call."""
+        return self.metrics.snapshot()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.error is not None:
+            raise self.error
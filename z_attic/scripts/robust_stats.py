@@ -0,0 +1,148 @@
+# Streaming robust statistics. A QuantileSketch folds in values one batch at a time into
+# logarithmically spaced buckets, like DDSketch: a value x > 0 goes in bucket ceil(log(x)/log(gamma)),
+# so every bucket spans the same relative width and any quantile is read off with a relative error
+# of at most `rel_error`, whatever the range of the values. An outlier far from the bulk only adds
+# buckets of its own, it can't coarsen the ones the median falls in. Memory grows with the log of
+# the range of the values, not with their number. The median and the median absolute deviation
+# (MAD) can be read off at any time.
+
+import numpy as np
+
+
+class _Buckets():
+    # counts of consecutive integer bucket keys starting at `offset`, growing to cover new keys
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _cover(self, kmin, kmax):
+        if len(self.counts) == 0:
+            self.offset = kmin
+            self.counts = np.zeros(kmax-kmin+1, dtype=np.int64)
+            return
+        lo, hi = min(kmin, self.offset), max(kmax, self.offset+len(self.counts)-1)
+        if lo < self.offset or hi >= self.offset+len(self.counts):
+            counts = np.zeros(hi-lo+1, dtype=np.int64)
+            counts[self.offset-lo:self.offset-lo+len(self.counts)] = self.counts
+            self.offset, self.counts = lo, counts
+
+    def add(self, keys, counts=None):
+        if len(keys) == 0:
+            return
+        self._cover(int(keys.min()), int(keys.max()))
+        self.counts += np.bincount(keys-self.offset, weights=counts, minlength=len(self.counts)).astype(np.int64)
+
+    def merge(self, other):
+        nz = np.nonzero(other.counts)[0]
+        self.add(nz+other.offset, other.counts[nz])
+
+    def nonzero(self):
+        """Return `(keys, counts)` of the non empty buckets, keys ascending."""
+        nz = np.nonzero(self.counts)[0]
+        return nz+self.offset, self.counts[nz]
+
+
+class QuantileSketch():
+    """
+    QuantileSketch(rel_error=1e-3, min_value=1e-9)
+    Use `add(x)` to fold in a batch of values, then `quantile(q)`, `median()` and `mad()`. Every value is
+    represented by its bucket's value, which is within `rel_error` of it (relative), values with magnitude
+    below `min_value` count as zero. So `median()` is within `rel_error*abs(median)` of the exact median of
+    the values, and `mad()` within `2*rel_error*(abs(median)+mad)` of the exact MAD, see `error_bound()`.
+    Sketches with the same `rel_error` and `min_value` combine exactly with `merge`. NaN values are ignored.
+    """
+    def __init__(self, rel_error=1e-3, min_value=1e-9):
+        if not 0 < rel_error < 1:
+            raise ValueError("rel_error must be between 0 and 1, got %g"%rel_error)
+        self.rel_error = rel_error
+        self.min_value = min_value
+        self.log_gamma = np.log((1+rel_error)/(1-rel_error))
+        self.positive = _Buckets()
+        self.negative = _Buckets() # keyed by the magnitude
+        self.nzero = 0
+        self.n = 0
+
+    def _keys(self, x):
+        return np.ceil(np.log(x)/self.log_gamma).astype(np.int64)
+
+    def _values(self, keys):
+        # the value that is within rel_error of everything in bucket k, (gamma^(k-1), gamma^k]
+        return 2*np.exp(keys*self.log_gamma)/(1+np.exp(self.log_gamma))
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64).ravel()
+        x = x[~np.isnan(x)]
+        if len(x) == 0:
+            return
+        self.positive.add(self._keys(x[x >= self.min_value]))
+        self.negative.add(self._keys(-x[x <= -self.min_value]))
+        self.nzero += int(np.count_nonzero(np.abs(x) < self.min_value))
+        self.n += len(x)
+
+    def merge(self, other):
+        """Fold `other`, which must have the same `rel_error` and `min_value`, into `self`."""
+        if (other.rel_error, other.min_value) != (self.rel_error, self.min_value):
+            raise ValueError("can't merge sketches with different rel_error or min_value")
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.nzero += other.nzero
+        self.n += other.n
+        return self
+
+    def _sorted(self):
+        """Return `(values, counts)` of every non empty bucket, values ascending."""
+        nkeys, ncounts = self.negative.nonzero()
+        pkeys, pcounts = self.positive.nonzero()
+        values = np.hstack((-self._values(nkeys[::-1]), [0.0], self._values(pkeys)))
+        counts = np.hstack((ncounts[::-1], [self.nzero], pcounts))
+        return values, counts
+
+    def quantile(self, q):
+        """Return the value of the bucket holding the `q` quantile."""
+        if self.n == 0:
+            return np.nan
+        values, counts = self._sorted()
+        j = int(np.searchsorted(np.cumsum(counts), q*self.n))
+        return values[min(j, len(values)-1)]
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def mad(self, median=None):
+        """Return the median absolute deviation from `median` (default `self.median()`)."""
+        if self.n == 0:
+            return np.nan
+        if median is None:
+            median = self.median()
+        values, counts = self._sorted()
+        dev = np.abs(values-median)
+        order = np.argsort(dev, kind="mergesort")
+        j = int(np.searchsorted(np.cumsum(counts[order]), 0.5*self.n))
+        return dev[order][min(j, len(order)-1)]
+
+    def error_bound(self):
+        """Return `(median_error, mad_error)`, upper bounds on the errors of `median()` and of `mad()`."""
+        median = abs(self.median())
+        return self.rel_error*median+self.min_value, 2*self.rel_error*(median+self.mad())+2*self.min_value
+
+
+class ConvergenceCheck():
+    """
+    ConvergenceCheck(rtol, patience=2)
+    Call `update(values)` after each batch with the quantities you care about (eg cut limits).
+    `update` returns True once every value changed by at most `rtol` (relative) for `patience` batches in a row.
+    """
+    def __init__(self, rtol, patience=2):
+        self.rtol = rtol
+        self.patience = patience
+        self.last = None
+        self.nstable = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.last is not None and np.all(np.abs(values-self.last) <= self.rtol*np.abs(self.last)):
+            self.nstable += 1
+        else:
+            self.nstable = 0
+        self.last = values
+        return self.nstable >= self.patience
@@ -0,0 +1,162 @@
+# Per channel statistics and average pulses over several pulse runs, for make_preknowledge.py
+# --extra_pulse_files. Each (channel, run) is summarized on its own into a PulseAggregate of
+# counts and a robust_stats sketch of pulse_average, then the aggregates of a channel's runs are
+# merged, so no records are ever concatenated and memory does not grow with the number of runs.
+# The runs' files are read concurrently by a thread pool; the work is mostly page faults on the
+# memory mapped files and numpy reductions, which release the GIL.
+
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from robust_stats import QuantileSketch
+import ljh
+
+SUMMARY_FIELDS = ["pretrig_mean", "pretrig_rms", "peak_value", "pulse_average", "postpeak_deriv"]
+
+
+def summarize_segment(samples, npresamples, peakind):
+    """
+    Return a structured array with one float64 field per `SUMMARY_FIELDS` for the `(n, nsamples)` `samples`, with
+    the same definitions as mass summarize_data (`postpeak_deriv` is `compute_max_deriv` of the samples from
+    `peakind` on, peak_value and pulse_average are relative to the pretrigger mean), so a `cuts.CutSet` can be
+    evaluated on it.
+    """
+    import mass
+    summary = np.zeros(len(samples), dtype=[(name, np.float64) for name in SUMMARY_FIELDS])
+    pre = samples[:,:npresamples]
+    summary["pretrig_mean"] = pre.mean(axis=1)
+    summary["pretrig_rms"] = pre.std(axis=1)
+    summary["peak_value"] = samples[:,npresamples:].max(axis=1)-summary["pretrig_mean"]
+    summary["pulse_average"] = samples[:,npresamples:].mean(axis=1)-summary["pretrig_mean"]
+    summary["postpeak_deriv"] = mass.analysis_algorithms.compute_max_deriv(samples[:,peakind:], ignore_leading=0)
+    return summary
+
+
+class PulseAggregate():
+    """
+    PulseAggregate(channum, nsamples, rel_error=1e-3)
+    Mergeable summary of one channel's pulses. `npulses` and `nuncut` counts, `pulse_average` a `QuantileSketch` of
+    the `pulse_average` of uncut records, and `pulse_sum`, `nsummed` the sum and count of the records that went into
+    the average pulse. Combine the aggregates of several runs with `merge`.
+    """
+    def __init__(self, channum, nsamples, rel_error=1e-3):
+        self.channum = channum
+        self.nsamples = nsamples
+        self.npulses = 0
+        self.nuncut = 0
+        self.pulse_average = QuantileSketch(rel_error)
+        self.pulse_sum = np.zeros(nsamples)
+        self.nsummed = 0
+
+    def merge(self, other):
+        if other.nsamples != self.nsamples:
+            raise ValueError("chan%d: can't merge runs with %d and %d samples per record"%(self.channum, self.nsamples, other.nsamples))
+        self.npulses += other.npulses
+        self.nuncut += other.nuncut
+        self.pulse_average.merge(other.pulse_average)
+        self.pulse_sum += other.pulse_sum
+        self.nsummed += other.nsummed
+        return self
+
+    def average_pulse(self):
+        return self.pulse_sum/max(self.nsummed, 1)
+
+    def cut_stats(self):
+        """Return a dict like `preknowledge.cut_stats_ds`, without the cuts."""
+        return dict(channum=self.channum, npulses=self.npulses, nuncut=self.nuncut,
+            fracuncut=self.nuncut/float(max(self.npulses, 1)))
+
+
+def aggregate_pulse_file(job):
+    """
+    aggregate_pulse_file(job)
+    Count the pulses and uncut pulses of one run of one channel, and sketch their `pulse_average`, into a
+    `PulseAggregate`. `job` is a dict with `filename`, `cuts` (a `cuts.CutSet`) and `peakind` (0 based sample to start
+    `postpeak_deriv` from), and optionally `rel_error` for the sketch and `channum` to use instead of the one in the
+    LJH header.
+    """
+    f = ljh.LJHFile(job["filename"])
+    agg = PulseAggregate(job.get("channum", f.channum), f.nsamples, job.get("rel_error", 1e-3))
+    for (first, end, segnum, samples) in f.iter_segments():
+        summary = summarize_segment(samples, f.npresamples, job["peakind"])
+        good = job["cuts"].good(summary)
+        agg.npulses += end-first
+        agg.nuncut += int(good.sum())
+        agg.pulse_average.add(summary["pulse_average"][good])
+    return agg
+
+
+def average_pulse_files(job):
+    """
+    average_pulse_files(job)
+    Return `(channum, pulse_sum, nsummed)` for the average pulse of one channel over several runs: the sum of the
+    pretrigger mean subtracted records that pass `cuts` and have `pulse_average` within `pulse_average_range`,
+    `(lo, hi)`, taking the first `max_pulses` of them in the order of `filenames`, like `max_pulses_to_use` of mass
+    `compute_average_pulse`. Files past the one that fills it are not read. `job` is a dict with those keys and
+    `channum` and `peakind` as for `aggregate_pulse_file`.
+    """
+    lo, hi = job["pulse_average_range"]
+    pulse_sum, nsummed = None, 0
+    for filename in job["filenames"]:
+        f = ljh.LJHFile(filename)
+        for (first, end, segnum, samples) in f.iter_segments():
+            if nsummed >= job["max_pulses"]:
+                break
+            summary = summarize_segment(samples, f.npresamples, job["peakind"])
+            use = job["cuts"].good(summary)&(summary["pulse_average"] >= lo)&(summary["pulse_average"] <= hi)
+            use &= np.cumsum(use) <= job["max_pulses"]-nsummed
+            if pulse_sum is None:
+                pulse_sum = np.zeros(f.nsamples)
+            elif len(pulse_sum) != f.nsamples:
+                raise ValueError("chan%d: can't average runs with %d and %d samples per record"%(job["channum"], len(pulse_sum), f.nsamples))
+            if np.any(use):
+                pulse_sum += samples[use].sum(axis=0, dtype=np.float64)-summary["pretrig_mean"][use].sum()
+                nsummed += int(use.sum())
+    return job["channum"], pulse_sum, nsummed
+
+
+def _map(func, jobs, threads):
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(func, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def aggregate_runs(jobs, threads=4):
+    """
+    Run `aggregate_pulse_file` on every job in `jobs` with a pool of `threads` threads, and merge the results by
+    channel. Return a dict of channel number -> merged `PulseAggregate`.
+    """
+    merged = {}
+    for agg in _map(aggregate_pulse_file, jobs, threads):
+        if agg.channum in merged:
+            merged[agg.channum].merge(agg)
+        else:
+            merged[agg.channum] = agg
+    return merged
+
+
+def average_pulses_multirun(filenames_by_channel, cuts_by_channel, peakind_by_channel, threads=4, band=0.05, max_pulses=7000):
+    """
+    Average pulses over several runs. `filenames_by_channel` maps channel number to the list of that channel's LJH
+    files, one per run, `cuts_by_channel` to a `cuts.CutSet` and `peakind_by_channel` to the 0 based peak index.
+    A first pass over every file counts the uncut records and finds the merged median `pulse_average` of them per
+    channel, a second averages the first `max_pulses` uncut records within `band` (fractional) of it, like the single
+    energy masks of mass `avg_pulses_auto_masks`. The first pass reads every file concurrently with `threads` threads,
+    the second reads each channel's runs in order, channels concurrently, and stops once `max_pulses` are summed.
+    Returns a dict of channel number -> merged `PulseAggregate`.
+    """
+    aggs = aggregate_runs([dict(filename=fname, channum=ch, cuts=cuts_by_channel[ch], peakind=peakind_by_channel[ch])
+        for (ch, fnames) in sorted(filenames_by_channel.items()) for fname in fnames], threads)
+    jobs = []
+    for (ch, agg) in sorted(aggs.items()):
+        med = agg.pulse_average.median()
+        if np.isfinite(med):
+            jobs.append(dict(filenames=filenames_by_channel[ch], channum=ch, cuts=cuts_by_channel[ch],
+                peakind=peakind_by_channel[ch], pulse_average_range=(med-band*abs(med), med+band*abs(med)),
+                max_pulses=max_pulses))
+    for (ch, pulse_sum, nsummed) in _map(average_pulse_files, jobs, threads):
+        aggs[ch].pulse_sum[:] = pulse_sum
+        aggs[ch].nsummed = nsummed
+    return aggs
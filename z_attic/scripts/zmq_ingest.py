@@ -0,0 +1,162 @@
+# Batched receive path for the live spectrum listeners (zmq_listener_py34.py and
+# zmq_listener_py27_and_pyqt.py). Instead of decoding, cutting and calibrating one
+# record at a time, we drain every available message from the socket into a
+# preallocated structured array, then cut and calibrate each channel's records
+# with whole array numpy operations.
+
+import time
+import numpy as np
+import zmq
+from dataproduct import RecordRing, payload_buffer
+
+
+def group_by_channel(channels):
+    """
+    Return `(order, chans, starts, ends)` such that `order[starts[i]:ends[i]]` indexes
+    every record from channel `chans[i]`, in arrival order.
+    """
+    order = np.argsort(channels, kind="mergesort") # stable, so records stay in arrival order within a channel
+    sorted_channels = channels[order]
+    chans, starts = np.unique(sorted_channels, return_index=True)
+    ends = np.hstack((starts[1:], len(sorted_channels))).astype(starts.dtype)
+    return order, chans, starts, ends
+
+def apply_calibration_batch(records, info_ch):
+    """Vectorized `apply_calibration`, the calibration is called once on all of `records["filt_value"]`."""
+    cal=info_ch[1]
+    return np.asarray(cal(records["filt_value"]), dtype=np.float64)
+
+
+class BatchIngest():
+    """
+    Drains a zmq SUB socket carrying Pope's `MassCompatibleDataProductFeb2017` messages into a
+    `RecordRing` and turns each batch into calibrated energies. `info` maps channel number
+    to `(cuts, calibration)` as built by the listener scripts, where `cuts` is a `cuts.CutSet`.
+    With `copy=False` messages are received as `zmq.Frame` and copied only once, from zmq's buffer into the
+    ring. pyzmq's Frame objects cost more to create than a bytes object, so this only pays off when
+    payloads hold many records; for Pope's one record payloads the default `copy=True` is faster.
+    With a `metrics.PipelineMetrics` as `metrics`, each batch adds its decode, cut and calibrate times, per
+    channel counts and per cut fail counts to it.
+    Messages with a topic that is not a channel number, or without a payload that is a whole number of records, are
+    dropped and counted in `nbad`, so one bad message can't stop ingest.
+    """
+    def __init__(self, socket, info, capacity=65536, copy=True, metrics=None):
+        self.socket = socket
+        self.copy = copy
+        self.info = info
+        self.metrics = metrics
+        self._drain_s = 0.0 # time spent in drain since the last process_by_channel, for metrics
+        self.ring = RecordRing(capacity)
+        self.nmessages = 0
+        self.nrecords = 0
+        self.nused = 0
+        self.nbad = 0
+        self._pending = None # (ch, records) of a payload that did not fit in the ring during the last drain
+
+    def _push(self, ch, payload):
+        """Push as many records of `payload` as fit in the ring, the rest waits in `_pending` for the next drain."""
+        ring = self.ring
+        itemsize = ring.dtype.itemsize
+        buf = memoryview(payload_buffer(payload))
+        self._pending = None # a payload that push rejects is dropped, not retried on every drain
+        n = ring.space()*itemsize
+        if len(buf) > n:
+            if len(buf)%itemsize != 0:
+                raise ValueError("payload of %d bytes is not a whole number of %d byte records"%(len(buf), itemsize))
+            self._pending = (ch, buf[n:]) # payloads bigger than the whole ring are split over several batches
+            buf = buf[:n]
+        ring.push(ch, buf)
+
+    def drain(self):
+        """Read messages until the socket is empty or the ring is full, return the number of records read."""
+        ring = self.ring
+        tstart = time.time()
+        if self._pending is not None:
+            self._push(*self._pending)
+        while not ring.isfull():
+            try:
+                m = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=self.copy)
+            except zmq.ZMQError:
+                break
+            self.nmessages += 1
+            topic = m[0] if self.copy else m[0].bytes
+            if topic.startswith(b"header"): continue
+            try:
+                self._push(int(topic), m[1])
+            except (ValueError, IndexError):
+                self.nbad += 1
+        self._drain_s += time.time()-tstart
+        return ring.n
+
+    def process_by_channel(self):
+        """
+        Cut and calibrate the records currently in the ring and rewind the ring.
+        Return a list of `(channel, energies)` with one entry per channel that had uncut records.
+        With `metrics`, also add this batch's stage times, per channel counts and why records were cut to it.
+        """
+        metrics = self.metrics
+        channels, records = self.ring.batch()
+        out = []
+        chans_seen, nrecords, nused = [], [], []
+        ncut_by = {}
+        cut_s = calibrate_s = 0.0
+        if len(channels) > 0:
+            order, chans, starts, ends = group_by_channel(channels)
+            for ch, start, end in zip(chans, starts, ends):
+                info_ch = self.info.get(int(ch), None)
+                chans_seen.append(int(ch))
+                nrecords.append(end-start)
+                if info_ch is None:
+                    nused.append(0)
+                    ncut_by["no calibration"] = ncut_by.get("no calibration", 0)+(end-start)
+                    continue
+                t0 = time.time()
+                recs = records[order[start:end]]
+                if metrics is None:
+                    cut = info_ch[0].cut_mask(recs)
+                else: # counting why records were cut costs a little more, so only when someone reads it
+                    cut, counts = info_ch[0].cut_mask_counts(recs)
+                    for (name, n) in counts.items():
+                        ncut_by[name] = ncut_by.get(name, 0)+n
+                recs = recs[~cut]
+                t1 = time.time()
+                nused.append(len(recs))
+                if len(recs) > 0:
+                    out.append((int(ch), apply_calibration_batch(recs, info_ch)))
+                cut_s += t1-t0
+                calibrate_s += time.time()-t1
+        self.nrecords += len(channels)
+        self.nused += sum(nused)
+        if metrics is not None:
+            metrics.add_batch(dict(decode=self._drain_s, cut=cut_s, calibrate=calibrate_s),
+                chans_seen, nrecords, nused, ncut_by)
+        self.ring.reset()
+        self._drain_s = 0.0
+        return out
+
+    def process(self):
+        """Cut and calibrate the records currently in the ring, rewind the ring, return an array of energies."""
+        out = self.process_by_channel()
+        if len(out) == 0:
+            return np.zeros(0)
+        return np.hstack([energies for (ch, energies) in out])
+
+    def get_channel_energies(self):
+        """Drain and process until the socket is empty, return a list of `(channel, energies)`."""
+        out = []
+        while True:
+            n = self.drain()
+            out.extend(self.process_by_channel())
+            if n < self.ring.capacity and self._pending is None:
+                break
+        return out
+
+    def get_energies(self):
+        """Drain and process until the socket is empty, return all energies as one array."""
+        energies = []
+        while True:
+            n = self.drain()
+            energies.append(self.process())
+            if n < self.ring.capacity and self._pending is None:
+                break
+        return np.hstack(energies)
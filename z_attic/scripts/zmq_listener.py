@@ -5,6 +5,7 @@
 import zmq
 import numpy as np
 import time
+from dataproduct import dtype_MassCompatibleDataProductFeb2017, decode_payload
 PORT = 2015
 
 ctx = zmq.Context() # context is required to create zmq socket
@@ -12,10 +13,6 @@ socket = zmq.Socket(ctx, zmq.SUB) # make a subscriber socket
 socket.connect ("tcp://localhost:%s" % PORT) # connect to the server
 socket.set_hwm(10000) # set the recieve side message buffer limit
 socket.setsockopt(zmq.SUBSCRIBE, "") # subscribe to all message, since all start with ""
-# define a dtype to match the julia type
-dtype_MassCompatibleDataProductFeb2017=np.dtype([("filt_value","f4"),("filt_phase","f4"),("timestamp","f8"),("rowcount",
-"i8"),("pretrig_mean","f4"),("pretrig_rms","f4"),("pulse_average","f4"),("pulse_rms","f4"),
-("rise_time","f4"),("postpeak_deriv","f4"),("peak_index","u2"),("peak_value","u2"),("min_value","u2")])
 
 
 def apply_calibration(payload, ch):
@@ -34,7 +31,7 @@ def get_counts():
         try:
             m = socket.recv_multipart(flags=zmq.NOBLOCK)
             ch = int(m[0])
-            payload = np.fromstring(m[1],dtype_MassCompatibleDataProductFeb2017,1)[0]
+            payload = decode_payload(m[1])[0]
             print(payload)
             break
             e = apply_calibration(payload,ch)
@@ -39,10 +39,16 @@ from matplotlib.figure import Figure
 from mass.core.files import LJHFile
 import mass
 import argparse
+from receiver import ReceiverThread
+from calibration import CalibrationTable
+from cuts import CutSet
+from metrics import SnapshotWriter, format_snapshot
 
 parser = argparse.ArgumentParser(description='A work in progress program to display a live spectrum.',
     epilog="""WARNING, PROBABLY NEEDS WORK ON CUTS""")
 parser.add_argument('calibrationpath', help='path of a mass hdf5 file containing calibration info')
+parser.add_argument('--metrics_file', help='append a json line of pipeline metrics to this file every --metrics_period_s', default=None)
+parser.add_argument('--metrics_period_s', help='seconds between metrics snapshots written to --metrics_file', default=10.0, type=float)
 args = vars(parser.parse_args())
 
 
@@ -80,60 +86,7 @@ class MplCanvas(QWidget):
 
 
 ctx = zmq.Context() # context is required to create zmq socket
-socket = zmq.Socket(ctx, zmq.SUB) # make a subscriber socket
-socket.connect ("tcp://localhost:%s" % PORT) # connect to the server
-socket.set_hwm(10000) # set the recieve side message buffer limit
-socket.setsockopt(zmq.SUBSCRIBE, "") # subscribe to all message, since all start with ""
-# define a dtype to match the julia type
-dtype_MassCompatibleDataProductFeb2017=np.dtype([("filt_value","f4"),("filt_phase","f4"),("timestamp","f8"),("rowcount",
-"i8"),("pretrig_mean","f4"),("pretrig_rms","f4"),("pulse_average","f4"),("pulse_rms","f4"),
-("rise_time","f4"),("postpeak_deriv","f4"),("peak_index","u2"),("peak_value","u2"),("min_value","u2")])
-
-
-class CalFile():
-    def __init__(self, filename):
-        self.h5 = h5py.File(filename,"r")
-        print(self.h5)
-
-    def get_hdf5_group(self,ch):
-        return self.h5["chan"+str(ch)]["calibration"]
-
-    def get_calibration(self,ch):
-        hdf5_group = self.get_hdf5_group(ch)
-        return mass.EnergyCalibration.load_from_hdf5(hdf5_group,"p_filt_value")
-
-    def isbad(self,ch):
-        return "why_bad" in self.h5["chan"+str(ch)].attrs
-
-
-def apply_calibration(payload, ch, info):
-    cal=info[ch][2]
-    return cal(payload["filt_value"])
-
-def iscut(payload, ch, info):
-    info_ch = info[ch]
-    pt_lo,pt_hi = info_ch[0]
-    md_lo,md_hi = info_ch[1]
-    v=payload["filt_value"]
-    return pt_lo<v<pt_hi and md_lo<v<md_hi
-
-def get_counts(info):
-    energies = []
-    i=0
-    while True:
-        i+=1
-        # read all available message, return when none are availble
-        try:
-            m = socket.recv_multipart(flags=zmq.NOBLOCK)
-            if m[0].startswith("header"): continue
-            ch = int(m[0])
-            payload = np.fromstring(m[1],dtype_MassCompatibleDataProductFeb2017,1)[0]
-            if ch in info.keys() and not iscut(payload,ch,info):
-                energies.append(apply_calibration(payload,ch,info))
-        except zmq.ZMQError:
-            break
-    print("%d/%d payloads used"%(len(energies),i))
-    return energies
+
 
 class MyCanvas(MplCanvas):
     def __init__(self):
@@ -147,15 +100,23 @@ class MyCanvas(MplCanvas):
             grp = calfile[k]
             if "why_bad" in grp.attrs.keys():
                 continue
-            pt=grp["calculated_cuts"]["pretrig_rms"].value
-            md=grp["calculated_cuts"]["postpeak_deriv"].value
+            cuts=CutSet.from_channel_group(grp)
             cal=mass.EnergyCalibration.load_from_hdf5(grp["calibration"],"p_filt_value")
-            info[chnum] = (pt,md,cal)
+            # one spline evaluation per knot now, then one np.interp per channel per batch
+            cal=CalibrationTable.from_energy_range(cal, 4000, 10000, max_error=0.01)
+            print("chan%d calibration table: %d points, max error %0.4f eV"%(chnum, cal.npoints, cal.max_error()))
+            info[chnum] = (cuts,cal)
         print("mid init")
         self.info = info
         self.bin_edges = np.arange(4000,10000,1.0)
         self.bin_centers = 0.5*(self.bin_edges[1:]+self.bin_edges[:-1])
         self.counts = np.zeros_like(self.bin_centers,dtype="int")
+        # the receiver thread drains the socket and histograms, tick only takes a snapshot to render
+        self.receiver = ReceiverThread(ctx, "tcp://localhost:%s" % PORT, info, self.bin_edges, hwm=10000)
+        self.receiver.start()
+        self.metrics_writer = SnapshotWriter(args["metrics_file"], args["metrics_period_s"]) if args["metrics_file"] else None
+        # figure text rather than axes text, so it survives self.clear()
+        self.metrics_text = self.fig.text(0.99, 0.99, "", ha="right", va="top", family="monospace", fontsize=7, alpha=0.7)
         print("making timer")
         self.timer = QTimer()
         self.timer.timeout.connect(self.tick)
@@ -165,9 +126,13 @@ class MyCanvas(MplCanvas):
 
     def tick(self):
         print("tick!!")
-        energies = get_counts(self.info)
-        newcounts,_ = np.histogram(energies, self.bin_edges)
-        self.counts+=newcounts
+        tstart = time.time()
+        self.counts, stats = self.receiver.snapshot()
+        snap = self.receiver.metrics_snapshot()
+        print("%(nused)d/%(nrecords)d payloads used, %(nbad)d bad messages, %(messages_per_wake)d messages/wake (max %(max_messages_per_wake)d)"%stats)
+        if self.metrics_writer is not None:
+            self.metrics_writer.maybe_write(snap)
+        self.metrics_text.set_text(format_snapshot(snap))
         if self.checkbox.isChecked():
             self.line2d.set_ydata(self.counts)
         else:
@@ -178,6 +143,12 @@ class MyCanvas(MplCanvas):
             # self.set_yscale("log")
         self.set_title("%d counts"%(self.counts.sum()))
         self.draw()
+        self.receiver.metrics.add_render(time.time()-tstart)
+
+    def closeEvent(self, event):
+        self.receiver.stop()
+        self.receiver.join()
+        MplCanvas.closeEvent(self, event)
 
 
 if __name__=="__main__":
@@ -15,69 +15,20 @@ from matplotlib.figure import Figure
 from mass.core.files import LJHFile
 import mass
 import argparse
+from receiver import ReceiverThread
+from calibration import CalibrationTable
+from cuts import CutSet
+from metrics import SnapshotWriter, format_snapshot
 
 parser = argparse.ArgumentParser(description='A work in progress program to display a live spectrum.',
     epilog="""WARNING, PROBABLY NEEDS WORK ON CUTS""")
 parser.add_argument('calibrationpath', help='path of a mass hdf5 file containing calibration info')
+parser.add_argument('--metrics_file', help='append a json line of pipeline metrics to this file every --metrics_period_s', default=None)
+parser.add_argument('--metrics_period_s', help='seconds between metrics snapshots written to --metrics_file', default=10.0, type=float)
 args = vars(parser.parse_args())
 
 
 ctx = zmq.Context() # context is required to create zmq socket
-socket = zmq.Socket(ctx, zmq.SUB) # make a subscriber socket
-socket.connect ("tcp://localhost:%s" % PORT) # connect to the server
-socket.set_hwm(10000) # set the recieve side message buffer limit
-socket.setsockopt_string(zmq.SUBSCRIBE, "") # subscribe to all message, since all start with ""
-# define a dtype to match the julia type
-dtype_MassCompatibleDataProductFeb2017=np.dtype([("filt_value","f4"),("filt_phase","f4"),("timestamp","f8"),("rowcount",
-"i8"),("pretrig_mean","f4"),("pretrig_rms","f4"),("pulse_average","f4"),("pulse_rms","f4"),
-("rise_time","f4"),("postpeak_deriv","f4"),("peak_index","u2"),("peak_value","u2"),("min_value","u2")])
-
-
-class CalFile():
-    def __init__(self, filename):
-        self.h5 = h5py.File(filename,"r")
-        print(self.h5)
-
-    def get_hdf5_group(self,ch):
-        return self.h5["chan"+str(ch)]["calibration"]
-
-    def get_calibration(self,ch):
-        hdf5_group = self.get_hdf5_group(ch)
-        return mass.EnergyCalibration.load_from_hdf5(hdf5_group,"p_filt_value")
-
-    def isbad(self,ch):
-        return "why_bad" in self.h5["chan"+str(ch)].attrs
-
-
-def apply_calibration(payload, ch, info):
-    cal=info[ch][2]
-    return cal(payload["filt_value"])
-
-def iscut(payload, ch, info):
-    info_ch = info[ch]
-    pt_lo,pt_hi = info_ch[0]
-    md_lo,md_hi = info_ch[1]
-    v=payload["filt_value"]
-    return pt_lo<v<pt_hi and md_lo<v<md_hi
-
-def get_counts(info):
-    energies = []
-    i=0
-    while True:
-        i+=1
-        # read all available message, return when none are availble
-        try:
-            m = socket.recv_multipart(flags=zmq.NOBLOCK)
-            if m[0].startswith(b"header"): continue
-            ch = int(m[0])
-            payload = np.fromstring(m[1],dtype_MassCompatibleDataProductFeb2017,1)[0]
-            if ch in info.keys() and not iscut(payload,ch,info):
-                energies.append(apply_calibration(payload,ch,info))
-        except zmq.ZMQError:
-            break
-    print("%d/%d payloads used"%(len(energies),i))
-    return energies
-
 
 
 calfile = h5py.File("20170913/20170913_B/20170913_B_mass.hdf5","r")
@@ -87,17 +38,21 @@ for (k,v) in calfile.items():
     grp = calfile[k]
     if "why_bad" in grp.attrs.keys():
         continue
-    # pt=grp["calculated_cuts"]["pretrig_rms"].value
-    # md=grp["calculated_cuts"]["postpeak_deriv"].value
-    # pt = [0,20]
-    # md = [0,20]
+    # cuts come from calculated_cuts, all of them are evaluated over each batch by CutSet.cut_mask
+    cuts=CutSet.from_channel_group(grp)
 
     cal=mass.EnergyCalibration.load_from_hdf5(grp["calibration"],"p_filt_value_phc")
-    info[chnum] = (pt,md,cal)
+    # one spline evaluation per knot now, then one np.interp per channel per batch
+    cal=CalibrationTable.from_energy_range(cal, 4000, 10000, max_error=0.01)
+    print("chan%d calibration table: %d points, max error %0.4f eV"%(chnum, cal.npoints, cal.max_error()))
+    info[chnum] = (cuts,cal)
 print("mid init")
 bin_edges = np.arange(4000,10000,1.0)
 bin_centers = 0.5*(bin_edges[1:]+bin_edges[:-1])
 counts = np.zeros_like(bin_centers,dtype="int")
+# the receiver thread drains the socket and histograms, so a slow redraw doesn't stall ingest
+receiver = ReceiverThread(ctx, "tcp://localhost:%s" % PORT, info, bin_edges, hwm=10000)
+receiver.start()
 plt.ion()
 
 
@@ -106,19 +61,26 @@ plt.xlabel("energy (eV)")
 plt.ylabel("counts per 1 eV bin")
 line2d = plt.plot(bin_centers, counts)[0]
 plt.title("%d counts"%(counts.sum()))
+metrics_text = plt.gcf().text(0.99, 0.99, "", ha="right", va="top", family="monospace", fontsize=7, alpha=0.7)
+metrics_writer = SnapshotWriter(args["metrics_file"], args["metrics_period_s"]) if args["metrics_file"] else None
 
 def tick():
     print("tick!!")
-    energies = np.array(get_counts(info))
-    newcounts,_ = np.histogram(energies[~np.isnan(energies)], bin_edges)
     global counts
-    counts+=newcounts
+    tstart = time.time()
+    counts, stats = receiver.snapshot()
+    snap = receiver.metrics_snapshot()
+    print("%(nused)d/%(nrecords)d payloads used, %(nbad)d bad messages, %(messages_per_wake)d messages/wake (max %(max_messages_per_wake)d)"%stats)
+    if metrics_writer is not None:
+        metrics_writer.maybe_write(snap)
+    metrics_text.set_text(format_snapshot(snap))
     global line2d
     line2d.set_ydata(counts)
     ilo,ihi = np.searchsorted(bin_centers, plt.xlim())
     plt.ylim(0,np.max(counts[ilo:ihi])*1.05)
     plt.draw()
     plt.show()
+    receiver.metrics.add_render(time.time()-tstart)
 
 while True:
     tick()
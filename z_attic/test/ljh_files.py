@@ -0,0 +1,58 @@
+# Writes small LJH 2.x files for the tests in this directory, in the layout ljh.LJHFile and src/LJH.jl read,
+# and makes the noise and pulse records that go in them.
+
+import numpy as np
+
+FRAMETIME = 9.6e-6
+
+HEADER = """#LJH Memorial File Format
+Save File Format Version: %(version)s
+Channel: %(channel)d
+Timebase: %(frametime)r
+Total Samples: %(nsamples)d
+Presamples: %(npresamples)d
+Number of rows: 30
+Number of columns: 8
+Row number (from 0-29 inclusive): 2
+Column number (from 0-7 inclusive): 1
+#End of Header
+"""
+
+def ljh_header(nsamples, npresamples, version="2.2.0", channel=3, frametime=FRAMETIME):
+    return (HEADER%dict(version=version, channel=channel, frametime=frametime, nsamples=nsamples,
+        npresamples=npresamples)).encode()
+
+def record_bytes(samples, version="2.2.0", rowcount=None, timestamp_usec=None, header=None):
+    """Return the records of the `(n, nsamples)` `samples` as bytes, with the 16 byte headers of 2.2 or the 6 of 2.0 and 2.1."""
+    import ljh
+    samples = np.asarray(samples)
+    records = np.zeros(len(samples), ljh.record_dtype(version, samples.shape[1]))
+    records["samples"] = samples
+    if "rowcount" in records.dtype.names:
+        records["rowcount"] = np.arange(len(samples))*1000 if rowcount is None else rowcount
+        records["timestamp_usec"] = np.arange(len(samples))*9600 if timestamp_usec is None else timestamp_usec
+    elif header is not None:
+        records["header"] = header
+    return records.tobytes()
+
+def write_ljh(filename, samples, npresamples, version="2.2.0", channel=3, frametime=FRAMETIME, **kwargs):
+    """Write the `(n, nsamples)` uint16 `samples` to the LJH file `filename`, `kwargs` go to `record_bytes`."""
+    samples = np.asarray(samples)
+    with open(filename, "wb") as f:
+        f.write(ljh_header(samples.shape[1], npresamples, version, channel, frametime))
+        f.write(record_bytes(samples, version, **kwargs))
+    return filename
+
+def noise_records(nrecords, nsamples, seed=0, baseline=1000, sigma=5.0):
+    rng = np.random.RandomState(seed)
+    return np.round(baseline+rng.normal(0, sigma, (nrecords, nsamples))).astype(np.uint16)
+
+def pulse_records(nrecords, nsamples, npresamples, seed=0, baseline=1000, sigma=5.0, amps=(2000.0,), tau_rise=3.0, tau_fall=30.0):
+    """Two exponential pulses starting within a sample of `npresamples`, with amplitudes drawn from `amps`, on noise."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(nsamples)
+    t0 = npresamples+rng.uniform(-1, 1, nrecords)
+    dt = np.maximum(t[None,:]-t0[:,None], 0)
+    amp = rng.choice(amps, nrecords)
+    x = baseline+amp[:,None]*(np.exp(-dt/tau_fall)-np.exp(-dt/tau_rise))+rng.normal(0, sigma, (nrecords, nsamples))
+    return np.round(np.clip(x, 0, 2**16-1)).astype(np.uint16)
@@ -0,0 +1,102 @@
+# Basis training of scripts/basis_training.py: the randomized SVD against numpy's, the randomized training against
+# the full SVD one, and a whole run over LJH files written here, read back like basis_create.jl output. Run with
+# pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import pytest
+import h5py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import basis_training
+from basis_training import randomized_svd, create_basis_one_channel, mass3_basis
+import noise_analysis
+import projectors
+from ljh_files import write_ljh, pulse_records, noise_records
+
+NSAMPLES = 120
+NPRESAMPLES = 30
+
+def pulse_data(n=400, seed=0):
+    """`(NSAMPLES, n)` pulses of two shapes and random sizes, like `basis_training.getall` returns."""
+    rng = np.random.RandomState(seed)
+    a = pulse_records(n, NSAMPLES, NPRESAMPLES, seed=seed, amps=(500.0, 2000.0, 4000.0))
+    b = pulse_records(n, NSAMPLES, NPRESAMPLES, seed=seed+1, amps=(1000.0,), tau_rise=1.0, tau_fall=10.0)
+    use_b = rng.uniform(size=n) < 0.3
+    return np.where(use_b[None,:], b.T, a.T).astype(np.float32)
+
+def noise_autocorr(seed=0):
+    samples = noise_records(200, NSAMPLES, seed=seed)
+    s = noise_analysis.NoiseSpectra(samples.size, 9.6e-6, NSAMPLES, NSAMPLES//2+1)
+    s.add(samples)
+    return s.result()
+
+def max_principal_angle(a, b):
+    qa, qb = np.linalg.qr(a)[0], np.linalg.qr(b)[0]
+    return np.arccos(np.clip(np.linalg.svd(qa.T.dot(qb), compute_uv=False).min(), -1, 1))
+
+def test_randomized_svd():
+    rng = np.random.RandomState(1)
+    a = rng.normal(size=(200, 5)).dot(np.diag([100, 50, 20, 10, 5])).dot(rng.normal(size=(5, 300)))+0.01*rng.normal(size=(200, 300))
+    u, s, q = randomized_svd(a, 4)
+    u0, s0, _ = np.linalg.svd(a, full_matrices=False)
+    np.testing.assert_allclose(s, s0[:4], rtol=1e-6)
+    assert max_principal_angle(u, u0[:,:4]) < 1e-4
+    # warm started from its own range with no power iterations it is just as good
+    u2, s2, _ = randomized_svd(a, 4, start=q, n_iter=0)
+    np.testing.assert_allclose(s2, s0[:4], rtol=1e-6)
+
+@pytest.mark.parametrize("tsvd_method", ["TSVD", "noisemass3"])
+def test_randomized_matches_full(tsvd_method):
+    data = pulse_data()
+    autocorr = noise_autocorr()["autocorr"]
+    args = (data, autocorr, 0.8, 3, 300, 5, tsvd_method, NPRESAMPLES)
+    full = create_basis_one_channel(*args, svd="full")
+    rand = create_basis_one_channel(*args, svd="randomized")
+    assert max_principal_angle(full["basis"], rand["basis"]) < 1e-3
+    np.testing.assert_allclose(rand["std_residuals"], full["std_residuals"], rtol=1e-3)
+    if tsvd_method == "noisemass3":
+        assert np.all(rand["basis"][:,0] == 1)
+        assert np.all(np.isnan(rand["singular_values"][:3]))
+    p = rand["projectors"]
+    np.testing.assert_allclose(p.dot(rand["basis"]), np.eye(5), atol=1e-6)
+    assert rand["example_pulses"].shape == (NSAMPLES, len(basis_training.PERCENTILES))
+    # the first loop's 3 component basis needs no SVD with noisemass3
+    assert rand["nsvd"] == (2 if tsvd_method == "noisemass3" else 3)
+
+def test_mass3_basis():
+    data = pulse_data(50).astype(np.float64)
+    b = mass3_basis(data, NPRESAMPLES)
+    assert np.all(b[:,0] == 1)
+    assert np.all(b[:NPRESAMPLES,2] == 0) and np.abs(b[:,2]).max() == 1
+    np.testing.assert_allclose(b[1:,1], np.diff(b[:,2]))
+
+def test_channel_files(tmp_path):
+    for name in ["run_chan1.ljh", "run_chan13.ljh", "run_chan3.ljh", "run_chan3.ljh.offsets", "other_chan2.ljh"]:
+        open(str(tmp_path/name), "w").close()
+    pulse_file = str(tmp_path/"run_chan3.ljh")
+    assert basis_training.dir_base_ext(pulse_file) == (str(tmp_path), "run", ".ljh")
+    files = basis_training.ljh_channel_files(pulse_file, 2)
+    assert files == {1:str(tmp_path/"run_chan1.ljh"), 3:pulse_file}
+
+def test_make_basis_all_channel(tmp_path):
+    pulse_files = {}
+    results = {}
+    for ch in [1, 3, 5]:
+        pulse_files[ch] = write_ljh(str(tmp_path/("run_chan%d.ljh"%ch)), pulse_data(300, seed=ch).T.astype(np.uint16),
+            NPRESAMPLES, channel=ch)
+        if ch != 5: # no noise for chan5, so it is skipped
+            results[ch] = noise_autocorr(seed=ch)
+    noise_file = noise_analysis.write_noise_results(str(tmp_path/"noise.hdf5"), results)
+    output = str(tmp_path/"run_model.hdf5")
+    summary = basis_training.make_basis_all_channel(output, pulse_files, noise_file, n_loop=3, n_pulses_for_train=200,
+        n_basis=5, workers=1)
+    assert sorted(summary) == [1, 3]
+    with h5py.File(output, "r") as h5:
+        bases, autocorrs, stored = projectors.read_model_bases(h5)
+        assert bases[1].shape == (NSAMPLES, 5)
+        np.testing.assert_allclose(autocorrs[3], results[3]["autocorr"])
+        assert h5["3/tsvd_method"][()] == b"noisemass3"
+        assert h5["3/example_pulses"].shape == (len(basis_training.PERCENTILES), NSAMPLES)
+    # the projectors were written transposed, as basis_create.jl does, and agree with a fresh computation
+    assert max(projectors.check_model_projectors(output).values()) < 1e-5
@@ -0,0 +1,147 @@
+# The block at a time summaries and filtering of scripts/batch_filter.py against record at a time loops
+# translated line by line from summarize and filter_single_lag in z_attic/src/summarize.jl and
+# z_attic/src/apply_filter.jl, run with pytest from this directory. Indices in the loops are 1 based like the julia.
+
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import batch_filter
+
+NSAMPLES = 200
+NPRESAMPLES = 50
+FRAMETIME = 9.6e-6
+PEAK_INDEX = 80 # the average pulse peak, 1 based
+
+def julia_estimate_rise_time(p, first, peakindex, peakval, ptm, frametime):
+    idx10 = first
+    if peakindex > len(p) or peakindex < first:
+        return float(len(p))
+    idx90 = peakindex
+    thresh10 = 0.1*(peakval-ptm)+ptm
+    thresh90 = 0.9*(peakval-ptm)+ptm
+    for j in range(idx10, peakindex+1):
+        if p[j-1] > thresh10:
+            idx10 = j-1
+            break
+    for j in range(idx10+1, peakindex+1):
+        if p[j-1] > thresh90:
+            idx90 = j-1
+            break
+    rise = (int(p[idx90-1])-int(p[idx10-1]))%2**16 # UInt16 subtraction wraps
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fracrise = np.float64(rise)/(peakval-ptm)
+        return (idx90-idx10)*frametime/fracrise
+
+def julia_max_timeseries_deriv_mass(p, s):
+    p = [int(x) for x in p]
+    N = len(p)
+    k1, k2, k3, k4, k5 = batch_filter.DERIV_KERNEL
+    t = lambda m: k5*p[m-1]+k4*p[m]+k3*p[m+1]+k2*p[m+2]+k1*p[m+3] # the kernel at window start m, 1 based
+    t0, t1, t2 = t(s+1), t(s+2), t(s+3)
+    t_max_deriv = min(t2, t0)
+    for j in range(s+8, N+1):
+        t3 = t(j-4)
+        t4 = t3 if t3 < t1 else t1
+        t_max_deriv = max(t4, t_max_deriv)
+        t0, t1, t2 = t1, t2, t3
+    return t_max_deriv/10.0
+
+def julia_summarize(data, npresamples, average_pulse_peak_index, frametime):
+    s = s2 = 0
+    peak_idx = peak_val = 0
+    min_val = 2**63-1
+    for j in range(1, len(data)+1):
+        if j == npresamples+1:
+            ptm = s/npresamples
+            pretrig_rms = np.sqrt(abs(s2/npresamples-ptm*ptm))
+            s = s2 = 0
+        d = int(data[j-1])
+        if d > peak_val:
+            peak_idx, peak_val = j, d
+        elif d < min_val:
+            min_val = d
+        s += d
+        s2 += d*d
+    npostsamples = len(data)-npresamples
+    pulse_average = s/npostsamples-ptm
+    return dict(
+        pretrig_mean=ptm,
+        pretrig_rms=pretrig_rms,
+        pulse_average=pulse_average,
+        pulse_rms=np.sqrt(abs(s2/npostsamples-ptm*(ptm+2*pulse_average))),
+        rise_time=julia_estimate_rise_time(data, npresamples+1, peak_idx, peak_val, ptm, frametime),
+        postpeak_deriv=julia_max_timeseries_deriv_mass(data, average_pulse_peak_index),
+        peak_index=peak_idx,
+        peak_value=int(round(peak_val-ptm)) if 0 <= peak_val-ptm <= 2**16-1 else 0,
+        min_value=min_val,
+    )
+
+def julia_filter_single_lag(data, filter, filter_at, pretrig_mean, npresamples, shift_threshold):
+    data = data.astype(np.float64)
+    x = data[:-1] if data[npresamples+2]-pretrig_mean > shift_threshold else data[1:]
+    conv0 = np.dot(x, filter)
+    conv1 = np.dot(x, filter_at)
+    return conv1/conv0, conv0
+
+def records(n=300, seed=0):
+    """Pulses of random size and arrival on noise, and a few odd records that take the less common branches."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(NSAMPLES)
+    samples = np.zeros((n, NSAMPLES))
+    for i in range(n):
+        t0 = NPRESAMPLES+rng.uniform(-2, 2)
+        dt = np.maximum(t-t0, 0)
+        amp = rng.choice([0, 200, 3000, 20000])
+        samples[i] = 1000+amp*(np.exp(-dt/30)-np.exp(-dt/3))+rng.normal(0, 10, NSAMPLES)
+    samples = np.clip(np.round(samples), 0, 2**16-1).astype(np.uint16)
+    samples[0] = 0 # no peak at all
+    samples[1] = 500
+    samples[1, 0] = 400 # the first sample is the minimum and also the first running peak
+    samples[2, 10] = 60000 # peak in the pretrigger, so the rise time search range is empty
+    samples[3, 0] = 1 # a first sample minimum below everything else
+    return samples
+
+def test_summarize_batch_matches_loop():
+    samples = records()
+    batch = batch_filter.summarize_batch(samples, NPRESAMPLES, PEAK_INDEX, FRAMETIME)
+    for (i, p) in enumerate(samples):
+        expected = julia_summarize(p, NPRESAMPLES, PEAK_INDEX, FRAMETIME)
+        for (name, v) in expected.items():
+            if name in ("peak_index", "peak_value", "min_value"):
+                assert batch[name][i] == v, (i, name)
+            else:
+                np.testing.assert_allclose(batch[name][i], v, rtol=1e-12, atol=1e-12, err_msg="record %d %s"%(i, name))
+
+def test_filter_single_lag_batch_matches_loop():
+    samples = records(seed=1)
+    rng = np.random.RandomState(2)
+    filter, filter_at = rng.normal(size=(2, NSAMPLES-1))
+    ptm = samples[:,:NPRESAMPLES].mean(axis=1)
+    shift_threshold = 50
+    phase, value = batch_filter.filter_single_lag_batch(samples[4:], np.column_stack((filter, filter_at)), ptm[4:],
+        NPRESAMPLES, shift_threshold)
+    nshift = 0
+    for (i, p) in enumerate(samples[4:]):
+        expected = julia_filter_single_lag(p, filter, filter_at, ptm[i+4], NPRESAMPLES, shift_threshold)
+        nshift += p[NPRESAMPLES+2]-ptm[i+4] > shift_threshold
+        np.testing.assert_allclose((phase[i], value[i]), expected, rtol=1e-10)
+    assert 0 < nshift < len(samples)-4 # both branches were taken
+
+def test_analyze_fields():
+    samples = records(50, seed=3)
+    rng = np.random.RandomState(4)
+    filter, filter_at = rng.normal(size=(2, NSAMPLES-1))
+    analysis = batch_filter.MassCompatibleAnalysis(filter, filter_at, NPRESAMPLES, NSAMPLES, PEAK_INDEX, FRAMETIME, 50,
+        [0.0, 30.0], [0.0, 20.0])
+    rowcount = np.arange(50)*1000
+    timestamp_usec = 1500000000000000+np.arange(50)*2000
+    out = analysis.analyze(samples, rowcount, timestamp_usec)
+    assert np.array_equal(out["rowcount"], rowcount)
+    np.testing.assert_allclose(out["timestamp"], timestamp_usec/1e6)
+    summary = batch_filter.summarize_batch(samples, NPRESAMPLES, PEAK_INDEX, FRAMETIME)
+    assert np.array_equal(out["peak_index"], summary["peak_index"])
+    with pytest.raises(ValueError):
+        batch_filter.MassCompatibleAnalysis(filter[1:], filter_at, NPRESAMPLES, NSAMPLES, PEAK_INDEX, FRAMETIME, 50,
+            [0.0, 30.0], [0.0, 20.0])
@@ -0,0 +1,46 @@
+# Calibration lookup tables of scripts/calibration.py against the calibration they tabulate, run with pytest from
+# this directory. A quadratic stands in for mass.EnergyCalibration.
+
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from calibration import CalibrationTable
+
+class QuadraticCalibration():
+    """energy = a*ph+b*ph**2, with the `energy2ph` inverse that `CalibrationTable.from_energy_range` uses."""
+    a, b = 0.5, 2e-6
+    def __call__(self, ph):
+        ph = np.asarray(ph, dtype=np.float64)
+        return self.a*ph+self.b*ph**2
+    def energy2ph(self, energy):
+        return (-self.a+np.sqrt(self.a**2+4*self.b*energy))/(2*self.b)
+
+def test_max_error():
+    cal = QuadraticCalibration()
+    table = CalibrationTable.with_max_error(cal, 0, 20000, max_error=0.01)
+    x = np.random.RandomState(0).uniform(0, 20000, 10000)
+    assert np.abs(table(x)-cal(x)).max() <= 0.01
+    assert table.max_error() <= 0.01
+    # the knots double from 256 until they are fine enough, and not past that
+    assert CalibrationTable(cal, 0, 20000, table.npoints//2).max_error() > 0.01
+
+def test_outside_range():
+    cal = QuadraticCalibration()
+    table = CalibrationTable(cal, 1000, 2000, npoints=16)
+    x = np.array([0.0, 500.0, 2500.0, 1e5])
+    assert np.allclose(table(x), cal(x), rtol=1e-12)
+
+def test_from_energy_range():
+    cal = QuadraticCalibration()
+    table = CalibrationTable.from_energy_range(cal, 4000, 10000, max_error=0.05, margin=0.1)
+    assert table.lo == pytest.approx(cal.energy2ph(3400))
+    assert table.hi == pytest.approx(cal.energy2ph(10600))
+    assert table.max_error() <= 0.05
+
+def test_not_monotone():
+    with pytest.raises(ValueError):
+        CalibrationTable(lambda x: -np.asarray(x), 0, 10)
+    with pytest.raises(ValueError):
+        CalibrationTable(QuadraticCalibration(), 10, 10)
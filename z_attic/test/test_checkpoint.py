@@ -0,0 +1,40 @@
+# Stage checkpoints of scripts/checkpoint.py, run with pytest from this directory.
+
+import os
+import sys
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from checkpoint import ChannelCheckpoint, stage_key
+from ljh_files import write_ljh, noise_records
+
+def test_stage_key(tmp_path):
+    filename = write_ljh(str(tmp_path/"a.ljh"), noise_records(4, 20), 5)
+    key = stage_key("cuts", [filename], dict(nsigma=7), ["abc"])
+    assert key == stage_key("cuts", [filename], dict(nsigma=7), ["abc"])
+    assert key != stage_key("cuts", [filename], dict(nsigma=8), ["abc"])
+    assert key != stage_key("cuts", [filename], dict(nsigma=7), ["abd"])
+    assert key != stage_key("summarize", [filename], dict(nsigma=7), ["abc"])
+    # appending records changes the file's size, so the key
+    write_ljh(filename, noise_records(5, 20), 5)
+    assert key != stage_key("cuts", [filename], dict(nsigma=7), ["abc"])
+
+def test_resume(tmp_path):
+    dirname = str(tmp_path/"checkpoints")
+    required = str(tmp_path/"mass.hdf5")
+    open(required, "w").close()
+    c = ChannelCheckpoint(dirname, 3, requires=[required])
+    assert c.get("summarize", "k1") is None
+    c.put("summarize", "k1", dict(peak_index=80))
+    c.put("cuts", "k2")
+    with open(os.path.join(dirname, "chan3.json")) as f:
+        assert sorted(json.load(f)) == ["cuts", "summarize"] # written on every put
+    c = ChannelCheckpoint(dirname, 3, requires=[required])
+    assert c.get("summarize", "k1") == dict(peak_index=80)
+    assert c.get("cuts", "other key") is None
+    assert c.key("cuts") == "k2" and c.key("filter") is None
+    assert c.describe() == "chan3: reused summarize, computed cuts"
+    # without resume, or with a required file gone, the checkpoints are discarded
+    assert ChannelCheckpoint(dirname, 3, resume=False).get("summarize", "k1") is None
+    ChannelCheckpoint(dirname, 3).put("summarize", "k1")
+    os.remove(required)
+    assert ChannelCheckpoint(dirname, 3, requires=[required]).get("summarize", "k1") is None
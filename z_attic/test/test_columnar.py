@@ -0,0 +1,84 @@
+# Queries of scripts/columnar.py exports against evaluating the same cuts with CutSet over whole columns,
+# run with pytest from this directory. The synthetic Pope file has a chunk of only NaN, a chunk with a few NaN,
+# a timestamp ordered column and a noisy stretch that fails the cuts.
+
+import os
+import sys
+import numpy as np
+import h5py
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from cuts import CutSet
+import columnar
+
+CHUNKSIZE = 100
+NRECORDS = 1050 # 11 chunks, the last one short
+
+def pope_records(seed=0):
+    rng = np.random.RandomState(seed)
+    records = np.zeros(NRECORDS, dtype_MassCompatibleDataProductFeb2017)
+    records["filt_value"] = rng.uniform(0, 20000, NRECORDS)
+    records["timestamp"] = np.cumsum(rng.exponential(0.01, NRECORDS))
+    records["pretrig_rms"] = rng.exponential(5, NRECORDS)
+    records["postpeak_deriv"] = rng.exponential(4, NRECORDS)
+    records["pretrig_rms"][200:300] = np.nan
+    records["pretrig_rms"][[410, 455]] = np.nan
+    records["postpeak_deriv"][600:800] += 100
+    return records
+
+@pytest.fixture
+def exported(tmp_path):
+    records = pope_records()
+    pope_filename = str(tmp_path/"pope.hdf5")
+    with h5py.File(pope_filename, "w") as h5:
+        g = h5.create_group("chan3")
+        for name in dtype_MassCompatibleDataProductFeb2017.names:
+            g[name] = records[name]
+        g.create_group("calculated_cuts")
+        g["calculated_cuts"]["pretrig_rms"] = np.array([0.0, 30.0])
+        g["calculated_cuts"]["postpeak_deriv"] = np.array([0.0, 20.0])
+    filename = str(tmp_path/"columnar.hdf5")
+    columnar.export_columnar(pope_filename, filename, chunksize=CHUNKSIZE)
+    return records, filename
+
+def test_chunk_stats():
+    assert columnar.chunk_stats(np.array([3.0, np.nan, -1.0])) == (-1.0, 3.0, 1)
+    lo, hi, nnan = columnar.chunk_stats(np.array([np.nan, np.nan]))
+    assert np.isnan(lo) and np.isnan(hi) and nnan == 2
+    assert columnar.chunk_stats(np.array([4, 7], dtype=np.uint16)) == (4, 7, 0)
+
+def test_nan_fails_cuts():
+    records = np.zeros(3, dtype_MassCompatibleDataProductFeb2017)
+    records["pretrig_rms"] = [1.0, np.nan, 50.0]
+    cuts = CutSet({"pretrig_rms":(None, 30.0)})
+    assert list(cuts.cut_mask(records)) == [False, True, True]
+    cut, counts = cuts.cut_mask_counts(records)
+    assert list(cut) == [False, True, True] and counts == {"pretrig_rms":2}
+    assert list(cuts.cut_masks(records)["pretrig_rms"]) == [False, True, True]
+
+def test_query_matches_cutset(exported):
+    records, filename = exported
+    with columnar.ColumnarFile(filename) as f:
+        channel = f[3]
+        assert len(channel) == NRECORDS
+        cuts = channel.cuts()
+        columns, info = channel.query(["filt_value", "timestamp"], cuts)
+        good = cuts.good(records)
+        assert np.array_equal(columns["filt_value"], records["filt_value"][good])
+        assert np.array_equal(columns["timestamp"], records["timestamp"][good])
+        # the all NaN chunk and the two chunks of the noisy stretch are never read
+        assert info["nchunks"] == 11
+        assert info["nskipped"] == 3
+        # no chunk with a NaN is taken whole
+        skip, whole = channel.chunk_plan(cuts)
+        assert skip[2] and not whole[4]
+
+def test_query_range(exported):
+    records, filename = exported
+    t = records["timestamp"]
+    lo, hi = t[333], t[512]
+    with columnar.ColumnarFile(filename) as f:
+        columns, info = f[3].query(["filt_value"], {"timestamp":(lo, hi)})
+    assert np.array_equal(columns["filt_value"], records["filt_value"][333:513])
+    assert info["nskipped"] == 8
@@ -0,0 +1,62 @@
+# CutSet of scripts/cuts.py against the cut rule written out per record, and its hdf5 round trips, run with
+# pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import h5py
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from dataproduct import dtype_MassCompatibleDataProductFeb2017
+from cuts import CutSet, load_cuts
+
+def records(n=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    r = np.zeros(n, dtype_MassCompatibleDataProductFeb2017)
+    r["pretrig_rms"] = rng.exponential(5, n)
+    r["postpeak_deriv"] = rng.exponential(4, n)
+    r["rise_time"] = rng.uniform(0, 1e-3, n)
+    r["peak_index"] = rng.randint(0, 200, n)
+    r["pretrig_rms"][::97] = np.nan
+    return r
+
+LIMITS = {"pretrigger_rms":(None, 12.0), "postpeak_deriv":(1.0, 9.0), "rise_time_ms":(0.1, 0.8), "peak_index":(60, None),
+    "pulse_rms":None}
+
+def test_cut_mask_matches_loop():
+    r = records()
+    cuts = CutSet(LIMITS)
+    assert len(cuts) == 4 # None limits are no cut at all
+    expected = np.zeros(len(r), dtype=bool)
+    for i in range(len(r)):
+        for (field, scale, (lo, hi)) in [("pretrig_rms", 1.0, LIMITS["pretrigger_rms"]), ("postpeak_deriv", 1.0, LIMITS["postpeak_deriv"]),
+                ("rise_time", 1e3, LIMITS["rise_time_ms"]), ("peak_index", 1.0, LIMITS["peak_index"])]:
+            v = scale*r[field][i]
+            if not ((lo is None or v >= lo) and (hi is None or v <= hi)): # NaN fails
+                expected[i] = True
+    assert np.array_equal(cuts.cut_mask(r), expected)
+    assert np.array_equal(cuts.good(r), ~expected)
+    cut, counts = cuts.cut_mask_counts(r)
+    masks = cuts.cut_masks(r)
+    assert np.array_equal(cut, expected)
+    assert counts == {name:int(m.sum()) for (name, m) in masks.items()}
+    assert np.array_equal(np.any(list(masks.values()), axis=0), expected)
+
+def test_unknown_cut():
+    with pytest.raises(ValueError):
+        CutSet({"pretrigger_rsm":(0, 1)})
+
+def test_hdf5_round_trip(tmp_path):
+    cuts = CutSet(LIMITS)
+    filename = str(tmp_path/"cuts.hdf5")
+    with h5py.File(filename, "w") as h5:
+        cuts.write_hdf5(h5.create_group("chan3/cuts"))
+        CutSet({"pretrig_rms":(0.0, 30.0)}).write_hdf5(h5.create_group("chan5/calculated_cuts"))
+        h5.create_group("chan7")
+    loaded = load_cuts(filename)
+    assert sorted(loaded) == [3, 5, 7]
+    assert dict(zip(loaded[3].names, loaded[3].limits)) == dict(zip(cuts.names, cuts.limits))
+    r = records()
+    assert np.array_equal(loaded[3].cut_mask(r), cuts.cut_mask(r))
+    assert loaded[5].names == ["pretrig_rms"] and loaded[5].limits == [(0.0, 30.0)]
+    assert len(loaded[7]) == 0 and not loaded[7].cut_mask(r).any()
@@ -0,0 +1,34 @@
+# Decoding of Pope's zmq payloads in scripts/dataproduct.py, run with pytest from this directory.
+# Payloads are packed here with struct the way Julia lays out MassCompatibleDataProductFeb2017,
+# 54 bytes of fields and 2 bytes of padding at the end, sizeof 56.
+
+import os
+import sys
+import struct
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from dataproduct import dtype_MassCompatibleDataProductFeb2017, decode_payload, RecordRing
+
+# the fields of MassCompatibleDataProductFeb2017(1,2,3,4,5,6,7,8,9,10,11,12,13), as in zmq_datasink.jl
+FIELDS = (1.0, 2.0, 3.0, 4, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11, 12, 13)
+
+def julia_payload(fields=FIELDS):
+    return struct.pack("<ffdqffffffHHH2x", *fields)
+
+def test_payload_size():
+    assert len(julia_payload()) == 56
+    assert dtype_MassCompatibleDataProductFeb2017.itemsize == 56
+
+def test_decode_payload():
+    records = decode_payload(julia_payload())
+    assert len(records) == 1
+    assert tuple(records[0].tolist()) == FIELDS
+
+def test_ring_push():
+    ring = RecordRing(4)
+    assert ring.push(3, julia_payload()) == 1
+    assert ring.push(5, julia_payload()*2) == 2
+    channels, records = ring.batch()
+    assert list(channels) == [3, 5, 5]
+    assert all(tuple(r.tolist()) == FIELDS for r in records)
+    assert np.all(records["min_value"] == 13)
@@ -0,0 +1,62 @@
+# Incremental histograms of scripts/histogram.py against np.histogram, run with pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from histogram import UniformHistogram, RollingCounts, Spectra
+
+def energies(n, seed=0):
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(3900, 10100, n)
+    x[:5] = [4000.0, 10000.0, 3999.999, 10000.001, np.nan] # both edges, just outside them, and NaN
+    return x
+
+@pytest.mark.parametrize("n", [10, 100000]) # the sparse np.add.at path and the bincount path
+def test_matches_np_histogram(n):
+    bin_edges = np.arange(4000, 10001, 2.0)
+    h = UniformHistogram.from_edges(bin_edges)
+    assert np.allclose(h.bin_edges, bin_edges)
+    x = energies(n)
+    h.add(x[:n//2])
+    h.add(x[n//2:])
+    assert np.array_equal(h.counts, np.histogram(x[np.isfinite(x)], bin_edges)[0])
+    h.clear()
+    assert h.counts.sum() == 0
+
+def test_bad_binning():
+    with pytest.raises(ValueError):
+        UniformHistogram(10, 10, 1)
+    with pytest.raises(ValueError):
+        UniformHistogram.from_edges([0, 1, 3])
+
+def test_rolling_counts():
+    r = RollingCounts(3, window_s=3, slice_s=1.0)
+    for (t, i) in [(0.5, 0), (1.5, 1), (2.5, 2), (2.7, 2)]:
+        for counts in r.targets(t):
+            counts[i] += 1
+    assert list(r.counts) == [1, 1, 2]
+    r.advance(3.1) # the slice from 0 to 1 s expires
+    assert list(r.counts) == [0, 1, 2]
+    r.advance(100.0) # everything expires at once
+    assert list(r.counts) == [0, 0, 0]
+
+def test_spectra():
+    bin_edges = np.arange(4000, 10001, 10.0)
+    s = Spectra.from_edges(bin_edges, rois={"fe":(6390, 6410)}, window_s=10)
+    s.add_binning("coarse", 0, 20000, 100)
+    x1, x2 = energies(1000, seed=1), energies(500, seed=2)
+    s.add(1, x1, t=0.0)
+    s.add(2, x2, t=20.0)
+    both = np.hstack((x1, x2))
+    both = both[np.isfinite(both)]
+    assert np.array_equal(s.counts, np.histogram(both, bin_edges)[0])
+    assert np.array_equal(s.channel(1).counts, np.histogram(x1[np.isfinite(x1)], bin_edges)[0])
+    assert s.roi_counts["fe"] == np.count_nonzero((both >= 6390)&(both < 6410))
+    assert s.roi_channel_counts["fe"][2] == np.count_nonzero((x2 >= 6390)&(x2 < 6410))
+    assert np.array_equal(s.binnings["coarse"].counts, np.histogram(both, np.arange(0, 20001, 100.0))[0])
+    # only the second batch is in the last 10 s
+    assert np.array_equal(s.window_counts(t=20.0), np.histogram(x2[np.isfinite(x2)], bin_edges)[0])
+    with pytest.raises(ValueError):
+        Spectra(0, 10, 1).window_counts()
@@ -0,0 +1,61 @@
+# Reading LJH 2.x files with scripts/ljh.py, run with pytest from this directory.
+
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import ljh
+from ljh_files import write_ljh, record_bytes, noise_records, FRAMETIME
+
+def test_read_22(tmp_path):
+    samples = noise_records(10, 100)
+    rowcount = np.arange(10)*3000+7
+    timestamp_usec = 1500000000000000+np.arange(10)*2880
+    filename = write_ljh(str(tmp_path/"a.ljh"), samples, 25, rowcount=rowcount, timestamp_usec=timestamp_usec)
+    f = ljh.LJHFile(filename)
+    assert (len(f), f.nsamples, f.npresamples, f.frametime, f.channum) == (10, 100, 25, FRAMETIME, 3)
+    assert (f.num_rows, f.row, f.num_columns, f.column) == (30, 2, 8, 1)
+    assert np.array_equal(f.samples, samples)
+    assert np.array_equal(f.rowcount, rowcount)
+    assert np.array_equal(f.timestamp_usec, timestamp_usec)
+    segments = list(f.iter_segments(4, first=1))
+    assert [(a, b, segnum) for (a, b, segnum, s) in segments] == [(1, 5, 0), (5, 9, 1), (9, 10, 2)]
+    assert np.array_equal(np.vstack([s for (a, b, segnum, s) in segments]), samples[1:])
+
+def test_decode_21(tmp_path):
+    # parse_record_header in LJH.jl for 2.1: byte 1 the 4 microsecond fraction, bytes 3-6 milliseconds
+    ms = np.array([0, 1, 123456, 2**31+5])
+    frac = np.array([0, 249, 17, 3])
+    header = np.zeros((4, 6), dtype=np.uint8)
+    header[:,0] = frac
+    for k in range(4):
+        header[:,2+k] = (ms>>(8*k))&0xff
+    filename = write_ljh(str(tmp_path/"a.ljh"), noise_records(4, 20), 5, version="2.1.0", header=header)
+    f = ljh.LJHFile(filename)
+    count_4usec = 250*ms+frac
+    count_frame = -(-count_4usec*4000//9600) # cld(count_nsec, ns_per_frame)
+    assert np.array_equal(f.rowcount, count_frame*30+2)
+    assert np.array_equal(f.timestamp_usec, 4*count_4usec)
+
+def test_refresh_and_follow(tmp_path):
+    samples = noise_records(6, 50)
+    filename = write_ljh(str(tmp_path/"a.ljh"), samples[:2], 10)
+    f = ljh.LJHFile(filename)
+    assert len(f) == 2
+    data = record_bytes(samples[2:], rowcount=np.arange(2, 6)*1000, timestamp_usec=np.arange(2, 6)*9600)
+    nbytes = f.record_nbytes
+    with open(filename, "ab") as out:
+        out.write(data[:nbytes+10]) # one record and part of the next
+    assert f.refresh() == 1
+    assert f.refresh() == 0
+    with open(filename, "ab") as out:
+        out.write(data[nbytes+10:])
+    batches = list(f.follow(poll_s=0.01, timeout_s=0.05, first=1))
+    assert [(a, b) for (a, b, records) in batches] == [(1, 6)]
+    assert np.array_equal(batches[0][2]["samples"], samples[1:])
+    assert np.array_equal(f.rowcount, np.arange(6)*1000)
+
+def test_empty(tmp_path):
+    filename = write_ljh(str(tmp_path/"a.ljh"), np.zeros((0, 30), np.uint16), 10)
+    f = ljh.LJHFile(filename)
+    assert len(f) == 0 and f.samples.shape == (0, 30)
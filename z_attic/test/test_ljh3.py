@@ -0,0 +1,105 @@
+# LJH3 files written with scripts/ljh3.py's LJH3Writer and read back with LJH3File, including the offsets sidecar
+# and records appended while the file is open, run with pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import ljh3
+from ljh3 import LJH3File, LJH3Writer
+
+FRAMEPERIOD = 4e-7
+
+def make_records(n, seed=0):
+    """Records in runs of the same length, longer than the first scan block, with some short runs and empty records."""
+    rng = np.random.RandomState(seed)
+    lengths = np.repeat([100, 7, 100, 0, 250], [200, 3, 40, 1, n-244])[:n]
+    samples = [rng.randint(0, 2**16, k).astype(np.uint16) for k in lengths]
+    headers = [(int(rng.randint(0, 50)), 1000*i+5, 1500000000000000+10*i) for i in range(n)]
+    return samples, headers
+
+def write_records(writer, samples, headers):
+    for (s, h) in zip(samples, headers):
+        writer.write(s, *h)
+
+def check_records(f, samples, headers):
+    assert len(f) == len(samples)
+    assert list(f.record_nsamples) == [len(s) for s in samples]
+    h, s = f.read_range(0, len(f))
+    for i in range(len(f)):
+        assert np.array_equal(s[i], samples[i])
+        assert tuple(h[i].tolist()) == (len(samples[i]),)+headers[i]
+    h, s = f[-1]
+    assert np.array_equal(s, samples[-1]) and h["frame1index"] == headers[-1][1]
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path/"a.ljh3")
+    samples, headers = make_records(300)
+    with LJH3Writer(filename, FRAMEPERIOD, {"Channel":5}) as w:
+        write_records(w, samples, headers)
+    assert ljh3.is_ljh3(filename)
+    with LJH3File(filename) as f:
+        assert f.frameperiod == FRAMEPERIOD and f.header["Channel"] == 5
+        check_records(f, samples, headers)
+        with pytest.raises(IndexError):
+            f.record(300)
+        parts = f.split(4)
+        assert parts[0][0] == 0 and parts[-1][1] == 300
+        assert all(a[1] == b[0] for (a, b) in zip(parts[:-1], parts[1:]))
+    assert os.path.isfile(ljh3.offsets_filename(filename))
+    # a second open reads the sidecar, and agrees
+    with LJH3File(filename) as f:
+        assert f.nsaved == 300
+        check_records(f, samples, headers)
+
+def test_refresh(tmp_path):
+    filename = str(tmp_path/"a.ljh3")
+    samples, headers = make_records(300, seed=1)
+    w = LJH3Writer(filename, FRAMEPERIOD)
+    write_records(w, samples[:250], headers[:250])
+    w.flush()
+    f = LJH3File(filename)
+    assert len(f) == 250
+    # a record and a half more, the partial record waits
+    write_records(w, samples[250:251], headers[250:251])
+    w.f.write(np.zeros(1, ljh3.RECORD_HEADER).tobytes()[:10])
+    w.flush()
+    assert f.refresh() == 1
+    w.close()
+    # finish the partial record by rewriting the tail of the file
+    with open(filename, "r+b") as out:
+        out.seek(f.end)
+        for (s, h) in zip(samples[251:], headers[251:]):
+            hdr = np.zeros(1, ljh3.RECORD_HEADER)
+            hdr["nsamples"], hdr["first_rising_sample"], hdr["frame1index"], hdr["timestamp_usec"] = (len(s),)+h
+            out.write(hdr.tobytes()+s.tobytes())
+    batches = list(f.follow(poll_s=0.01, timeout_s=0.05, first=240))
+    assert batches == [(240, 300)]
+    check_records(f, samples, headers)
+    f.close()
+    # the sidecar was extended, not rewritten, and a fresh open uses all of it
+    with LJH3File(filename) as f2:
+        assert f2.nsaved == 300
+        check_records(f2, samples, headers)
+
+def test_stale_sidecar(tmp_path):
+    filename = str(tmp_path/"a.ljh3")
+    samples, headers = make_records(260, seed=2)
+    with LJH3Writer(filename, FRAMEPERIOD) as w:
+        write_records(w, samples, headers)
+    LJH3File(filename).close()
+    # rewrite the file with another header and fewer records, the old sidecar must not be used
+    with LJH3Writer(filename, 2*FRAMEPERIOD) as w:
+        write_records(w, samples[:10], headers[:10])
+    with LJH3File(filename) as f:
+        check_records(f, samples[:10], headers[:10])
+    with LJH3File(filename, persist_offsets=False) as f:
+        assert f.nsaved == 10
+
+def test_not_ljh3(tmp_path):
+    filename = str(tmp_path/"a.ljh3")
+    with open(filename, "wb") as out:
+        out.write(b'{"File Format": "LJH3", "File Format Version": "2.0.0", "frameperiod": 1e-6}\n')
+    with pytest.raises(ValueError):
+        LJH3File(filename)
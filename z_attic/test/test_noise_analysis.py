@@ -0,0 +1,108 @@
+# NoiseSpectra of scripts/noise_analysis.py against the autocorrelation and power spectral density worked out
+# directly, lag by lag and frequency by frequency without FFTs, following compute_autocorr and compute_psd in
+# src/NoiseAnalysis.jl. Run with pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import h5py
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import noise_analysis
+from noise_analysis import NoiseSpectra, round_up_dft_length, hann
+import ljh
+from ljh_files import write_ljh, noise_records, FRAMETIME
+
+def direct_autocorr(data, nlags, chunk_multiple=7, max_exc=1000):
+    """Average over chunks of nlags*chunk_multiple samples of sum_i x[i]x[i+k]/(m-k), skipping chunks with big excursions."""
+    m = nlags*chunk_multiple
+    ac = np.zeros(nlags)
+    nused = 0
+    for i in range(len(data)//m):
+        x = data[i*m:(i+1)*m].astype(np.float64)
+        x = x-x.mean()
+        if np.abs(x).max() > max_exc:
+            continue
+        nused += 1
+        for k in range(nlags):
+            ac[k] += np.dot(x[:m-k], x[k:])/(m-k)
+    return ac/nused
+
+def direct_psd(data, nfreq, dt):
+    """Hann windowed segments of 2(nfreq-1) samples spread evenly over `data`, each transformed with an explicit DFT sum."""
+    nsamp = 2*(nfreq-1)
+    nseg = int(np.ceil(len(data)/float(nsamp)))
+    step = (len(data)+1-nsamp)//(nseg-1) if nseg > 1 else 1
+    window = hann(nsamp)
+    window = window/np.sqrt(np.sum(window**2))
+    dft = np.exp(-2j*np.pi*np.outer(np.arange(nfreq), np.arange(nsamp))/nsamp)
+    psd = np.zeros(nfreq)
+    for i in range(nseg):
+        x = data[i*step:i*step+nsamp].astype(np.float64)
+        psd += np.abs(dft.dot(window*(x-x.mean())))**2
+    return psd*2*dt/nseg
+
+def correlated_noise(n, seed=0):
+    # a running sum of white noise plus white noise, so the autocorrelation isn't just a spike at lag 0
+    rng = np.random.RandomState(seed)
+    x = rng.normal(0, 5, n)
+    x = 1000+np.convolve(x, np.ones(4)/2, "same")+rng.normal(0, 3, n)
+    return np.round(x).astype(np.uint16)
+
+@pytest.mark.parametrize("nsamples_total", [60*40, 60*40+37])
+def test_matches_direct(nsamples_total):
+    data = correlated_noise(nsamples_total+100)
+    nlags, nfreq = 40, 33
+    s = NoiseSpectra(nsamples_total, FRAMETIME, nlags, nfreq)
+    # odd sized pieces, and samples past nsamples_total, which are ignored
+    rng = np.random.RandomState(1)
+    i = 0
+    while i < len(data):
+        k = rng.randint(1, 150)
+        s.add(data[i:i+k])
+        i += k
+    r = s.result()
+    used = data[:nsamples_total]
+    np.testing.assert_allclose(r["autocorr"], direct_autocorr(used, nlags), rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(r["powerspectrum"], direct_psd(used, nfreq, FRAMETIME), rtol=1e-9, atol=1e-12)
+    assert r["samplesused"] == nsamples_total
+    assert r["freqstep"] == pytest.approx(0.5/FRAMETIME/(nfreq-1))
+
+def test_max_excursion():
+    data = correlated_noise(20*70).astype(np.float64)
+    data[3*70+5] += 5000 # one glitch, in the 4th autocorrelation chunk
+    s = NoiseSpectra(len(data), FRAMETIME, 10, 17)
+    s.add(data)
+    r = s.result()
+    assert s.nchunks_used == 19
+    np.testing.assert_allclose(r["autocorr"], direct_autocorr(data, 10), rtol=1e-9)
+
+def test_errors():
+    with pytest.raises(ValueError):
+        NoiseSpectra(100, FRAMETIME, 20, 17) # less than one 140 sample autocorrelation chunk
+    s = NoiseSpectra(500, FRAMETIME, 10, 17)
+    s.add(np.full(400, 1000))
+    with pytest.raises(ValueError):
+        s.result() # not all samples added
+    s.add(np.full(100, 1000))
+    with pytest.raises(ValueError):
+        s.result() # constant
+
+def test_round_up_dft_length():
+    assert [round_up_dft_length(n) for n in [100, 128, 129, 161, 200, 1600]] == [128, 128, 160, 192, 256, 2048]
+
+def test_noise_file(tmp_path):
+    samples = noise_records(300, 64, seed=2)
+    filename = write_ljh(str(tmp_path/"noise.ljh"), samples, 16)
+    s, nrecords = noise_analysis.noise_spectra_for_file(filename, max_samples=250*64+10)
+    assert nrecords == 250
+    for (first, end, segnum, seg) in ljh.LJHFile(filename).iter_segments(64):
+        s.add(seg)
+    r = s.result()
+    data = samples[:250].ravel()
+    np.testing.assert_allclose(r["autocorr"], direct_autocorr(data, 64), rtol=1e-9)
+    np.testing.assert_allclose(r["powerspectrum"], direct_psd(data, round_up_dft_length(32)+1, FRAMETIME), rtol=1e-9)
+    output = noise_analysis.write_noise_results(str(tmp_path/"noise.hdf5"), {3:r})
+    with h5py.File(output, "r") as h5:
+        assert np.array_equal(h5["3/noise/autocorr"][()], r["autocorr"])
+        assert h5["3/noise/samplesused"][()] == 250*64
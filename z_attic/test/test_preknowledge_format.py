@@ -0,0 +1,90 @@
+# Preknowledge files in the grouped and packed layouts of scripts/preknowledge_format.py, each read back with
+# PreknowledgeFile and cuts.load_cuts, run with pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import h5py
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import preknowledge_format
+from preknowledge_format import PreknowledgeFile, write_grouped, write_packed, convert_preknowledge
+from cuts import load_cuts
+
+def channel_values(seed=0, chans=(1, 3, 13)):
+    rng = np.random.RandomState(seed)
+    out = {}
+    for ch in chans:
+        out[ch] = {
+            "analysis_type":"mass compatible feb 2017",
+            "physical/frametime":9.6e-6,
+            "trigger/nsamples":np.int64(200),
+            "trigger/npresamples":np.int64(50),
+            "summarize/peak_index":np.int64(80+ch),
+            "filter/shift_threshold":np.int64(21),
+            "filter/values":rng.normal(size=199),
+            "filter/values_at":rng.normal(size=199),
+            "filter/average_pulse":rng.normal(size=200),
+            "cuts/pretrigger_rms":np.array([0.0, 10.0+ch]),
+            "cuts/postpeak_deriv":np.array([-np.inf, 20.0]),
+        }
+    # a cut only one channel has, packed files fill it in with (-inf, inf) for the rest
+    out[chans[0]]["cuts/timestamp_sec"] = np.array([100.0, 200.0])
+    return out
+
+def assert_same_values(a, b, fill_cuts=False):
+    for (p, v) in a.items():
+        if isinstance(v, str):
+            assert b[p] == v, p
+        else:
+            assert np.array_equal(b[p], v), p
+    extra = set(b)-set(a)
+    if fill_cuts:
+        for p in extra:
+            assert p.startswith("cuts/") and list(b[p]) == [-np.inf, np.inf]
+    else:
+        assert not extra
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_round_trip(tmp_path, packed):
+    values = channel_values()
+    filename = str(tmp_path/"pk.hdf5")
+    (write_packed if packed else write_grouped)(filename, values)
+    with PreknowledgeFile(filename) as pk:
+        assert pk.packed == packed
+        assert pk.channels == [1, 3, 13]
+        everything = pk.read_all()
+        for ch in pk.channels:
+            assert_same_values(values[ch], pk[ch], fill_cuts=packed)
+            assert_same_values(values[ch], everything[ch], fill_cuts=packed)
+        cuts = pk.cuts(3)
+    assert sorted(cuts.names) == ["postpeak_deriv", "pretrigger_rms"]+(["timestamp_sec"] if packed else [])
+    assert dict(zip(cuts.names, cuts.limits))["pretrigger_rms"] == (0.0, 13.0)
+    loaded = load_cuts(filename)
+    assert dict(zip(loaded[1].names, loaded[1].limits))["timestamp_sec"] == (100.0, 200.0)
+
+def test_grouped_is_what_pope_reads(tmp_path):
+    filename = write_grouped(str(tmp_path/"pk.hdf5"), channel_values())
+    with h5py.File(filename, "r") as h5:
+        assert h5["chan13/summarize/peak_index"][()] == 93
+        assert h5["chan13/analysis_type"][()] == b"mass compatible feb 2017"
+        assert list(h5["chan1/cuts"].keys()) == ["postpeak_deriv", "pretrigger_rms", "timestamp_sec"]
+
+def test_convert(tmp_path):
+    values = channel_values(seed=1)
+    grouped = write_grouped(str(tmp_path/"pk.hdf5"), values)
+    packed = convert_preknowledge(grouped, str(tmp_path/"pk_packed.hdf5"), True)
+    back = convert_preknowledge(packed, str(tmp_path/"pk_grouped.hdf5"), False)
+    with PreknowledgeFile(back) as pk:
+        for ch in values:
+            assert_same_values(values[ch], pk[ch], fill_cuts=True)
+
+def test_packed_needs_matching_channels(tmp_path):
+    values = channel_values()
+    del values[3]["filter/shift_threshold"]
+    with pytest.raises(ValueError):
+        write_packed(str(tmp_path/"pk.hdf5"), values)
+    values = channel_values()
+    values[3]["filter/average_pulse"] = np.zeros(100)
+    with pytest.raises(ValueError):
+        write_packed(str(tmp_path/"pk.hdf5"), values)
@@ -0,0 +1,83 @@
+# Projectors of scripts/projectors.py against the dense solve of computeprojectors in src/projections.jl,
+# with the noise covariance built as a full Toeplitz matrix, run with pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import scipy.linalg
+import h5py
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import projectors
+from projectors import compute_projectors, NoiseFactorCache
+
+def dense_projectors(basis, autocorr):
+    N = basis.shape[0]
+    rinvb = np.linalg.solve(scipy.linalg.toeplitz(autocorr[:N]), basis)
+    a = basis.T.dot(rinvb)
+    return np.linalg.solve(a, rinvb.T), np.linalg.inv(a)
+
+def exp_autocorr(n, sigma, rho, white):
+    autocorr = sigma**2*rho**np.arange(n)
+    autocorr[0] += white**2
+    return autocorr
+
+def random_bases(shapes, seed=0):
+    rng = np.random.RandomState(seed)
+    return {ch:rng.normal(size=shape) for (ch, shape) in shapes.items()}
+
+SHAPES = {1:(64, 3), 3:(64, 3), 5:(64, 5), 7:(100, 4)}
+AUTOCORRS = {1:exp_autocorr(64, 5, 0.6, 3), 3:exp_autocorr(80, 2, 0.9, 1), 5:exp_autocorr(64, 5, 0.6, 3),
+    7:exp_autocorr(100, 4, 0.3, 6)}
+
+@pytest.mark.parametrize("kind", projectors.FACTOR_KINDS)
+def test_matches_dense(kind):
+    bases = random_bases(SHAPES)
+    out = compute_projectors(bases, AUTOCORRS, NoiseFactorCache(kind))
+    for (ch, basis) in bases.items():
+        p, pcovar = out[ch]
+        p0, pcovar0 = dense_projectors(basis, AUTOCORRS[ch])
+        assert p.shape == (SHAPES[ch][1], SHAPES[ch][0])
+        np.testing.assert_allclose(p, p0, rtol=1e-8, atol=1e-10*np.abs(p0).max())
+        np.testing.assert_allclose(pcovar, pcovar0, rtol=1e-8, atol=1e-10*np.abs(pcovar0).max())
+        # projecting the basis itself gives back its coefficients
+        np.testing.assert_allclose(p.dot(basis), np.eye(SHAPES[ch][1]), atol=1e-8)
+
+def test_cache(tmp_path):
+    bases = random_bases(SHAPES)
+    cache = NoiseFactorCache(cache_dir=str(tmp_path/"factors"))
+    compute_projectors(bases, AUTOCORRS, cache)
+    assert (cache.hits, cache.misses) == (1, 3) # chan 1 and 5 have the same noise
+    assert len(os.listdir(str(tmp_path/"factors"))) == 3
+    cache2 = NoiseFactorCache(cache_dir=str(tmp_path/"factors"))
+    p, pcovar = projectors.computeprojectors(bases[7], AUTOCORRS[7], cache2)
+    assert (cache2.hits, cache2.misses) == (1, 0)
+    np.testing.assert_allclose(p, dense_projectors(bases[7], AUTOCORRS[7])[0], rtol=1e-8, atol=1e-12)
+
+def test_errors():
+    basis = random_bases({0:(32, 3)})[0]
+    with pytest.raises(ValueError):
+        projectors.computeprojectors(basis[:,[0, 1, 1]], exp_autocorr(32, 5, 0.6, 3))
+    with pytest.raises(ValueError):
+        projectors.computeprojectors(basis, exp_autocorr(20, 5, 0.6, 3))
+    with pytest.raises(ValueError):
+        projectors.computeprojectors(basis[:2], exp_autocorr(32, 5, 0.6, 3)) # more columns than rows
+    with pytest.raises(ValueError):
+        NoiseFactorCache("qr")
+
+def test_check_model_projectors(tmp_path):
+    bases = random_bases(SHAPES)
+    filename = str(tmp_path/"model.hdf5")
+    with h5py.File(filename, "w") as h5:
+        for (ch, basis) in bases.items():
+            p, pcovar = dense_projectors(basis, AUTOCORRS[ch])
+            g = h5.create_group("%d/svdbasis"%ch)
+            g["basis"] = basis.T
+            g["noise_result/autocorr"] = AUTOCORRS[ch]
+            g["projectors"] = (p*(1.1 if ch == 3 else 1.0)).T.astype(np.float32)
+            g["projector_covariance"] = pcovar.T.astype(np.float32)
+    diffs = projectors.check_model_projectors(filename)
+    assert diffs[3] == pytest.approx(0.1/1.1, rel=1e-5)
+    assert max(diffs[ch] for ch in [1, 5, 7]) < 1e-6
+    projectors.check_model_projectors(filename, write=True)
+    assert max(projectors.check_model_projectors(filename).values()) < 1e-6
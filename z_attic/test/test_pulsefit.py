@@ -0,0 +1,55 @@
+# Two exponential pulse fits of scripts/pulsefit.py on pulses made from known time constants, the batch fit
+# also against curve_fit one channel at a time, run with pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import scipy.optimize
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from pulsefit import two_exp_curve, two_exp_fit_batch, two_exp_fit_pulse, two_exp_initial_guess
+
+NSAMPLES = 400
+NPRESAMPLES = 100
+TAUS = [(2.0, 30.0), (5.0, 80.0), (10.0, 40.0), (1.0, 150.0)]
+
+def average_pulses(noise=0.0, seed=0):
+    """`(NSAMPLES, len(TAUS))` normalized pulses starting at sample NPRESAMPLES+1, like the average pulses in the report."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(NSAMPLES-NPRESAMPLES-1, dtype=np.float64)
+    pulses = np.zeros((NSAMPLES, len(TAUS)))
+    for (i, (tau1, tau2)) in enumerate(TAUS):
+        y = two_exp_curve(t, 1.0, tau1, tau2)
+        pulses[NPRESAMPLES+1:, i] = y/y.max()+noise*rng.normal(size=len(t))
+    return pulses
+
+def test_batch_recovers_time_constants():
+    fit = two_exp_fit_batch(average_pulses(), NPRESAMPLES)
+    assert np.all(fit["converged"])
+    np.testing.assert_allclose(fit["tau1"], [tau1 for (tau1, tau2) in TAUS], rtol=1e-6)
+    np.testing.assert_allclose(fit["tau2"], [tau2 for (tau1, tau2) in TAUS], rtol=1e-6)
+    np.testing.assert_allclose(fit["amp"], 1.0, rtol=1e-6)
+
+def test_batch_matches_curve_fit():
+    pulses = average_pulses(noise=0.01)
+    fit = two_exp_fit_batch(pulses, NPRESAMPLES)
+    t = np.arange(NSAMPLES-NPRESAMPLES-1, dtype=np.float64)
+    for (i, (tau1, tau2)) in enumerate(TAUS):
+        popt, pcov = scipy.optimize.curve_fit(two_exp_curve, t, pulses[NPRESAMPLES+1:, i], [1.0, tau1, tau2])
+        assert fit["converged"][i]
+        np.testing.assert_allclose((fit["tau1"][i], fit["tau2"][i]), popt[1:], rtol=1e-4)
+        np.testing.assert_allclose((fit["dtau1"][i], fit["dtau2"][i]), np.sqrt(np.diag(pcov))[1:], rtol=1e-2)
+
+def test_initial_guess():
+    y = average_pulses()[NPRESAMPLES+1:]
+    t = np.arange(len(y), dtype=np.float64)
+    a, tau1, tau2 = two_exp_initial_guess(t, y)
+    assert np.all(tau1 < tau2)
+    # the fall time comes straight from the log slope of the tail, so it is close already
+    np.testing.assert_allclose(tau2, [tau2 for (tau1, tau2) in TAUS], rtol=0.2)
+
+def test_fit_pulse():
+    pulses = average_pulses()
+    popt, sigma, ydata = two_exp_fit_pulse(pulses[:,1], NPRESAMPLES)
+    assert len(ydata) == NSAMPLES
+    assert sorted(popt[1:3]) == pytest.approx([5.0, 80.0], rel=1e-3)
@@ -0,0 +1,63 @@
+# QuantileSketch in scripts/robust_stats.py against numpy, run with pytest from this directory.
+
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from robust_stats import QuantileSketch, ConvergenceCheck
+
+def exact(x):
+    median = np.median(x)
+    return median, np.median(np.abs(x-median))
+
+def noise_with_outliers(outlier, n=200000, fraction=0.001, seed=0):
+    # like a noise file's postpeak_deriv with a few stray pulses in it
+    rng = np.random.RandomState(seed)
+    x = rng.normal(20, 2, n)
+    x[rng.rand(n) < fraction] = outlier
+    return x
+
+@pytest.mark.parametrize("outlier", [60000.0, 5000.0, -3000.0, 1e12])
+def test_median_mad_with_outliers(outlier):
+    x = noise_with_outliers(outlier)
+    sketch = QuantileSketch()
+    for batch in np.array_split(x, 13):
+        sketch.add(batch)
+    median, mad = exact(x)
+    median_error, mad_error = sketch.error_bound()
+    assert abs(sketch.median()-median) <= median_error
+    assert abs(sketch.mad()-mad) <= mad_error
+    # the cut limit calc_cuts_from_noise builds from them, 7 sigma
+    limit = median+7*1.4826*mad
+    assert abs(sketch.median()+7*1.4826*sketch.mad()-limit) < 0.01*limit
+
+def test_merge_matches_one_sketch():
+    rng = np.random.RandomState(1)
+    x = np.hstack((rng.exponential(5, 50000), -rng.exponential(1, 1000), np.zeros(100), [np.nan]*10))
+    whole = QuantileSketch()
+    whole.add(x)
+    parts = [QuantileSketch() for i in range(3)]
+    for (part, batch) in zip(parts, np.array_split(x, 3)):
+        part.add(batch)
+    merged = parts[0].merge(parts[1]).merge(parts[2])
+    assert merged.n == whole.n == len(x)-10
+    for q in [0.01, 0.25, 0.5, 0.9, 0.999]:
+        assert merged.quantile(q) == whole.quantile(q)
+        expected = np.nanquantile(x, q, method="inverted_cdf") # the value of rank ceil(q*n), like the sketch
+        assert abs(whole.quantile(q)-expected) <= 1e-3*abs(expected)+1e-9
+    assert merged.mad() == whole.mad()
+
+def test_empty_and_mismatched():
+    sketch = QuantileSketch()
+    sketch.add([np.nan])
+    assert np.isnan(sketch.median()) and np.isnan(sketch.mad())
+    with pytest.raises(ValueError):
+        sketch.merge(QuantileSketch(rel_error=1e-2))
+
+def test_convergence_check():
+    check = ConvergenceCheck(0.01, patience=2)
+    assert not check.update([10.0, 1.0])
+    assert not check.update([10.05, 1.0])
+    assert check.update([10.0, 1.005])
+    assert not check.update([12.0, 1.0])